@@ -0,0 +1,192 @@
+"""
+Agents compiled once instead of on every call.
+
+Each agent (data, twitter, rec, prediction) is registered with its prompt template and
+output schema. Registering builds the JsonOutputParser, the schema's format instructions
+and a PromptTemplate with those instructions already bound, and hashes the lot into a
+version. Calls then only supply their inputs, and chains are built once per model.
+
+Prompts can be swapped while running, either with `swap` or by dropping `<agent>.txt`
+into AGENT_PROMPT_DIR (picked up on the agent's next use). The version hash changes with
+the prompt, so `key` gives caches a stable key that never mixes prompt versions.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from langchain_core.output_parsers import JsonOutputParser
+from langchain.prompts import PromptTemplate
+from llm_scheduler import COMPLETION_TOKENS
+
+AGENT_PROMPT_DIR = os.getenv("AGENT_PROMPT_DIR")
+
+
+class compiled_agent():
+    def __init__(self, name, template, schema, version="builtin"):
+        """
+        Args:
+            name : agent name, e.g. "data"
+            template : prompt template; {format_instructions} is filled from `schema`
+            schema : pydantic (v1) model describing the agent's JSON output
+            version : label for where the template came from (the hash identifies the content)
+        """
+        self.name = name
+        self.template = template
+        self.schema = schema
+        self.version = version
+        self.parser = JsonOutputParser(pydantic_object=schema)
+        self.format_instructions = self.parser.get_format_instructions()
+        self.prompt = PromptTemplate.from_template(template).partial(format_instructions=self.format_instructions)
+        self.inputs = tuple(self.prompt.input_variables)
+        self.hash = hashlib.sha1(f"{name}\0{template}\0{self.format_instructions}".encode("utf-8")).hexdigest()[:12]
+        self.__chars = len(template) + len(self.format_instructions)
+        self.__chains = {}
+        self.__lock = threading.Lock()
+
+    def chain(self, model):
+        """
+        Outputs:
+            prompt | model | parser, built once per model
+        """
+        chain = self.__chains.get(id(model))
+        if chain is None:
+            with self.__lock:
+                # keep the model referenced so its id is not reused
+                self.__chains[id(model)] = (model, self.prompt | model | self.parser)
+                chain = self.__chains[id(model)]
+        return chain[1]
+
+    def tokens(self, inputs):
+        """
+        Rough prompt + completion tokens (~4 characters per token) without rendering the prompt
+        """
+        return (self.__chars + sum(len(str(value)) for value in inputs.values())) // 4 + COMPLETION_TOKENS
+
+    def key(self, inputs):
+        """
+        Outputs:
+            stable cache key for this prompt version and these inputs
+        """
+        payload = json.dumps(inputs, sort_keys=True, default=str, ensure_ascii=False)
+        return f"{self.name}:{self.hash}:{hashlib.sha1(payload.encode('utf-8')).hexdigest()}"
+
+    def describe(self):
+        return {"version": self.version, "hash": self.hash, "inputs": list(self.inputs)}
+
+
+class agent_registry():
+    def __init__(self, prompt_dir=AGENT_PROMPT_DIR):
+        """
+        Args:
+            prompt_dir : optional directory of `<agent>.txt` templates that override the registered ones
+        """
+        self.prompt_dir = prompt_dir
+        self.__agents = {}
+        self.__builtin = {}
+        self.__overrides = {}
+        self.__lock = threading.Lock()
+
+    def register(self, name, template, schema):
+        """
+        Compile an agent's built-in template
+        """
+        agent = compiled_agent(name, template, schema)
+        with self.__lock:
+            self.__builtin[name] = agent
+            self.__agents[name] = agent
+        return agent
+
+    def swap(self, name, template, version="runtime"):
+        """
+        Replace an agent's template; calls already running keep the version they started with
+        """
+        agent = compiled_agent(name, template, self.__agents[name].schema, version)
+        with self.__lock:
+            self.__agents[name] = agent
+        print(f"\n>>>\t{name} agent prompt swapped to {version} ({agent.hash})")
+        return agent
+
+    def restore(self, name):
+        """
+        Go back to the agent's built-in template
+        """
+        with self.__lock:
+            self.__agents[name] = self.__builtin[name]
+
+    def get(self, name):
+        """
+        Outputs:
+            the agent's current compiled_agent, after picking up any change to its AGENT_PROMPT_DIR file
+        """
+        if self.prompt_dir:
+            self.__check_override(name)
+        return self.__agents[name]
+
+    def __check_override(self, name):
+        path = os.path.join(self.prompt_dir, f"{name}.txt")
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+        if self.__overrides.get(name) == mtime:
+            return
+        self.__overrides[name] = mtime
+        if mtime is None:
+            self.restore(name)
+            return
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.swap(name, f.read(), f"{name}.txt@{mtime:.0f}")
+        except Exception as e:
+            # a broken override leaves the running prompt in place
+            print(f"\n>>>\tcould not load {path}: {e}")
+
+    def versions(self):
+        """
+        Outputs:
+            {agent: {"version", "hash", "inputs"}}
+        """
+        return {name: self.get(name).describe() for name in list(self.__agents)}
+
+
+if __name__ == "__main__":
+    # microbenchmark: per-call setup before (parser, format instructions, template) and after compiling once
+    import sys
+    import timeit
+    from pydantic.v1 import BaseModel, Field
+    from langchain_core.language_models import FakeListChatModel
+
+    class schema(BaseModel):
+        title : str = Field(description="")
+        location : str = Field(description="")
+        summary : str = Field(description="")
+
+    template = "Use the following format instructions:\n{format_instructions}\n" + "Instructions. " * 400 + "\n{article_title}\n{article_content}\n{{}}"
+    inputs = {"article_title": "Bushfire near Rowville", "article_content": "Content. " * 500}
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    model = FakeListChatModel(responses=["{}"])
+    fallback = FakeListChatModel(responses=["{}"])
+
+    def before():
+        # what every call used to do before queueing: rebuild, render for the token estimate, chain twice
+        parser = JsonOutputParser(pydantic_object=schema)
+        prompt = PromptTemplate(template=template, input_variables=[], partial_variables={"format_instructions": parser.get_format_instructions(), **inputs})
+        len(prompt.format())
+        prompt | model | parser
+        prompt | fallback | parser
+
+    registry = agent_registry()
+    registry.register("data", template, schema)
+
+    def after():
+        agent = registry.get("data")
+        agent.chain(model)
+        agent.chain(fallback)
+        agent.tokens(inputs)
+        agent.key(inputs)
+
+    for label, fn in (("per-call compile", before), ("registry", after)):
+        seconds = timeit.timeit(fn, number=calls)
+        print(f"{label:>16}: {seconds / calls * 1e6:8.1f} us/call")
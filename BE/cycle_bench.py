@@ -0,0 +1,352 @@
+"""
+Stub-model harness for the serverside cycle.
+
+Runs the real `run_cycle` (agents, LLM scheduler, geocoding, reduce, publishing) against
+a local stub chat model that answers every agent with valid JSON after a latency drawn
+from a heavy-tailed distribution, and injects 429 rate-limit errors and latency spikes.
+Geocoding and the news/twitter sources are stubbed too, so nothing leaves the machine;
+the articles are synthetic or replayed from recorded NewsAPI responses, with a new one
+arriving before every cycle. Before timing, it checks the scheduler itself: priority
+order under a full queue, 429s retried to success without holding a pool thread, and
+deadlines. It reports cycle completion time and, from the published snapshots, the time
+from a new article's arrival to each section being served (time to first useful data).
+It exits non-zero if any check fails or a cycle does.
+
+    python cycle_bench.py                          # 10 cycles, 10% 429s, 5% 10x latency spikes
+    python cycle_bench.py --rate-limits 0.3 --spikes 0.1 --cycles 20 --concurrency 2
+    python cycle_bench.py --replay newsapi.jsonl   # one recorded NewsAPI response per line
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import numpy
+import tabulate
+import shapely.geometry
+import geopandas as gpd
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatResult, ChatGeneration
+
+# around Melbourne, where the stub geocoder places every zone
+CENTRE = (144.96, -37.81)
+PLACES = (
+    "Churchill National Park, VIC, Australia",
+    "Plenty Gorge Park, VIC, Australia",
+    "Dandenong Ranges National Park, VIC, Australia",
+    "Lysterfield Park, VIC, Australia",
+    "Kinglake National Park, VIC, Australia",
+    "Brisbane Ranges National Park, VIC, Australia"
+)
+GOV_ADDRESSES = ("You Yangs Regional Park, Little River, VIC, Australia", "Yarra Ranges National Park, VIC, Australia")
+
+
+class RateLimitError(Exception):
+    """
+    Stands in for openai.RateLimitError (the scheduler retries by class name and status code)
+    """
+    status_code = 429
+
+
+class stub_chat_model(BaseChatModel):
+    """
+    Answers each agent with valid JSON for its schema after a lognormal latency
+    """
+    latency: float = 0.2
+    sigma: float = 0.5
+    spikes: float = 0.05
+    spike_factor: float = 10.0
+    rate_limits: float = 0.1
+    places: tuple = PLACES
+    calls: int = 0
+    rate_limited: int = 0
+
+    @property
+    def _llm_type(self):
+        return "stub"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls += 1
+        if random.random() < self.rate_limits:
+            self.rate_limited += 1
+            # 429s come back quickly
+            time.sleep(self.latency / 10)
+            raise RateLimitError("stub rate limit")
+        delay = random.lognormvariate(0, self.sigma) * self.latency
+        if random.random() < self.spikes:
+            delay *= self.spike_factor
+        time.sleep(delay)
+        text = messages[-1].content if messages else ""
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=json.dumps(stub_answer(text, self.places))))])
+
+
+def stub_places(count):
+    """
+    Outputs:
+        `count` place names for the stub geocoder: PLACES, then numbered ones
+    """
+    return PLACES[:count] + tuple(f"Stub Zone {i}, VIC, Australia" for i in range(len(PLACES), count))
+
+
+def stub_answer(prompt, places=PLACES):
+    """
+    Outputs:
+        an answer for whichever agent's output schema the prompt's format instructions carry
+    """
+    schema = prompt.split("Here is the output schema:")[-1]
+    if "predicted_time" in schema:
+        return [{"location": random.choice(places), "predicted_time": "2h, 30m", "time_of_impact": "18:30"}]
+    if "vehicle_advice" in schema:
+        return {"vehicle_advice": "4-Wheeler large vehicle", "clothing_advice": "Fire-proof clothes", "general_advice": "Leave early."}
+    if '"status"' in schema:
+        return [{"location": address, "status": "dangerous"} for address in GOV_ADDRESSES]
+    return {
+        "title": "Bushfire update", "location": random.choice(places), "disaster_type": "bushfire",
+        "emergency_no": "000", "url": "https://example.org", "danger_level": random.randint(5, 8),
+        "summary": "Fire crews are on the scene."
+    }
+
+
+def stub_geocode(latency=0.05):
+    """
+    Outputs:
+        replacement for osmnx.geocode_to_gdf: a 200-point boundary near CENTRE, stable per place
+    """
+    def geocode(place):
+        time.sleep(latency)
+        rng = random.Random(place)
+        x, y = CENTRE[0] + rng.uniform(-0.5, 0.5), CENTRE[1] + rng.uniform(-0.5, 0.5)
+        angles = numpy.linspace(0, 2 * numpy.pi, 200)
+        radius = rng.uniform(0.01, 0.05) * (1 + 0.1 * numpy.sin(7 * angles))
+        boundary = shapely.geometry.Polygon(numpy.column_stack((x + radius * numpy.cos(angles), y + radius * numpy.sin(angles))))
+        return gpd.GeoDataFrame({"display_name": [place]}, geometry=[boundary], crs="EPSG:4326")
+    return geocode
+
+
+class stub_sources():
+    """
+    Stands in for get_data: six articles, the government locations and a few tweets, with a
+    new article every `every` calls (every call by default) so each poll finds new content.
+    Articles are synthetic (`articles` of them), or taken in turn from `replay` (recorded
+    NewsAPI responses).
+    """
+    def __init__(self, every=1, replay=None, articles=6):
+        self.every = every
+        self.replay = replay
+        self.articles = articles
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.calls += 1
+            latest = self.calls // self.every
+        if self.replay:
+            articles = self.replay[latest % len(self.replay)].get("articles", [])
+        else:
+            articles = [
+                {"title": f"Bushfire update {n}", "content": "Fire crews are on the scene. " * 40,
+                 "url": f"https://example.org/{n}", "publishedAt": f"2025-01-22T{n % 24:02d}:00:00Z"}
+                for n in range(latest, latest - self.articles, -1)
+            ]
+        tweets = [
+            {"username": "FireWatchVIC", "content": f"Fire spreading near {address.split(',')[0]} #Bushfire", "date-time posted": "2025-01-22T15:00:00Z"}
+            for address in GOV_ADDRESSES
+        ]
+        md_twitter = "| | username | content |\n|---|---|---|\n" + "\n".join(f"| {i} | {t['username']} | {t['content']} |" for i, t in enumerate(tweets))
+        return (md_twitter, list(GOV_ADDRESSES), {"articles": articles}, tweets)
+
+
+def load_replay(path):
+    """
+    Outputs:
+        list of recorded NewsAPI responses from a JSON list, or one response per line
+    """
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def install(backend, model, geocode_latency=0.05, sources=None):
+    """
+    Point the backend's agents, geocoder and (optionally) sources at the stubs
+    """
+    backend.updated_data.set_model(model)
+    backend.ox.geocode_to_gdf = stub_geocode(geocode_latency)
+    if sources is not None:
+        backend.updated_data.get_data = staticmethod(sources)
+
+
+def stub_app():
+    """
+    uvicorn factory (`uvicorn cycle_bench:stub_app --factory`): the real app with stubbed
+    agents, geocoder and sources, configured from STUB_* environment variables. POST
+    /start_serverside then runs the real cycle inside the server.
+    """
+    import first_responders_serverside_backend as backend
+    places = int(os.getenv("STUB_PLACES", str(len(PLACES))))
+    model = stub_chat_model(
+        latency=float(os.getenv("STUB_LATENCY", "0.2")),
+        spikes=float(os.getenv("STUB_SPIKES", "0.05")),
+        rate_limits=float(os.getenv("STUB_RATE_LIMITS", "0.1")),
+        places=stub_places(places)
+    )
+    replay = load_replay(os.environ["STUB_REPLAY"]) if os.getenv("STUB_REPLAY") else None
+    sources = stub_sources(replay=replay, articles=int(os.getenv("STUB_ARTICLES", "6")))
+    install(backend, model, float(os.getenv("STUB_GEOCODE_LATENCY", "0.05")), sources)
+    return backend.app
+
+
+def check_scheduler():
+    """
+    Outputs:
+        list of failed checks of llm_scheduler against stub calls
+    """
+    from llm_scheduler import llm_scheduler, PRIORITY_ARTICLE, PRIORITY_REC
+    failures = []
+
+    # priority: with the request bucket empty, a rec call queued behind four articles runs first
+    scheduler = llm_scheduler(rpm=60, concurrency=2)
+    scheduler.requests.level = 0
+    order, lock = [], threading.Lock()
+
+    def call(name, seconds=0.05):
+        def fn():
+            with lock:
+                order.append(name)
+            time.sleep(seconds)
+            return name
+        return fn
+    futures = [scheduler.submit(call(f"art{i}"), priority=PRIORITY_ARTICLE, tokens=10) for i in range(4)]
+    futures.append(scheduler.submit(call("rec"), priority=PRIORITY_REC, tokens=10))
+    for future in futures:
+        future.result()
+    if order[0] != "rec":
+        failures.append(f"priority: admitted {order}, expected rec first")
+    scheduler.shutdown()
+
+    # 429s are retried to success, and backoff doesn't hold the only pool thread
+    scheduler = llm_scheduler(concurrency=1, base_delay=0.3, max_delay=0.3)
+    attempts = []
+
+    def limited():
+        attempts.append(time.monotonic())
+        if len(attempts) < 3:
+            raise RateLimitError("stub rate limit")
+        return "ok"
+    flaky = scheduler.submit(limited)
+    time.sleep(0.05)
+    started = time.monotonic()
+    quick = scheduler.submit(lambda: "quick").result(timeout=5)
+    if quick != "quick" or time.monotonic() - started > 0.2:
+        failures.append(f"backoff: a call waited {time.monotonic() - started:.2f}s behind a retry's backoff")
+    if flaky.result(timeout=5) != "ok" or len(attempts) != 3:
+        failures.append(f"retry: {len(attempts)} attempts")
+    scheduler.shutdown()
+
+    # deadlines: a call that can't start before its deadline fails instead of waiting forever
+    scheduler = llm_scheduler(concurrency=1)
+    scheduler.submit(call("slow", 0.5))
+    late = scheduler.submit(call("late"), deadline=0.1)
+    try:
+        late.result(timeout=5)
+        failures.append("deadline: queued call ran past its deadline")
+    except TimeoutError:
+        pass
+    scheduler.shutdown()
+    return failures
+
+
+def percentile(ordered, pct):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] if ordered else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cycles", type=int, default=10, help="cycles to time")
+    parser.add_argument("--latency", type=float, default=0.2, help="median stub LLM latency (seconds)")
+    parser.add_argument("--sigma", type=float, default=0.5, help="lognormal spread of the stub latency")
+    parser.add_argument("--spikes", type=float, default=0.05, help="fraction of calls taking --spike-factor times longer")
+    parser.add_argument("--spike-factor", type=float, default=10, help="latency multiplier of a spike")
+    parser.add_argument("--rate-limits", type=float, default=0.1, help="fraction of calls answered with a 429")
+    parser.add_argument("--geocode-latency", type=float, default=0.05, help="stub geocoding latency (seconds)")
+    parser.add_argument("--concurrency", type=int, default=4, help="LLM_CONCURRENCY")
+    parser.add_argument("--replay", help="file of recorded NewsAPI responses (a JSON list, or one per line) to play one per cycle")
+    parser.add_argument("--cache", action="store_true", help="keep the LLM result cache on (unchanged articles are not re-sent)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    failures = check_scheduler()
+    for failure in failures:
+        print(f"FAILED {failure}")
+    print(f"scheduler checks: {3 - len({f.split(':')[0] for f in failures})} of 3 passed\n")
+
+    scratch = tempfile.mkdtemp()
+    # the backend reads these on import
+    os.environ.update(
+        SNAPSHOT_DB=os.path.join(scratch, "snapshots.db"),
+        OPENAI_API_KEY=os.getenv("OPENAI_API_KEY") or "stub",
+        LLM_CONCURRENCY=str(args.concurrency),
+        LLM_BASE_DELAY="0.2",
+        LLM_CACHE_SIZE=os.getenv("LLM_CACHE_SIZE", "256") if args.cache else "0"
+    )
+    import first_responders_serverside_backend as backend
+    from snapshot_store import snapshot_store
+
+    model = stub_chat_model(
+        latency=args.latency, sigma=args.sigma, spikes=args.spikes,
+        spike_factor=args.spike_factor, rate_limits=args.rate_limits
+    )
+    sources = stub_sources(replay=load_replay(args.replay) if args.replay else None)
+    install(backend, model, args.geocode_latency)
+    zones = backend.updated_data
+    zones.set_store(snapshot_store())
+    zones.compile_agents()
+    zones.store.acquire()
+
+    sections = {"danger zones": "polygons", "advice": "ai_rec", "predictions": "predictions"}
+    times = {"cycle completion": [], "first useful data": [], **{label: [] for label in sections}}
+    failed = 0
+    for cycle in range(args.cycles):
+        # the new article arrives with this poll
+        arrived = time.time()
+        started = time.monotonic()
+        try:
+            zones.run_cycle(list(sources()))
+        except Exception as e:
+            print(f"cycle {cycle} failed: {e}")
+            failed += 1
+            continue
+        times["cycle completion"].append(time.monotonic() - started)
+        served = zones.get_snapshot()
+        for label, section in sections.items():
+            times[label].append(served[f"{section}_at"] - arrived)
+        times["first useful data"].append(min(times[label][-1] for label in sections))
+    zones.store.release()
+    zones.shutdown_geometry()
+
+    rows = []
+    for label, samples in times.items():
+        ordered = sorted(samples)
+        rows.append([label, len(ordered), percentile(ordered, 50), percentile(ordered, 95), ordered[-1] if ordered else None])
+    print(tabulate.tabulate(rows, headers=["seconds after the article arrived", "cycles", "p50", "p95", "max"], floatfmt=".2f"))
+    print(f"\nstub LLM: {model.calls} calls, {model.rate_limited} answered 429; {failed} cycles failed\n")
+    agents = zones.get_llm_stats()["agents"]
+    print(tabulate.tabulate(
+        [[agent, s_["calls"], s_["p50"], s_["p90"], s_["p99"], s_["hedged"], s_["hedge_wins"]] for agent, s_ in agents.items()],
+        headers=["agent", "calls", "p50 s", "p90 s", "p99 s", "hedged", "hedge wins"], floatfmt=".2f"
+    ))
+    if failures or failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Change-driven cadence for the serverside cycle.
+
+The leader polls its sources (NewsAPI, twitter, government data) cheaply and only runs
+the expensive LLM/geocode stages when that content has changed. The wait between polls
+adapts: it drops to the minimum while danger levels or the rate of new items are high,
+and backs off exponentially towards the maximum while nothing changes. The danger level
+is the last cycle's, so an ongoing incident keeps polling fast between new articles
+until a later cycle reports it lower.
+"""
+
+import os
+import time
+import hashlib
+
+
+class cycle_scheduler():
+    def __init__(
+        self,
+        min_interval=float(os.getenv("CYCLE_MIN_INTERVAL", "15")),
+        max_interval=float(os.getenv("CYCLE_MAX_INTERVAL", "900")),
+        backoff=float(os.getenv("CYCLE_BACKOFF", "2")),
+        cycle_deadline=float(os.getenv("CYCLE_DEADLINE", "600")),
+        hot_danger=int(os.getenv("CYCLE_HOT_DANGER", "5")),
+        hot_velocity=float(os.getenv("CYCLE_HOT_VELOCITY", "2"))
+    ):
+        """
+        Args:
+            min_interval, max_interval : bounds (seconds) on the wait between polls
+            backoff : factor the wait grows by after each poll with no new content
+            cycle_deadline : seconds the LLM/geocode stages of one cycle may take
+            hot_danger : danger level at or above which polling runs at min_interval
+            hot_velocity : new items per minute at or above which polling runs at min_interval
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.cycle_deadline = cycle_deadline
+        self.hot_danger = hot_danger
+        self.hot_velocity = hot_velocity
+        self.interval = min_interval
+        # highest danger level the last completed cycle found
+        self.danger_level = 0
+        self.__seen = set()
+        self.__fingerprint = None
+        self.__last_poll = None
+
+    def reset(self):
+        """
+        Forget what was seen so the next poll always runs a full cycle
+        """
+        self.interval = self.min_interval
+        self.danger_level = 0
+        self.__seen = set()
+        self.__fingerprint = None
+        self.__last_poll = None
+
+    def invalidate(self):
+        """
+        Forget the last fingerprint so unchanged content is processed again (e.g. after a failed cycle)
+        """
+        self.__fingerprint = None
+
+    def poll(self, items):
+        """
+        Compare freshly fetched source items against the last processed ones
+        Args:
+            items : iterable of strings identifying each article/tweet/location
+        Outputs:
+            (changed, velocity) : whether anything changed, new items per minute since the last poll
+        """
+        now = time.monotonic()
+        keys = set(items)
+        fingerprint = hashlib.sha1("\n".join(sorted(keys)).encode("utf-8")).hexdigest()
+        new_items = len(keys - self.__seen)
+        elapsed = (now - self.__last_poll) if self.__last_poll is not None else 60.0
+        velocity = new_items * 60.0 / max(elapsed, 1.0)
+
+        changed = fingerprint != self.__fingerprint
+        self.__fingerprint = fingerprint
+        self.__seen = keys
+        self.__last_poll = now
+        return (changed, velocity)
+
+    def update(self, changed, velocity, danger_level=None):
+        """
+        Pick the wait before the next poll
+        Args:
+            danger_level : highest danger level of the cycle that just ran, or None if none ran
+                           (the last cycle's level then still applies)
+        Outputs:
+            seconds to wait
+        """
+        if danger_level is not None:
+            self.danger_level = danger_level
+        if self.danger_level >= self.hot_danger or velocity >= self.hot_velocity:
+            self.interval = self.min_interval
+        elif changed:
+            self.interval = max(self.min_interval, self.interval / self.backoff)
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        return self.interval
+
+    def deadline(self):
+        """
+        Outputs:
+            time.monotonic() value the cycle starting now must finish by
+        """
+        return time.monotonic() + self.cycle_deadline
@@ -2,11 +2,11 @@ import os
 import pandas as pd
 import json
 from dotenv import load_dotenv
+# before the local modules below, which read their settings from the environment on import
+load_dotenv()
 import tabulate
 from newsapi import NewsApiClient
 import requests
-from langchain_core.output_parsers import JsonOutputParser
-from langchain.prompts import PromptTemplate
 from datetime import datetime
 import pytz
 
@@ -26,19 +26,34 @@ from langchain_community.callbacks.manager import get_openai_callback
 from pydantic.v1 import BaseModel, Field
 
 from fastapi import FastAPI
+from fastapi import Query
+from fastapi import Body
 from fastapi import BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+from fastapi.responses import Response
+from fastapi.responses import StreamingResponse
 import osmnx as ox
 import shapely.geometry as geom
-from shapely.geometry import Polygon
 import time
+import threading
+import contextvars
+import copy
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_for
 from contextlib import asynccontextmanager
 import numpy
 from geopy.geocoders import Nominatim
 import geopandas as gpd
-
-load_dotenv()
+from snapshot_store import snapshot_store, snapshot_json, lease_lost
+from polygon_snapshot import polygon_snapshot
+from location_matcher import location_matcher
+from road_router import road_router, route_too_long
+from geofence import geofence_engine, ALERT_RADIUS
+from geometry_pool import geometry_pool, reduce_geometries, SIMPLIFY_TOLERANCE
+from agent_registry import agent_registry
+from cycle_scheduler import cycle_scheduler
+from llm_scheduler import llm_scheduler, PRIORITY_REC, PRIORITY_PREDICTION, PRIORITY_TWITTER, PRIORITY_ARTICLE
 
 class updated_data():
     polygons = []
@@ -48,16 +63,55 @@ class updated_data():
         model_name = "gpt-4o-mini",
         temperature = 0.2,
         max_tokens = 16384,
-        openai_api_key = os.getenv("OPENAI_API_KEY")
+        openai_api_key = os.getenv("OPENAI_API_KEY"),
+        # retries and rate limits are handled by __scheduler
+        timeout = float(os.getenv("LLM_TIMEOUT", "60")),
+        max_retries = 0
     )
+    # hedged duplicates of slow calls go here (the same model unless LLM_FALLBACK_MODEL is set)
+    __fallback_model = ChatOpenAI(
+        model_name = os.getenv("LLM_FALLBACK_MODEL"),
+        temperature = 0.2,
+        max_tokens = 16384,
+        openai_api_key = os.getenv("OPENAI_API_KEY"),
+        timeout = float(os.getenv("LLM_TIMEOUT", "60")),
+        max_retries = 0
+    ) if os.getenv("LLM_FALLBACK_MODEL") else __model
+    __scheduler = llm_scheduler()
+    __cycle = cycle_scheduler()
+    __cycle_deadline = None
+    # runs the recommendation and prediction stages alongside danger-zone geocoding
+    __stages = ThreadPoolExecutor(max_workers=2, thread_name_prefix="stage")
+    # zone simplification runs in worker processes once the zones carry GEOMETRY_PARALLEL_POINTS points
+    __geometry = geometry_pool()
+    # polygon_snapshot views of the stored binary sections, keyed by section
+    __decoded = {}
+    __matcher = None
+    # road graph for /route, loaded in the background; hazards follow the published zones
+    __router_lock = threading.Lock()
+    __router_version = None
+    router = None
+    # subscriptions as last loaded from the store, with their alert state (leader only)
+    __geofences = geofence_engine()
+    __geofence_version = None
+    # compiled agents, and LLM results keyed by agent prompt version + inputs
+    agents = None
+    __results = OrderedDict()
+    __results_lock = threading.Lock()
     stop = True
     running = False
     active = False
+    store = None
 
     # KEYS AND ENV VARS
     LANGSMITH_ENDPOINT = os.getenv("LANGSMITH_ENDPOINT")
     LANGSMITH_API_KEY = os.getenv("LANGSMITH_API_KEY")
     LANGSMITH_PROJECT = os.getenv("LANGSMITH_PROJECT")
+    # ask the twitter agent about locations the local matcher finds ambiguous
+    TWITTER_LLM_FALLBACK = os.getenv("TWITTER_LLM_FALLBACK", "false").lower() == "true"
+    LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "256"))
+    # a source with this many zones or more is left out of the danger zones
+    MAX_SOURCE_ZONES = int(os.getenv("MAX_SOURCE_ZONES", "40"))
     
     @classmethod
     def set_poly(cls, poly_):
@@ -97,6 +151,92 @@ class updated_data():
         """
         cls.active = state
 
+    @classmethod
+    def set_model(cls, model, fallback=None):
+        """
+        Swap the chat model the agents run on (and the model hedged calls go to, the same one by default)
+        """
+        cls.__model = model
+        cls.__fallback_model = fallback or model
+
+    @classmethod
+    def set_store(cls, store):
+        """
+        Shared snapshot store used by every worker
+        """
+        cls.store = store
+
+    @classmethod
+    def claim_leader(cls):
+        """
+        Take the cycle lease so only this worker runs the LLM/geocode cycle
+        Outputs:
+            True if this worker is (now) the leader
+        """
+        return cls.store.acquire()
+
+    @classmethod
+    def __heartbeat(cls, done):
+        """
+        Renew the cycle lease until the cycle finishes
+        """
+        while not done.wait(cls.store.lease_ttl / 3):
+            if not cls.store.renew():
+                print("\n>>>\tlost cycle lease, stopping after this cycle.")
+                cls.set_stop(True)
+                return
+
+    @classmethod
+    def publish(cls, *sections):
+        """
+        Write the given sections ("polygons", "predictions", "ai_rec") of the current outputs
+        to the shared store for every worker to serve
+        """
+        outputs = {"polygons": cls.polygons, "predictions": cls.predictions, "ai_rec": cls.ai_rec}
+        cls.store.publish(**{section: outputs[section] for section in sections})
+        if {"polygons", "predictions"} & set(sections):
+            # mask the new zones now rather than on this worker's next route request
+            cls.get_router()
+            cls.evaluate_geofences([s_ for s_ in sections if s_ != "ai_rec"])
+
+    @classmethod
+    def evaluate_geofences(cls, sections):
+        """
+        Join every subscription against the newly published polygon sections and log the alerts that changed
+        """
+        try:
+            started = time.monotonic()
+            version = cls.store.subscription_version()
+            if version != cls.__geofence_version:
+                restore = cls.__geofence_version is None
+                cls.__geofences.load(cls.store.subscriptions())
+                if restore:
+                    # another worker may have led since this one last evaluated
+                    cls.__geofences.restore(cls.store.latest_alerts())
+                cls.__geofence_version = version
+            alerts = []
+            for section in sections:
+                alerts += cls.__geofences.evaluate(section, cls.get_polygon_snapshot(section))
+            if alerts:
+                cls.store.add_alerts(alerts)
+            print(f">>>\t{len(alerts)} geofence alerts for {len(cls.__geofences)} subscriptions in {time.monotonic() - started:.2f}s")
+        except Exception as e:
+            # alerts are best effort; the published snapshot stands
+            print(f"\n>>>\tgeofence evaluation failed: {e}")
+
+    @classmethod
+    def check_geofence(cls, row):
+        """
+        Outputs:
+            current (non-clear) alerts of one subscription row, starting clear, against the latest published zones
+        """
+        engine = geofence_engine([row])
+        return [
+            alert
+            for section in ("polygons", "predictions") if cls.get_available(section)
+            for alert in engine.evaluate(section, cls.get_polygon_snapshot(section))
+        ]
+
     @classmethod
     def start_serverside(cls):
         """
@@ -105,74 +245,278 @@ class updated_data():
             cls.polygons : .geojson of Polygons variable
             cls.ai_rec : .json of AI recommendations variable
         """
+        if not cls.claim_leader():
+            print("\n\tServerside already running in another worker.\n")
+            return
 
         cls.set_stop(False)
         cls.set_running(True)
+        cls.__geofence_version = None
+
+        done = threading.Event()
+        threading.Thread(target=cls.__heartbeat, args=(done,), daemon=True).start()
+        try:
+            cls.__run_cycles()
+        finally:
+            done.set()
+            cls.store.release()
+            cls.set_running(False)
+        print("\n\tServer successfully stopped.\n")
 
+    @classmethod
+    def __run_cycles(cls):
+        cls.__cycle.reset()
         while(True):
-            dt_ = list(cls.get_data())
-
-            # params: md_twitter, dummy_government_data, data (NewsAPI)
-            outs_ = list(cls.prompt_ai(cls.__get_model(), dt_[0], dt_[1], dt_[2]))
+            changed, velocity, danger_level = False, 0, None
+            try:
+                # cheap poll; the LLM/geocode stages only run when the sources changed
+                dt_ = list(cls.get_data())
+                changed, velocity = cls.__cycle.poll(cls.source_items(dt_))
+                if changed:
+                    danger_level = cls.run_cycle(dt_)
+                    print("\n>>>\tsuccessfully ran cycle.")
+                else:
+                    print("\n>>>\tno new content, skipped cycle.")
+            except Exception as e:
+                # a failed cycle (e.g. LLM retries exhausted) keeps the last snapshot and is retried on the next poll
+                print(f"\n>>>\tcycle failed: {e}")
+                cls.__cycle.invalidate()
+                changed = False
+
+            wait = cls.__cycle.update(changed, velocity, danger_level)
+            print(f">>>\tnext poll in {wait:.0f}s (velocity {velocity:.1f}/min, danger level {cls.__cycle.danger_level})")
+            if cls.__wait(wait): break
 
-            # params: o_df, o_twit_df, dummy_government_data, output_recs, code
-            gnd_ = list(cls.gen_polygons(outs_[0], outs_[1], dt_[1], outs_[2], 0))
+    @classmethod
+    def __wait(cls, seconds):
+        """
+        Sleep until the next poll, waking early to stop
+        Outputs:
+            True if the serverside was asked to stop
+        """
+        end = time.monotonic() + seconds
+        while True:
+            if cls.stop or cls.store.stop_requested():
+                return True
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(5, remaining))
 
-            cls.set_ai_rec(gnd_[0])
+    @classmethod
+    def source_items(cls, dt_):
+        """
+        Identify every article, tweet and government location so polls can detect new content
+        Outputs:
+            list of strings, one per source item
+        """
+        md_twitter, dummy_government_addys, data = dt_[:3]
+        items = [f"news:{a.get('url') or a.get('title')}:{a.get('publishedAt')}" for a in data.get("articles", [])]
+        # rows of the markdown table, skipping the header and separator
+        items += [f"tweet:{row}" for row in md_twitter.splitlines()[2:]]
+        items += [f"gov:{addy}" for addy in dummy_government_addys]
+        return items
 
-            # Predict disaster type = outs_[0]['disaster_type'] "disaster_type" : o_df['disaster_type'][0]
-            prds_ = cls.predict(cls.__get_model(), outs_[1], dt_[1], outs_[0]['disaster_type'][0])
+    @classmethod
+    def __check_stage(cls, stage):
+        """
+        Abort the cycle before `stage` if the lease was lost or the cycle deadline passed
+        """
+        if not cls.store.holds():
+            raise lease_lost(f"lost cycle lease before {stage}")
+        if cls.__cycle_deadline is not None and time.monotonic() > cls.__cycle_deadline:
+            raise TimeoutError(f"cycle deadline passed before {stage}")
 
-            prds_poly_ = list(cls.gen_polygons(prds_, outs_[1], dt_[1], outs_[2], 1))
+    @classmethod
+    def run_cycle(cls, dt_=None):
+        """
+        Run the LLM and geocode stages once, publishing each section as soon as its stage finishes:
+            polygons once the data agents' locations are geocoded and reduced, ai_rec once the
+            recommendation agent returns, predictions once the prediction agent's are
+        Outputs:
+            highest danger level among the analysed articles (0 if none)
+        """
+        started = time.monotonic()
+        cls.__cycle_deadline = cls.__cycle.deadline()
+        if dt_ is None:
+            dt_ = list(cls.get_data())
 
-            poly_final = cls.reduce(gnd_[1], 40)
-            pred_final = cls.reduce(prds_poly_[1], 40)
+        # params: md_twitter, dummy_government_data, data (NewsAPI)
+        outs_ = list(cls.prompt_ai(cls.__get_model(), dt_[0], dt_[1], dt_[2], dt_[3]))
+        danger_level = outs_[2]
+
+        # a quiet cycle: no article is dangerous enough to have zones, predictions or advice
+        if outs_[0].empty:
+            cls.__check_stage("publishing")
+            cls.set_poly("No Danger detected.")
+            cls.publish("polygons")
+            cls.set_pred("No Danger detected.")
+            cls.publish("predictions")
+            cls.set_active(True)
+            print(f">>>\tno danger detected {time.monotonic() - started:.1f}s into cycle")
+            return danger_level
+        d_type = outs_[0]['disaster_type'][0]
+
+        # the recommendation and prediction agents only need the agent outputs, so they run while danger zones are geocoded
+        cls.__check_stage("recommendation")
+        advice = cls.__stages.submit(
+            contextvars.copy_context().run,
+            cls.__advise, cls.__get_model(), outs_[1], d_type, started
+        )
+        cls.__check_stage("prediction")
+        prediction = cls.__stages.submit(
+            contextvars.copy_context().run,
+            cls.predict, cls.__get_model(), outs_[1], dt_[1], d_type
+        )
+
+        try:
+            # params: o_df, o_twit_df, dummy_government_data, output_recs (published by its own stage), code
+            cls.__check_stage("geocoding")
+            gnd_ = list(cls.gen_polygons(outs_[0], outs_[1], dt_[1], None, 0))
+
+            cls.set_poly(cls.reduce(gnd_[1], 40))
+            cls.publish("polygons")
+            cls.set_active(True)
+            print(f">>>\tpublished danger zones {time.monotonic() - started:.1f}s into cycle")
+        finally:
+            # neither stage may outlive the cycle
+            wait_for((advice, prediction))
 
-            cls.set_poly(poly_final)
-            cls.set_pred(pred_final)
+        prds_ = prediction.result()
+        cls.__check_stage("prediction geocoding")
+        prds_poly_ = list(cls.gen_polygons(prds_, outs_[1], dt_[1], None, 1))
 
-            cls.set_active(True)
+        cls.set_pred(cls.reduce(prds_poly_[1], 40))
+        cls.publish("predictions")
+        print(f">>>\tpublished predictions {time.monotonic() - started:.1f}s into cycle")
+        advice.result()
 
-            if cls.stop: break
+        return danger_level
 
-            if not cls.stop: 
-                print("\n>>>\tsuccessfully ran cycle.")
-                time.sleep(45)
-        print("\n\tServer successfully stopped.\n")
+    @classmethod
+    def __advise(cls, model, o_twit_df, d_type, started):
+        """
+        Recommendation stage: publish ai_rec as soon as the agent returns
+        """
+        output_rec = cls.recommend(model, o_twit_df, d_type)
+        cls.set_ai_rec(json.dumps(output_rec, indent=4))
+        cls.__check_stage("publishing advice")
+        cls.publish("ai_rec")
+        print(f">>>\tpublished advice {time.monotonic() - started:.1f}s into cycle")
 
     @classmethod
     def stop_serverside(cls):
         cls.set_running(False)
         cls.set_active(False)
         cls.set_stop(True)
+        # the leader may be another worker
+        cls.store.request_stop()
 
     @classmethod
     def get_polygons(cls):
         """
         Outputs:
-            cls.polygons : List of polygon dangerzones in the form of geojson string
+            List of polygon dangerzones as JSON bytes from the shared store
         """
-        return cls.polygons
+        return cls.store.latest()["polygons"]
 
     @classmethod
     def get_ai_rec(cls):
         """
         Outputs:
-            cls.ai_rec : AI recommendations in the form of string
+            AI recommendations as JSON bytes from the shared store
         """
-        return cls.ai_rec
+        return cls.store.latest()["ai_rec"]
 
     @classmethod
     def get_predictions(cls):
-        return cls.predictions
+        return cls.store.latest()["predictions"]
+
+    @classmethod
+    def get_snapshot(cls):
+        """
+        Outputs:
+            latest published snapshot (possibly from before a restart), or None
+        """
+        return cls.store.latest()
+
+    @classmethod
+    def get_available(cls, section):
+        """
+        True if the section was ever published (possibly before a restart)
+        """
+        snapshot = cls.get_snapshot()
+        return snapshot is not None and snapshot[f"{section}_at"] is not None
+
+    @classmethod
+    def get_stale(cls, section=None):
+        """
+        True if the section (or any section) being served was not produced by the current leader
+        """
+        sections = [section] if section else ["polygons", "predictions", "ai_rec"]
+        return any(cls.get_available(s_) and not cls.get_active(s_) for s_ in sections)
+
+    @classmethod
+    def get_polygon_snapshot(cls, section):
+        """
+        Outputs:
+            polygon_snapshot viewing the stored binary of a polygon section (empty if it holds no zones)
+        """
+        buf = cls.get_snapshot()[f"{section}_bin"]
+        if buf is None:
+            return polygon_snapshot.from_rings([])
+        cached = cls.__decoded.get(section)
+        if cached is None or cached[0] is not buf:
+            cached = (buf, polygon_snapshot.from_binary(buf))
+            cls.__decoded[section] = cached
+        return cached[1]
+
+    @classmethod
+    def load_router(cls):
+        """
+        Load (building once if needed) the cached road graph used for routing
+        """
+        try:
+            cls.router = road_router.load()
+            print(f"\n>>>\tloaded road graph ({len(cls.router)} nodes).")
+        except Exception as e:
+            print(f"\n>>>\tcould not load road graph: {e}")
+
+    @classmethod
+    def get_router(cls):
+        """
+        Outputs:
+            road_router with the edges crossing the latest danger zones and predictions masked,
+            or None while the road graph is loading
+        """
+        snapshot = cls.get_snapshot()
+        if cls.router is None or snapshot is None:
+            return cls.router
+        version = (snapshot["polygons_at"], snapshot["predictions_at"])
+        with cls.__router_lock:
+            if version != cls.__router_version:
+                cls.router.update_hazards(cls.get_polygon_snapshot("polygons"), cls.get_polygon_snapshot("predictions"))
+                cls.__router_version = version
+        return cls.router
 
     @classmethod
     def get_running(cls):
-        return cls.running
+        """
+        True if any worker holds the cycle lease
+        """
+        return cls.store.lease_info() is not None
 
     @classmethod
-    def get_active(cls):
-        return cls.active
+    def get_active(cls, section=None):
+        """
+        True if the section (or any section) was published since the current leader started
+        """
+        lease = cls.store.lease_info()
+        latest = cls.store.latest()
+        if lease is None or latest is None:
+            return False
+        sections = [section] if section else ["polygons", "predictions", "ai_rec"]
+        return any((latest[f"{s_}_at"] or 0) >= lease[1] for s_ in sections)
 
     @classmethod
     def __get_model(cls):
@@ -182,6 +526,79 @@ class updated_data():
         """
         return cls.__model
 
+    @classmethod
+    def __submit(cls, agent, inputs, model, priority):
+        """
+        Queue an agent's precompiled chain on the shared LLM scheduler, hedging to the fallback model if slow.
+        Results are remembered by prompt version and inputs, so unchanged articles are not re-sent.
+        Outputs:
+            Future with the parsed chain output
+        """
+        compiled = cls.get_agent(agent)
+        key = compiled.key(inputs)
+        with cls.__results_lock:
+            if key in cls.__results:
+                cls.__results.move_to_end(key)
+                cached = Future()
+                cached.set_result(copy.deepcopy(cls.__results[key]))
+                return cached
+
+        chain = compiled.chain(model)
+        fallback_chain = compiled.chain(cls.__fallback_model)
+        # calls may not outlive the cycle they belong to
+        deadline = None
+        if cls.__cycle_deadline is not None:
+            deadline = max(0, cls.__cycle_deadline - time.monotonic())
+        future = cls.__scheduler.submit(
+            lambda: chain.invoke(inputs),
+            priority=priority,
+            tokens=compiled.tokens(inputs),
+            deadline=deadline,
+            agent=agent,
+            hedge_fn=lambda: fallback_chain.invoke(inputs)
+        )
+        future.add_done_callback(lambda f: cls.__remember(key, f))
+        return future
+
+    @classmethod
+    def __remember(cls, key, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        with cls.__results_lock:
+            cls.__results[key] = copy.deepcopy(future.result())
+            if len(cls.__results) > cls.LLM_CACHE_SIZE:
+                cls.__results.popitem(last=False)
+
+    @classmethod
+    def compile_agents(cls):
+        """
+        Build every agent's parser, format instructions and prompt template once
+        """
+        registry = agent_registry()
+        registry.register("data", tmplt_data_agent, tds_data_agent)
+        registry.register("twitter", tmplt_twit_agent, tds_twit_agent)
+        registry.register("rec", tmplt_rec_agent, tds_rec_agent)
+        registry.register("prediction", tmplt_prediction_agent, tds_prediction_agent)
+        cls.agents = registry
+
+    @classmethod
+    def get_agent(cls, name):
+        """
+        Outputs:
+            the agent's compiled_agent at its current prompt version
+        """
+        if cls.agents is None:
+            cls.compile_agents()
+        return cls.agents.get(name)
+
+    @classmethod
+    def get_llm_stats(cls):
+        """
+        Outputs:
+            per-agent LLM latency histograms and hedge spend
+        """
+        return cls.__scheduler.stats()
+
     @classmethod
     def get_data(cls):
         """
@@ -190,6 +607,7 @@ class updated_data():
             md_twitter : twitter data in Markdown format
             dummy_government_addys : government identified dangerzone locations
             data : newsAPI identified dangerzones
+            dummy_twitter_data : raw tweets for the local location matcher
         """
         # GET DANGER ZONE LOCATION + DUMMY DATA
         url_endpoint = "https://newsapi.org/v2/everything"
@@ -296,117 +714,305 @@ class updated_data():
 
         md_twitter = df_twitter.to_markdown()
 
-        return (md_twitter, dummy_government_addys, data)
+        return (md_twitter, dummy_government_addys, data, dummy_twitter_data)
 
     @classmethod
-    def prompt_ai(cls, model, md_twitter, dummy_government_addys, data):
+    def prompt_ai(cls, model, md_twitter, dummy_government_addys, data, tweets=None):
         """
         Prompts the AI model 
+        Twitter/government correlation runs on the local location matcher when raw `tweets` are given
         Outputs:
             o_df : AI analysis of NewsAPI dangerzone information
             o_twit_df : AI analysis of Twitter dangerzone information
-            output_rec : AI recommendations for disaster
+            danger_level : highest danger level among all analysed articles (0 if none)
         """
-        # TEMPLATES
-        parser_data_agent = JsonOutputParser(pydantic_object=tds_data_agent)
-        parser_twit_agent = JsonOutputParser(pydantic_object=tds_twit_agent)
-        parser_rec_agent = JsonOutputParser(pydantic_object=tds_rec_agent)
-        tmplt_rec_agent = """
-        ---
-        You are an advanced meteoriligist consultant analyzing data about current natural disasters. Your task is to conclude recommendations from the provided JSON article and structure them into the `tds_rec_agent` schema. Carefully follow the instructions and requirements below to ensure accuracy and completeness.
+        # AI CALL
+        outputs = []
+        levels = []
+        with get_openai_callback() as cb:
+            # Max of 6 articles (for token usage limiting)
+            articles = data.get("articles", [])[:6]
+            futures = []
+            for num_articles, article in enumerate(articles):
+                print(f"Reviewing: {num_articles} - {article['title']}")
+                inputs = {
+                    "article_title" : article['title'],
+                    "article_content" : article['content']
+                }
 
-        Use the following format instructions:
-        {format_instructions}
-        ---
+                futures.append(cls.__submit("data", inputs, model, PRIORITY_ARTICLE))
 
-        ### INPUT FORMAT  
-        You will receive an article in JSON format with the following fields:  
+            for article, future in zip(articles, futures):
+                try:
+                    output = future.result()
+                except Exception as e:
+                    print(f"Skipping article {article['title']}: {e}")
+                    continue
 
-        - `twitter_insight` : is a bunch of twitter posts stored in Markdown format : {twitter_insight}
-        - `disaster_type` : the type of disaster you will be performing recommendations on : {disaster_type}
+                levels.append(output.get('danger_level'))
+                if (output['danger_level'] > 4):
+                    outputs.append(output)
+            
+            # OUTPUTS TO DF
+            o_df = pd.DataFrame(outputs)
+            # over every analysed article, not just those kept above, so the cycle scheduler sees quiet days too
+            danger_level = pd.to_numeric(pd.Series(levels, dtype=object), errors='coerce').max()
+            danger_level = 0 if pd.isna(danger_level) else int(danger_level)
+            
+            # Analyze twitter and ensure correlation with Government insight
+            # locally when the raw tweets are available; the LLM only sees what the matcher can't decide
+            gov_data = dummy_government_addys
+            output_twit = []
+            if tweets is not None:
+                matcher = cls.match_locations(dummy_government_addys, tweets)
+                output_twit = matcher.records()
+                gov_data = matcher.ambiguous() if cls.TWITTER_LLM_FALLBACK else []
+
+            if gov_data:
+                inputs_twitter_agent = {
+                    "gov_data" : gov_data,
+                    "twitter_data" : md_twitter
+                }
+                
+                llm_twit = cls.__submit("twitter", inputs_twitter_agent, model, PRIORITY_TWITTER).result()
 
-        ---
+                # Ensure it's always a list of dictionaries
+                if isinstance(llm_twit, dict):
+                    llm_twit = [llm_twit]  # Convert single dictionary to a list
 
-        ### TASK INSTRUCTIONS 
+                # the prompt used to ask for "location_name"; the records carry "location"
+                llm_twit = [
+                    {"location": record.get("location", record.get("location_name")), "status": record.get("status")}
+                    for record in llm_twit
+                ]
 
-        1. **Analyze for Disaster Context**:  
-        Each field in the `OUTPUT FORMAT` must correspond to the type of natural disaster(s) described in the `twitter_insight` content and the given `disaster_type`. Look for:
-        - How the disaster affects mobility, clothing needs, and general survival recommendations.
+                # LLM answers replace the matcher's records for the same locations
+                decided = {record["location"] for record in llm_twit}
+                output_twit = [record for record in output_twit if record["location"] not in decided] + llm_twit
 
-        2. **Field-Specific Extraction Guidance**:
-        - **Vehicle Advice**:  
-            Assess the disaster context and identify the most suitable type of land vehicle for navigation or evacuation (e.g., 4-Wheeler large vehicles for floods, container trucks for large-scale evacuation, small vehicles for tight or debris-filled spaces, or motorbikes for areas with limited road access).  
-            Include only practical suggestions that match the disaster conditions.
+            # Convert list of dictionaries to DataFrame
+            o_twit_df = pd.DataFrame(output_twit)
 
-        - **Clothing Advice**:  
-            Extract clothing recommendations based on the environmental conditions created by the disaster. Examples include:
-            - Warm clothes for cold-weather disasters (e.g., blizzards).
-            - Fireproof clothes for wildfires.
-            - Waterproof clothes for floods or heavy rains.  
-            Prioritize functional and protective clothing relevant to survival in the described disaster.
+            print(cb)
 
-        - **General Advice**:  
-            Provide concise and practical recommendations addressing the unpredictability, speed, or severity of the disaster. For instance:
-            - Alerting users about sudden changes (e.g., rapidly spreading wildfires).
-            - Highlighting life-threatening risks (e.g., flash floods).
-            - Advising on preparedness for specific outcomes (e.g., power outages, supply shortages).  
-            This should be no more than **2 sentences** to maintain clarity and focus.
 
-        ---
+        return (o_df, o_twit_df, danger_level)
 
-        ### OUTPUT FORMAT TEMPLATE  
+    @classmethod
+    def recommend(cls, model, t_insight, d_type):
+        """
+        Prompts the recommendation agent
+        Outputs:
+            output_rec : AI recommendations for disaster
+        """
+        with get_openai_callback() as cb:
+            inputs_rec_agent = {
+                "twitter_insight" : t_insight.to_markdown(),
+                "disaster_type" : d_type
+            }
+            
+            output_rec = cls.__submit("rec", inputs_rec_agent, model, PRIORITY_REC).result()
 
-        {{
-            "vehicle_advice": "Type of land vehicle recommendation according to disaster described (e.g., 4-Wheeler large vehicle, 4-Wheeler container trucks, small vehicles, motorbikes)",
-            "clothing_advice": "General clothing advice according to disaster described (e.g., Warm clothes, Fire-proof clothes, Water-proof clothes)",
-            "general_advice": "General advice for users to take into account regarding the disaster. How unpredictable the disaster is, potential for loss of life, how fast the disaster spreads, etc. *No more than 2 sentences*",
-        }}
+            print(cb)
 
-        ---
+        return output_rec
 
-        By following these instructions, you will accurately extract all necessary information for the `tds_rec_agent` schema and provide high-quality, structured data.
+    @classmethod
+    def match_locations(cls, dummy_government_addys, tweets):
         """
+        Scan new tweets with the location matcher, building it once per set of government locations
+        Outputs:
+            location_matcher holding the sliding-window mention counts
+        """
+        if cls.__matcher is None or cls.__matcher.gov_addresses != list(dummy_government_addys):
+            cls.__matcher = location_matcher(dummy_government_addys)
+        cls.__matcher.scan(tweets)
+        return cls.__matcher
 
-        tmplt_data_agent = """
-        ---
-        You are an advanced information extraction assistant specializing in analyzing articles about natural disasters. Your task is to extract specific data fields from the provided JSON article and structure them into the `tds_data_agent` schema. Carefully follow the instructions and requirements below to ensure accuracy and completeness.
+    @classmethod
+    def gen_polygons(cls, o_df, o_twit_df, dummy_government_addys, output_rec, code):
+        """
+        Generate list of polygons and ai recommendation as geojson and json file
+        Outputs:
+            ai_advice : AI advice in formatted JSON
+            polygons_json : Dangerzones in Polygon formatted GeoJSON
+        """
+        # CREATE .geojson
+        polygons_dict = {
+            "twitter" : [],
+            "gov" : [],
+            "gen" : []
+        }
 
-        Use the following format instructions:
-        {format_instructions}
-        ---
+        polygons_gdf = gpd.GeoDataFrame(columns=['geometry'], geometry='geometry')
 
-        ### INPUT FORMAT  
-        You will receive an article in JSON format with the following fields:
+        for addy in o_df['location']:
+            try:
+                polygon = ox.geocode_to_gdf(addy)
+                polygons_dict['gen'].append(polygon)
+            except:
+                continue
 
-        - `title`: The headline or title of the article : {article_title} 
-        - `content`: The full text content of the article (this is typically large). : {article_content}
+        if code == 0:
+            for addy in o_twit_df['location']:
+                try:
+                    polygon = ox.geocode_to_gdf(addy)
+                    polygons_dict['twitter'].append(polygon)
+                except:
+                    continue
 
-        ---
+            for addy in dummy_government_addys:
+                try:
+                    polygon = ox.geocode_to_gdf(addy)
+                    polygons_dict['gov'].append(polygon)
+                except:
+                    continue
 
-        ### TASK INSTRUCTIONS  
+        # Save the polygon as a GeoJSON file
+            for dct in polygons_dict:
+                if len(polygons_dict[dct]) > 0 and len(polygons_dict[dct]) < cls.MAX_SOURCE_ZONES:
+                    polygons_gdf = gpd.GeoDataFrame(pd.concat(polygons_dict[dct], ignore_index=True))
 
-        Using the provided JSON article, extract the following fields and map them to the `tds_data_agent` schema:
+        if code == 1 and len(polygons_dict['gen']) > 0 and len(polygons_dict['gen']) < cls.MAX_SOURCE_ZONES:
+            polygons_gdf = gpd.GeoDataFrame(pd.concat(polygons_dict['gen'], ignore_index=True))
 
-        #### 1. **Title**  
-        - Use the `title` field from the JSON input directly for the `title` field of `tds_data_agent`.
+        ai_advice = json.dumps(output_rec, indent=4)
 
-        #### 2. **Location**  
-        - Identify the **specific address or precise location** where the disaster is occurring. Ensure the output provides a complete and unambiguous location.
-        - Format the location as:  
-            ```
-            "[Street Address or Landmark (if applicable)], [Specific Area or Suburb], [City], [State/Territory], [Country]"
-            ```
-        - Avoid vague descriptions such as "Mid West, Western Australia, Australia" unless absolutely no further details are available.
-        - Use information in the `content` to derive the most specific location possible. If the article provides ambiguous or conflicting locations, choose the one most prominently associated with the disaster.
-        - Return the location as a **string** in the `location` field.  
-        - Identify the main address or region of a disaster. Ensure to identify a specific region.
-        - output must be in the format: "[Specific Address (if applicable)], [Area], [City], [State], [Country]"
-        - Return the identified locations as a **string** in the `location` field.  
-        - ***Useful tip:*** All regions are in Country = Australia
+        return (ai_advice, polygons_gdf)
 
-        #### 3. **Disaster Type**  
-        - Determine the type of natural disaster being discussed in the article based on the `content`.  
-        - Common examples include:  
+    @classmethod
+    def predict(cls, model, t_insight, g_insight, d_type):
+        # current AEST date-time now
+        aest = pytz.timezone("Australia/Sydney")
+        current_aest_time = datetime.now(aest)
+
+        print(f"Predicting future {d_type} polygons. . .")
+        with get_openai_callback() as cb:
+            # Analyze twitter and ensure correlation with Government insight
+            inputs_prediction_agent = {
+                "twitter_insight" : t_insight.to_markdown(),
+                "gov_insight" : g_insight,
+                "datetime" : current_aest_time,
+                "disaster_type" : d_type
+            }
+            
+            output_prediction = cls.__submit("prediction", inputs_prediction_agent, model, PRIORITY_PREDICTION).result()
+
+            # Ensure it's always a list of dictionaries
+            if isinstance(output_prediction, dict):
+                output_prediction = [output_prediction]  # Convert single dictionary to a list
+
+            # Convert list of dictionaries to DataFrame
+            o_pred_df = pd.DataFrame(output_prediction)
+
+            print(cb)
+
+        return o_pred_df
+
+    @classmethod
+    def reduce(cls, polygons_, max_coords):
+        """
+        Simplify every zone's exterior rings
+        Outputs:
+            polygon_snapshot of the reduced zones (or "No Danger detected." if there are none)
+        """
+        if polygons_.empty:
+            return "No Danger detected."
+
+        # each Polygon/MultiPolygon part's exterior, simplified and capped at max_coords
+        coords, ring_offsets, zone_offsets = cls.__geometry.reduce(
+            numpy.asarray(polygons_.geometry.values, dtype=object), SIMPLIFY_TOLERANCE, max_coords
+        )
+
+        attributes = {}
+        if "display_name" in polygons_.columns:
+            attributes["name"] = polygons_["display_name"].astype(str).tolist()
+
+        return polygon_snapshot(coords, ring_offsets, zone_offsets, attributes)
+
+    @classmethod
+    def shutdown_geometry(cls):
+        cls.__geometry.shutdown()
+
+    @classmethod
+    def __del__(self):
+        """
+        Cleanup method called when an instance is deleted
+        """
+
+        # Reset shared resources
+        self.polygons.clear()
+        self.ai_rec.clear()
+        
+        # Explicitly delete model (if necessary)
+        if hasattr(self, "__model"):
+            del self.__model
+
+# TEMPLATE CLASSES
+class tds_data_agent(BaseModel):
+    title : str = Field(description="")
+    location : str = Field(description="")
+    disaster_type : str = Field(description="")
+    emergency_no : str = Field(description="")
+    url : str = Field(description="")
+    danger_level : str = Field(description="")
+    summary : str = Field(description="")
+
+class tds_twit_agent(BaseModel):
+    location : str = Field(description="")
+    status : str = Field(description="")
+
+class tds_rec_agent(BaseModel):
+    vehicle_advice : str = Field(description="")
+    clothing_advice : str = Field(description="")
+    general_advice : str = Field(description="")
+
+class tds_prediction_agent(BaseModel):
+    location : str = Field(description="")
+    predicted_time : str = Field(description="")
+    time_of_impact : str = Field(description="")
+
+# AGENT TEMPLATES (compiled once by updated_data.compile_agents)
+tmplt_data_agent = """
+        ---
+        You are an advanced information extraction assistant specializing in analyzing articles about natural disasters. Your task is to extract specific data fields from the provided JSON article and structure them into the `tds_data_agent` schema. Carefully follow the instructions and requirements below to ensure accuracy and completeness.
+
+        Use the following format instructions:
+        {format_instructions}
+        ---
+
+        ### INPUT FORMAT  
+        You will receive an article in JSON format with the following fields:
+
+        - `title`: The headline or title of the article : {article_title} 
+        - `content`: The full text content of the article (this is typically large). : {article_content}
+
+        ---
+
+        ### TASK INSTRUCTIONS  
+
+        Using the provided JSON article, extract the following fields and map them to the `tds_data_agent` schema:
+
+        #### 1. **Title**  
+        - Use the `title` field from the JSON input directly for the `title` field of `tds_data_agent`.
+
+        #### 2. **Location**  
+        - Identify the **specific address or precise location** where the disaster is occurring. Ensure the output provides a complete and unambiguous location.
+        - Format the location as:  
+            ```
+            "[Street Address or Landmark (if applicable)], [Specific Area or Suburb], [City], [State/Territory], [Country]"
+            ```
+        - Avoid vague descriptions such as "Mid West, Western Australia, Australia" unless absolutely no further details are available.
+        - Use information in the `content` to derive the most specific location possible. If the article provides ambiguous or conflicting locations, choose the one most prominently associated with the disaster.
+        - Return the location as a **string** in the `location` field.  
+        - Identify the main address or region of a disaster. Ensure to identify a specific region.
+        - output must be in the format: "[Specific Address (if applicable)], [Area], [City], [State], [Country]"
+        - Return the identified locations as a **string** in the `location` field.  
+        - ***Useful tip:*** All regions are in Country = Australia
+
+        #### 3. **Disaster Type**  
+        - Determine the type of natural disaster being discussed in the article based on the `content`.  
+        - Common examples include:  
             - Flood  
             - Earthquake  
             - Hurricane  
@@ -452,7 +1058,7 @@ class updated_data():
         By following these instructions, you will accurately extract all necessary information for the `tds_rec_agent` schema and provide high-quality, structured data.
         """
 
-        tmplt_twit_agent = """
+tmplt_twit_agent = """
         ---
         You are an advanced information extraction assistant specializing in analyzing Twitter data to detect discussions about natural disasters in specific government-monitored locations. Your task is to analyze tweets and determine if any locations in the provided `gov_data` are dangerous. The extracted information must be structured into the `tds_twit_agent` schema. Follow the instructions carefully to ensure accurate results.
 
@@ -492,136 +1098,69 @@ class updated_data():
         - Provide a structured output for each location in `gov_data` with the following fields:  
         ```
         {{
-            "location_name": "<Location name from gov_data>",
+            "location": "<Location name from gov_data>",
             "status": "<'dangerous' or 'not dangerous'>"
         }}
         ```
         """
 
-        # AI CALL
-        num_articles = 0
-        outputs = []
-        with get_openai_callback() as cb:
-            for article in data.get("articles", []):
-                print(f"Reviewing: {num_articles} - {article['title']}")
-                prompt = PromptTemplate(
-                    template=tmplt_data_agent,
-                    input_variables=[],
-                    partial_variables={
-                        "format_instructions" : parser_data_agent.get_format_instructions(),
-                        "article_title" : article['title'],
-                        "article_content" : article['content']
-                    }
-                )
-
-                chain = prompt | model | parser_data_agent
-                output = chain.invoke({})
-
-                if (output['danger_level'] > 4):
-                    outputs.append(output)
-                num_articles += 1
-
-                # Max of 5 articles (for token usage limiting)
-                if num_articles > 5:
-                    break
-            
-            # OUTPUTS TO DF
-            o_df = pd.DataFrame(outputs)
-            
-            # Analyze twitter and ensure correlation with Government insight
-            prompt_twitter_agent = PromptTemplate(
-                template=tmplt_twit_agent,
-                input_variables=[],
-                partial_variables={
-                    "format_instructions" : parser_twit_agent.get_format_instructions(),
-                    "gov_data" : dummy_government_addys,
-                    "twitter_data" : md_twitter
-                }
-            )
-            
-            chain_twit_agent = prompt_twitter_agent | model | parser_twit_agent
-            output_twit = chain_twit_agent.invoke({})
-
-            # Ensure it's always a list of dictionaries
-            if isinstance(output_twit, dict):
-                output_twit = [output_twit]  # Convert single dictionary to a list
+tmplt_rec_agent = """
+        ---
+        You are an advanced meteoriligist consultant analyzing data about current natural disasters. Your task is to conclude recommendations from the provided JSON article and structure them into the `tds_rec_agent` schema. Carefully follow the instructions and requirements below to ensure accuracy and completeness.
 
-            # Convert list of dictionaries to DataFrame
-            o_twit_df = pd.DataFrame(output_twit)
+        Use the following format instructions:
+        {format_instructions}
+        ---
 
-            prompt_rec_agent = PromptTemplate(
-                    template=tmplt_rec_agent,
-                    input_variables=[],
-                    partial_variables={
-                        "format_instructions" : parser_rec_agent.get_format_instructions(),
-                        "twitter_insight" : o_twit_df.to_markdown(),
-                        "disaster_type" : o_df['disaster_type'][0]
-                    }
-                )
-            
-            chain_rec_agent = prompt_rec_agent | model | parser_rec_agent
-            output_rec = chain_rec_agent.invoke({})
+        ### INPUT FORMAT  
+        You will receive an article in JSON format with the following fields:  
 
-            print(cb)
+        - `twitter_insight` : is a bunch of twitter posts stored in Markdown format : {twitter_insight}
+        - `disaster_type` : the type of disaster you will be performing recommendations on : {disaster_type}
 
+        ---
 
-        return (o_df, o_twit_df, output_rec)
+        ### TASK INSTRUCTIONS 
 
-    @classmethod
-    def gen_polygons(cls, o_df, o_twit_df, dummy_government_addys, output_rec, code):
-        """
-        Generate list of polygons and ai recommendation as geojson and json file
-        Outputs:
-            ai_advice : AI advice in formatted JSON
-            polygons_json : Dangerzones in Polygon formatted GeoJSON
-        """
-        # CREATE .geojson
-        polygons_dict = {
-            "twitter" : [],
-            "gov" : [],
-            "gen" : []
-        }
+        1. **Analyze for Disaster Context**:  
+        Each field in the `OUTPUT FORMAT` must correspond to the type of natural disaster(s) described in the `twitter_insight` content and the given `disaster_type`. Look for:
+        - How the disaster affects mobility, clothing needs, and general survival recommendations.
 
-        polygons_gdf = gpd.GeoDataFrame(columns=['geometry'], geometry='geometry')
+        2. **Field-Specific Extraction Guidance**:
+        - **Vehicle Advice**:  
+            Assess the disaster context and identify the most suitable type of land vehicle for navigation or evacuation (e.g., 4-Wheeler large vehicles for floods, container trucks for large-scale evacuation, small vehicles for tight or debris-filled spaces, or motorbikes for areas with limited road access).  
+            Include only practical suggestions that match the disaster conditions.
 
-        for addy in o_df['location']:
-            try:
-                polygon = ox.geocode_to_gdf(addy)
-                polygons_dict['gen'].append(polygon)
-            except:
-                continue
+        - **Clothing Advice**:  
+            Extract clothing recommendations based on the environmental conditions created by the disaster. Examples include:
+            - Warm clothes for cold-weather disasters (e.g., blizzards).
+            - Fireproof clothes for wildfires.
+            - Waterproof clothes for floods or heavy rains.  
+            Prioritize functional and protective clothing relevant to survival in the described disaster.
 
-        if code == 0:
-            for addy in o_twit_df['location']:
-                try:
-                    polygon = ox.geocode_to_gdf(addy)
-                    polygons_dict['twitter'].append(polygon)
-                except:
-                    continue
+        - **General Advice**:  
+            Provide concise and practical recommendations addressing the unpredictability, speed, or severity of the disaster. For instance:
+            - Alerting users about sudden changes (e.g., rapidly spreading wildfires).
+            - Highlighting life-threatening risks (e.g., flash floods).
+            - Advising on preparedness for specific outcomes (e.g., power outages, supply shortages).  
+            This should be no more than **2 sentences** to maintain clarity and focus.
 
-            for addy in dummy_government_addys:
-                try:
-                    polygon = ox.geocode_to_gdf(addy)
-                    polygons_dict['gov'].append(polygon)
-                except:
-                    continue
+        ---
 
-        # Save the polygon as a GeoJSON file
-            for dct in polygons_dict:
-                if len(polygons_dict[dct]) > 0 and len(polygons_dict[dct]) < 40:
-                    polygons_gdf = gpd.GeoDataFrame(pd.concat(polygons_dict[dct], ignore_index=True))
+        ### OUTPUT FORMAT TEMPLATE  
 
-        if code == 1 and len(polygons_dict['gen']) > 0 and len(polygons_dict['gen']) < 40:
-            polygons_gdf = gpd.GeoDataFrame(pd.concat(polygons_dict['gen'], ignore_index=True))
+        {{
+            "vehicle_advice": "Type of land vehicle recommendation according to disaster described (e.g., 4-Wheeler large vehicle, 4-Wheeler container trucks, small vehicles, motorbikes)",
+            "clothing_advice": "General clothing advice according to disaster described (e.g., Warm clothes, Fire-proof clothes, Water-proof clothes)",
+            "general_advice": "General advice for users to take into account regarding the disaster. How unpredictable the disaster is, potential for loss of life, how fast the disaster spreads, etc. *No more than 2 sentences*",
+        }}
 
-        ai_advice = json.dumps(output_rec, indent=4)
+        ---
 
-        return (ai_advice, polygons_gdf)
+        By following these instructions, you will accurately extract all necessary information for the `tds_rec_agent` schema and provide high-quality, structured data.
+        """
 
-    @classmethod
-    def predict(cls, model, t_insight, g_insight, d_type):
-        parser_prediction_agent = JsonOutputParser(pydantic_object=tds_prediction_agent)
-        tmplt_prediction_agent = """
+tmplt_prediction_agent = """
         ---
 
         You are an advanced information extraction assistant specializing in analyzing articles about natural disasters. Your task is to extract specific data fields from the provided JSON article and structure them into the `tds_data_agent` schema. Carefully follow the instructions and requirements below to ensure accuracy and completeness.
@@ -687,151 +1226,6 @@ class updated_data():
         By following these instructions, you will accurately extract all necessary information for the `tds_predicted_agent` schema and provide high-quality, structured data.
         """
 
-        # current AEST date-time now
-        aest = pytz.timezone("Australia/Sydney")
-        current_aest_time = datetime.now(aest)
-
-        print(f"Predicting future {d_type} polygons. . .")
-        with get_openai_callback() as cb:
-            # Analyze twitter and ensure correlation with Government insight
-            prompt_prediction_agent = PromptTemplate(
-                template=tmplt_prediction_agent,
-                input_variables=[],
-                partial_variables={
-                    "format_instructions" : parser_prediction_agent.get_format_instructions(),
-                    "twitter_insight" : t_insight.to_markdown(),
-                    "gov_insight" : g_insight,
-                    "datetime" : current_aest_time,
-                    "disaster_type" : d_type
-                }
-            )
-            
-            chain_prediction_agent = prompt_prediction_agent | model | parser_prediction_agent
-            output_prediction = chain_prediction_agent.invoke({})
-
-            # Ensure it's always a list of dictionaries
-            if isinstance(output_prediction, dict):
-                output_prediction = [output_prediction]  # Convert single dictionary to a list
-
-            # Convert list of dictionaries to DataFrame
-            o_pred_df = pd.DataFrame(output_prediction)
-
-            print(cb)
-
-        return o_pred_df
-
-    @classmethod
-    def reduce(cls, polygons_, max_coords):
-        ply_formatted = []
-
-        if polygons_.empty:
-            return "No Danger detected."
-
-        # Iterate over each row in the GeoDataFrame
-        for _, feature in polygons_.iterrows():
-            polygons_unf = []  # Reset for each feature
-
-            # Check if the geometry is a MultiPolygon or a Polygon
-            geometry = feature["geometry"]
-            
-            if geometry.geom_type == "MultiPolygon":
-                # Handle MultiPolygon geometry (multiple polygons in one feature)
-                for multipolygon in geometry.geoms:  # Use .geoms to get individual polygons
-                    # Each multipolygon is a Polygon object
-                    if multipolygon.geom_type == "Polygon":
-                        # Access the coordinates of the polygon (exterior)
-                        polygons_unf.append(list(multipolygon.exterior.coords))
-            elif geometry.geom_type == "Polygon":
-                # Handle simple Polygon geometry
-                polygons_unf.append(list(geometry.exterior.coords))
-
-            # Append the processed polygons to the result list
-            ply_formatted.append(cls.douglas_peucker(polygons_unf, max_coords))
-
-        return ply_formatted
-
-    @classmethod
-    def douglas_peucker(cls, coords, max_points):
-        """
-        Simplifies polygons and enforces a maximum number of coordinates per polygon.
-        
-        Args:
-            coords (list): List of polygons, where each polygon is a list of [longitude, latitude] points.
-            max_points (int): Maximum number of coordinates allowed per polygon.
-        
-        Returns:
-            list: List of simplified polygon coordinates.
-        """
-        tolerance = 0.006  # This value can be adjusted based on your requirements
-        simplified_polygons = []
-
-        # Iterate over each polygon in the coords list
-        for poly in coords:
-            # Ensure the poly is not an empty list or a list containing empty lists
-            if not poly:
-                print("Skipping invalid or empty polygon.")
-                continue  # Skip invalid polygons
-
-            # Convert the polygon (list of [longitude, latitude]) to a Shapely Polygon
-            polygon = Polygon(poly)
-            # Convert the polygon (list of [longitude, latitude]) to a Shapely Polygon
-
-            # Step 1: Simplify the polygon using the specified tolerance
-            simplified_polygon = polygon.simplify(tolerance)
-
-            # Step 2: Get simplified coordinates
-            simplified_coords = list(simplified_polygon.exterior.coords)
-
-            # Step 3: If the simplified polygon exceeds max_points, downsample the coordinates
-            if len(simplified_coords) > max_points:
-                step = len(simplified_coords) // max_points  # Evenly space the points
-                reduced_coords = simplified_coords[::step][:max_points]  # Keep only max_points
-            else:
-                reduced_coords = simplified_coords  # Keep the simplified polygon as is
-
-            # Add the reduced polygon to the result list
-            simplified_polygons.append(reduced_coords)
-
-        return simplified_polygons
-
-    @classmethod
-    def __del__(self):
-        """
-        Cleanup method called when an instance is deleted
-        """
-
-        # Reset shared resources
-        self.polygons.clear()
-        self.ai_rec.clear()
-        
-        # Explicitly delete model (if necessary)
-        if hasattr(self, "__model"):
-            del self.__model
-
-# TEMPLATE CLASSES
-class tds_data_agent(BaseModel):
-    title : str = Field(description="")
-    location : str = Field(description="")
-    disaster_type : str = Field(description="")
-    emergency_no : str = Field(description="")
-    url : str = Field(description="")
-    danger_level : str = Field(description="")
-    summary : str = Field(description="")
-
-class tds_twit_agent(BaseModel):
-    location : str = Field(description="")
-    status : str = Field(description="")
-
-class tds_rec_agent(BaseModel):
-    vehicle_advice : str = Field(description="")
-    clothing_advice : str = Field(description="")
-    general_advice : str = Field(description="")
-
-class tds_prediction_agent(BaseModel):
-    location : str = Field(description="")
-    predicted_time : str = Field(description="")
-    time_of_impact : str = Field(description="")
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
@@ -839,8 +1233,18 @@ async def lifespan(app: FastAPI):
     """
     global zones
     zones = updated_data()
+    zones.set_store(snapshot_store())
+    zones.compile_agents()
+    # warm restart: serve the last snapshot (flagged stale) until a new cycle publishes
+    if zones.get_snapshot() is not None:
+        print("\n>>>\tloaded last snapshot from store.")
+    # building the road graph the first time can take minutes, so don't hold up startup
+    threading.Thread(target=zones.load_router, daemon=True).start()
     yield
-    zones.stop_serverside()
+    if zones.running:
+        zones.stop_serverside()
+    zones.shutdown_geometry()
+    zones.store.close()
 
 # uvicorn first_responders_serverside_backend:app --reload
 app = FastAPI(lifespan=lifespan)
@@ -849,27 +1253,55 @@ app.add_middleware(
     CORSMiddleware
 )
 
+def snapshot_response(section, stale=False, format="json"):
+    """
+    Serve one section of the latest snapshot as stored, with its own freshness timestamp.
+    Sections left over from a previous run are flagged stale.
+    Polygon sections can also be served as `polygon_snapshot` binary (format="bin", or "bin32" for int32 coordinates)
+    or as a GeoJSON FeatureCollection (format="geojson").
+    """
+    snapshot = zones.get_snapshot()
+    headers = {
+        "X-Snapshot-Published-At": datetime.fromtimestamp(snapshot[f"{section}_at"], pytz.utc).isoformat(),
+        "X-Snapshot-Stale": "true" if stale else "false",
+    }
+    if format == "bin":
+        # stored already encoded
+        return Response(content=snapshot[f"{section}_bin"] or polygon_snapshot.from_rings([]).to_binary(), media_type="application/octet-stream", headers=headers)
+    if format == "bin32":
+        return Response(content=zones.get_polygon_snapshot(section).to_binary(quantize=True), media_type="application/octet-stream", headers=headers)
+    if format == "geojson":
+        # encoded once per published section; the polygon_snapshot view is cached until the next publish
+        return Response(content=zones.get_polygon_snapshot(section).to_geojson(), media_type="application/geo+json", headers=headers)
+    return Response(content=snapshot[section], media_type="application/json", headers=headers)
+
 @app.post("/predictions")
-async def getPolygons():
+async def getPolygons(format: str = "json"):
     """
     Returns a JSON of predicted polygons as dangerzones based on a given identified disaster.
+    ?format=bin or ?format=bin32 returns the columnar binary encoding instead, ?format=geojson a FeatureCollection.
     """
-    if (zones.get_running() & zones.get_active()):
-        return JSONResponse(content=zones.get_predictions())
-    elif (zones.get_running() & (not zones.get_active())):
+    if (zones.get_running() & zones.get_active("predictions")):
+        return snapshot_response("predictions", format=format)
+    elif zones.get_available("predictions"):
+        return snapshot_response("predictions", stale=True, format=format)
+    elif (zones.get_running() & (not zones.get_active("predictions"))):
         return JSONResponse(content={"message": "Please wait: Serverside running. . ."})
     else:
         return JSONResponse(content={"message": "Please run: start_serverside()"})
 
 
 @app.post("/dangerzones")
-async def getPolygons():
+async def getPolygons(format: str = "json"):
     """
     Returns a JSON of polygons as dangerzones based on a given identified disaster.
+    ?format=bin or ?format=bin32 returns the columnar binary encoding instead, ?format=geojson a FeatureCollection.
     """
-    if (zones.get_running() & zones.get_active()):
-        return JSONResponse(content=zones.get_polygons())
-    elif (zones.get_running() & (not zones.get_active())):
+    if (zones.get_running() & zones.get_active("polygons")):
+        return snapshot_response("polygons", format=format)
+    elif zones.get_available("polygons"):
+        return snapshot_response("polygons", stale=True, format=format)
+    elif (zones.get_running() & (not zones.get_active("polygons"))):
         return JSONResponse(content={"message": "Please wait: Serverside running. . ."})
     else:
         return JSONResponse(content={"message": "Please run: start_serverside()"})
@@ -879,9 +1311,11 @@ async def getAIAdvice():
     """
     Returns a JSON of AI Recommendations based on a given identified disaster.
     """
-    if (zones.get_running() & zones.get_active()):
-        return JSONResponse(content=zones.get_ai_rec())
-    elif (zones.get_running() & (not zones.get_active())):
+    if (zones.get_running() & zones.get_active("ai_rec")):
+        return snapshot_response("ai_rec")
+    elif zones.get_available("ai_rec"):
+        return snapshot_response("ai_rec", stale=True)
+    elif (zones.get_running() & (not zones.get_active("ai_rec"))):
         return JSONResponse(content={"message": "Please wait: Serverside running. . ."})
     else:
         return JSONResponse(content={"message": "Please run: start_serverside()"})
@@ -892,7 +1326,7 @@ async def start_serverside(background_tasks: BackgroundTasks):
     Start the serverside processing in the background on request.
     This is triggered by a POST request.
     """
-    if zones.get_running():
+    if zones.get_running() or not zones.claim_leader():
         return JSONResponse(content={"message": "Serverside already running."})
 
     background_tasks.add_task(zones.start_serverside)
@@ -908,3 +1342,169 @@ async def stop_serverside():
         return JSONResponse(content={"message": "Serverside stopped successfully."})
 
     return JSONResponse(content={"message": "Serverside is not running."})
+
+@app.get("/tiles/{layer}/{z}/{x}/{y}")
+async def tiles(layer: str, z: int, x: int, y: int):
+    """
+    Returns the dangerzones or predictions intersecting web-mercator tile z/x/y, in the
+    polygon_snapshot binary layout with int32 tile pixel coordinates (extent 4096).
+    """
+    section = {"dangerzones": "polygons", "predictions": "predictions"}.get(layer)
+    if section is None:
+        return JSONResponse(content={"message": "Unknown layer, use dangerzones or predictions."}, status_code=404)
+    if not zones.get_available(section):
+        return JSONResponse(content={"message": "Please wait: Serverside running. . ."}, status_code=404)
+    return Response(content=zones.get_polygon_snapshot(section).to_tile(z, x, y), media_type="application/octet-stream")
+
+@app.post("/status")
+async def status():
+    """
+    Returns whether the serverside is running, whether its outputs are available and if the served snapshot is stale,
+    with the freshness of each section.
+    """
+    snapshot = zones.get_snapshot()
+
+    def iso(ts):
+        return None if ts is None else datetime.fromtimestamp(ts, pytz.utc).isoformat()
+
+    return JSONResponse(content={
+        "running": zones.get_running(),
+        "active": zones.get_active(),
+        "stale": zones.get_stale(),
+        "published_at": None if snapshot is None else iso(snapshot["published_at"]),
+        "sections": {
+            section: {
+                "published_at": None if snapshot is None else iso(snapshot[f"{section}_at"]),
+                "stale": zones.get_stale(section)
+            }
+            for section in ("polygons", "predictions", "ai_rec")
+        }
+    })
+
+@app.post("/llm_stats")
+async def llm_stats():
+    """
+    Returns per-agent LLM latency histograms and hedging spend for this worker.
+    """
+    return JSONResponse(content=zones.get_llm_stats())
+
+@app.post("/agents")
+async def agents():
+    """
+    Returns each agent's prompt version and hash. Prompts are swapped at runtime by writing
+    `<agent>.txt` into AGENT_PROMPT_DIR (and restored by deleting it).
+    """
+    return JSONResponse(content=zones.agents.versions())
+
+@app.get("/history")
+async def history(
+    at: datetime | None = None,
+    from_: datetime | None = Query(None, alias="from"),
+    to: datetime | None = None
+):
+    """
+    Returns past snapshots for after-action review.
+        ?at=      : the snapshot that was being served at that time
+        ?from=&to= : every snapshot published in that range (oldest first), streamed
+                     from the store as they are read
+    Times are ISO 8601; naive times are read as UTC.
+    """
+    def ts(value):
+        return (value if value.tzinfo else pytz.utc.localize(value)).timestamp()
+
+    if at is not None:
+        snapshot = zones.store.at(ts(at))
+        if snapshot is None:
+            return JSONResponse(content={"message": "No snapshot at that time."}, status_code=404)
+        return Response(content=snapshot_json(snapshot), media_type="application/json")
+
+    if from_ is None and to is None:
+        return JSONResponse(content={"message": "Please give ?at= or ?from=&to="}, status_code=400)
+
+    start = ts(from_) if from_ is not None else 0
+    end = ts(to) if to is not None else time.time()
+    def stream():
+        yield b"["
+        for i_, s_ in enumerate(zones.store.between(start, end)):
+            yield (b"," if i_ else b"") + snapshot_json(s_)
+        yield b"]"
+
+    # a plain generator, so starlette reads the store on the threadpool
+    return StreamingResponse(stream(), media_type="application/json")
+
+@app.get("/route")
+# a plain def so searches run on the threadpool instead of blocking the event loop
+def route(from_: str = Query(..., alias="from"), to: str = Query(...)):
+    """
+    Returns the shortest drivable route between two "lon,lat" points as a GeoJSON LineString feature,
+    avoiding the current dangerzones and predictions where any other road exists.
+        ?from=144.96,-37.81&to=145.10,-37.90
+    """
+    try:
+        from_lon, from_lat = (float(v_) for v_ in from_.split(","))
+        to_lon, to_lat = (float(v_) for v_ in to.split(","))
+    except ValueError:
+        return JSONResponse(content={"message": "Please give ?from=lon,lat&to=lon,lat"}, status_code=400)
+
+    router = zones.get_router()
+    if router is None:
+        return JSONResponse(content={"message": "Please wait: road graph loading. . ."}, status_code=503)
+
+    try:
+        found = router.route(from_lon, from_lat, to_lon, to_lat)
+    except route_too_long:
+        return JSONResponse(content={"message": "Route too long to search; please split it into shorter legs."}, status_code=422)
+    if found is None:
+        return JSONResponse(content={"message": "No route found between those points."}, status_code=404)
+    return JSONResponse(content={
+        "type": "Feature",
+        "geometry": {"type": "LineString", "coordinates": found["coordinates"]},
+        "properties": {"distance": found["distance"], "crosses_danger": found["crosses_danger"]}
+    })
+
+@app.post("/subscribe")
+async def subscribe(
+    id: str = Body(...),
+    geometry: dict = Body(...),
+    radius: float = Body(ALERT_RADIUS)
+):
+    """
+    Register a GeoJSON Point or Polygon for alerts when a dangerzone or prediction contains it or comes within
+    `radius` metres. Re-registering an id replaces it. Returns the subscription's current alerts; /alerts
+    then only reports changes from them.
+        {"id": "unit-12", "geometry": {"type": "Point", "coordinates": [144.96, -37.81]}, "radius": 5000}
+    """
+    kind, coords = geometry.get("type"), geometry.get("coordinates")
+    try:
+        if kind == "Point":
+            row = (id, float(coords[0]), float(coords[1]), None, radius, "{}")
+        elif kind == "Polygon":
+            row = (id, None, None, json.dumps(geometry), radius, "{}")
+            geom.shape(geometry)
+        else:
+            raise ValueError(kind)
+        current = zones.check_geofence(row)
+    except Exception:
+        return JSONResponse(content={"message": "Please give a GeoJSON Point or Polygon geometry."}, status_code=400)
+
+    # the leader starts this subscription from what it was just told, so it only alerts on changes
+    state = json.dumps({alert["section"]: [alert["status"], alert["zone"]] for alert in current})
+    zones.store.subscribe(id, radius, state, lon=row[1], lat=row[2], area=row[3])
+    return JSONResponse(content={"message": "Subscribed.", "alerts": current})
+
+@app.post("/unsubscribe")
+async def unsubscribe(id: str = Body(..., embed=True)):
+    """
+    Remove a subscription.
+    """
+    if zones.store.unsubscribe(id):
+        return JSONResponse(content={"message": "Unsubscribed."})
+    return JSONResponse(content={"message": "No such subscription."}, status_code=404)
+
+@app.get("/alerts")
+async def alerts(subscription: str | None = None, since: int = 0):
+    """
+    Returns the alerts logged after sequence number `since` (for one subscription, or all), oldest first.
+    Each alert's status is inside, near or clear; poll again with since= the last alert's seq.
+    """
+    return JSONResponse(content=zones.store.alerts(subscription, since))
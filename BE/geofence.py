@@ -0,0 +1,224 @@
+"""
+Batched proximity alerts for registered points and areas.
+
+Subscriptions are held as one array of shapely geometries projected to metres. Each
+time a danger or prediction section is published, every subscription is joined against
+that section's zones in a single STRtree pass: which zone (if any) contains or overlaps
+it, otherwise how far the nearest zone edge is. Only subscriptions whose status or zone
+changed since that section's last evaluation produce an alert. A subscription starts from
+the state it was told about when it subscribed, so its first alert is a real change. The
+last alert logged per subscription and section can be restored, so a new leader carries
+on where the last stopped.
+
+    python geofence.py [subscriptions] [zones]   # time per publish, 100k subscriptions by default
+"""
+
+import os
+import math
+import json
+import numpy
+import shapely
+import shapely.geometry
+
+ALERT_RADIUS = float(os.getenv("ALERT_RADIUS", "5000"))
+# metres per degree of latitude
+METRES_PER_DEGREE = 111195.0
+
+CLEAR, NEAR, INSIDE = 0, 1, 2
+STATUS = ("clear", "near", "inside")
+
+
+class geofence_engine():
+    def __init__(self, subscriptions=()):
+        """
+        Args:
+            subscriptions : iterable of (id, lon, lat, area, radius, state) rows; `area` is a GeoJSON
+                            polygon string used instead of lon/lat when set, and `state` the JSON
+                            {section: [status, zone]} the subscriber was last told (sections missing are clear)
+        """
+        self.ids = []
+        self.radius = numpy.empty(0)
+        self.geometries = numpy.empty(0, dtype=object)
+        self.origin = (0.0, 0.0)
+        self.scale = numpy.array([METRES_PER_DEGREE, METRES_PER_DEGREE])
+        # section -> (status, zone label) arrays aligned with self.ids
+        self.__state = {}
+        self.__rows = []
+        # per subscription: the state it subscribed with
+        self.__seeds = []
+        self.load(subscriptions)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def load(self, subscriptions):
+        """
+        Replace the subscriptions, keeping the alert state of those that remain unchanged
+        """
+        rows = list(subscriptions)
+        ids = [row[0] for row in rows]
+        lonlat = numpy.array([(row[1], row[2]) for row in rows], dtype=numpy.float64).reshape(-1, 2)
+        areas = [i for i, row in enumerate(rows) if row[3]]
+
+        geometries = numpy.empty(len(rows), dtype=object)
+        point_rows = numpy.setdiff1d(numpy.arange(len(rows)), areas)
+        geometries[point_rows] = shapely.points(lonlat[point_rows])
+        for i in areas:
+            geometries[i] = shapely.geometry.shape(json.loads(rows[i][3]))
+
+        # one equirectangular projection about the subscriptions' centre; fine at state scale
+        if len(rows):
+            west, south, east, north = shapely.total_bounds(geometries)
+            self.origin = ((west + east) / 2, (south + north) / 2)
+        self.scale = numpy.array([METRES_PER_DEGREE * math.cos(math.radians(self.origin[1])), METRES_PER_DEGREE])
+
+        previous = {row: i for i, row in enumerate(self.__rows)}
+        keep = numpy.array([previous.get(row, -1) for row in rows], dtype=numpy.int64)
+        found = keep >= 0
+        seeds = [json.loads(row[5]) for row in rows]
+        for section, (status, zone) in self.__state.items():
+            new_status, new_zone = self.__initial(section, seeds)
+            new_status[found], new_zone[found] = status[keep[found]], zone[keep[found]]
+            self.__state[section] = (new_status, new_zone)
+
+        self.ids = ids
+        self.__rows = rows
+        self.__seeds = seeds
+        self.radius = numpy.array([row[4] for row in rows], dtype=numpy.float64)
+        self.geometries = self.project(geometries)
+
+    def restore(self, alerts):
+        """
+        Take each subscription's state from its latest logged alerts ({"subscription", "section", "status", "zone"});
+        subscriptions without one keep the state they subscribed with
+        """
+        index = {id: i for i, id in enumerate(self.ids)}
+        for section in {alert["section"] for alert in alerts}:
+            self.__state[section] = self.__initial(section, self.__seeds)
+        for alert in alerts:
+            i = index.get(alert["subscription"])
+            if i is not None:
+                status, zone = self.__state[alert["section"]]
+                status[i], zone[i] = STATUS.index(alert["status"]), alert["zone"]
+
+    @staticmethod
+    def __initial(section, seeds):
+        """
+        Outputs:
+            (status, zone label) arrays for `section`: each subscription's seed state (clear if
+            its seed leaves the section out)
+        """
+        status = numpy.full(len(seeds), CLEAR, dtype=numpy.int8)
+        zone = numpy.full(len(seeds), None, dtype=object)
+        for i, seed in enumerate(seeds):
+            if section in seed:
+                status[i], zone[i] = STATUS.index(seed[section][0]), seed[section][1]
+        return status, zone
+
+    def project(self, geometries):
+        """
+        Outputs:
+            geometries in metres east/north of self.origin
+        """
+        origin, scale = numpy.array(self.origin), self.scale
+        return shapely.transform(geometries, lambda coords: (coords - origin) * scale)
+
+    def evaluate(self, section, snapshot):
+        """
+        Join every subscription against the zones of a newly published section
+        Args:
+            section : "polygons" or "predictions"
+            snapshot : polygon_snapshot of that section
+        Outputs:
+            list of {"subscription", "section", "status", "zone", "distance"} alerts for the
+            subscriptions whose status or zone changed (since the last evaluation, or the state they
+            subscribed with); `distance` is metres to the nearest zone edge (inside or out), None once clear
+        """
+        n = len(self.ids)
+        status = numpy.full(n, CLEAR, dtype=numpy.int8)
+        zone = numpy.full(n, -1, dtype=numpy.int64)
+        distance = numpy.full(n, numpy.nan)
+
+        polygons, polygon_zone = snapshot.to_shapely()
+        if n and len(polygons):
+            polygons = self.project(polygons)
+            edges = shapely.boundary(polygons)
+            tree = shapely.STRtree(polygons)
+
+            # containment (areas: any overlap)
+            sub, poly = tree.query(self.geometries, predicate="intersects")
+            sub, first = numpy.unique(sub, return_index=True)
+            poly = poly[first]
+            status[sub] = INSIDE
+            zone[sub] = polygon_zone[poly]
+            distance[sub] = shapely.distance(self.geometries[sub], edges[poly])
+
+            # nearest edge of everything outside, within the largest radius
+            outside = numpy.flatnonzero(status != INSIDE)
+            if len(outside) and self.radius.max() > 0:
+                sub, poly = tree.query(self.geometries[outside], predicate="dwithin", distance=self.radius.max())
+                sub = outside[sub]
+                dist = shapely.distance(self.geometries[sub], polygons[poly])
+                # closest zone per subscription: sort by (subscription, distance) and keep the first
+                order = numpy.lexsort((dist, sub))
+                sub, first = numpy.unique(sub[order], return_index=True)
+                poly, dist = poly[order][first], dist[order][first]
+                near = dist <= self.radius[sub]
+                status[sub[near]] = NEAR
+                zone[sub[near]] = polygon_zone[poly[near]]
+                distance[sub[near]] = dist[near]
+
+        # zones are compared by label, since their indices are not stable between snapshots
+        names = snapshot.attributes.get("name")
+        zone_labels = numpy.array([None] + (list(names) if names else [str(z_) for z_ in range(len(snapshot))]), dtype=object)
+        label = zone_labels[zone + 1]
+
+        old_status, old_label = self.__state.get(section) or self.__initial(section, self.__seeds)
+        self.__state[section] = (status, label)
+        changed = numpy.flatnonzero((status != old_status) | (label != old_label))
+
+        ids = self.ids
+        dists = [None if math.isnan(d_) else round(d_, 1) for d_ in distance[changed].tolist()]
+        return [
+            {"subscription": ids[i], "section": section, "status": STATUS[s_], "zone": l_, "distance": d_}
+            for i, s_, l_, d_ in zip(changed.tolist(), status[changed].tolist(), label[changed].tolist(), dists)
+        ]
+
+
+if __name__ == "__main__":
+    # per-publish cost of the spatial join: python geofence.py [subscriptions] [zones]
+    import sys
+    import time
+    from polygon_snapshot import polygon_snapshot
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    zones = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    rng = numpy.random.default_rng(0)
+    centre = numpy.array([144.96, -37.81])
+
+    # one in twenty subscriptions is a small area, the rest points, spread over about 100 km
+    rows = []
+    for i, (lon, lat) in enumerate((centre + rng.uniform(-0.6, 0.6, (count, 2))).tolist()):
+        if i % 20:
+            rows.append((f"unit-{i}", lon, lat, None, ALERT_RADIUS, "{}"))
+        else:
+            ring = [[lon, lat], [lon + 0.01, lat], [lon + 0.01, lat + 0.01], [lon, lat + 0.01], [lon, lat]]
+            rows.append((f"area-{i}", None, None, json.dumps({"type": "Polygon", "coordinates": [ring]}), ALERT_RADIUS, "{}"))
+
+    # the same zones drifting east between publishes, as a front moves
+    centres = centre + rng.uniform(-0.5, 0.5, (zones, 2))
+    radii = rng.uniform(0.005, 0.03, zones)
+
+    def publish(shift):
+        angles = numpy.linspace(0, 2 * numpy.pi, 40)
+        rings = [[numpy.column_stack((x + r * numpy.cos(angles), y + r * numpy.sin(angles)))] for (x, y), r in zip(centres + [shift, 0], radii)]
+        return polygon_snapshot.from_rings(rings, {"name": [f"Zone {z_}" for z_ in range(zones)]})
+
+    started = time.perf_counter()
+    engine = geofence_engine(rows)
+    print(f"{count} subscriptions loaded in {time.perf_counter() - started:.2f}s")
+    for n, shift in enumerate((0, 0.005, 0.01, 0.015, 0.02)):
+        snapshot = publish(shift)
+        started = time.perf_counter()
+        alerts = engine.evaluate("polygons", snapshot)
+        print(f"publish {n}: {zones} zones, {len(alerts)} alerts in {time.perf_counter() - started:.2f}s")
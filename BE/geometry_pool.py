@@ -0,0 +1,237 @@
+"""
+Zone simplification off the cycle's thread.
+
+`reduce_geometries` is the vectorized zone simplification: every polygon part of every zone
+has its exterior simplified and, if still longer than `max_points`, evenly downsampled. Zone
+sets with many points (geocoded boundaries run to thousands each, so a few dozen zones are
+enough) are split into chunks of about equal point counts and reduced on a process pool, so
+the work neither holds the GIL nor competes with request handling. The pool only starts in
+the worker that runs the cycle, and each uvicorn worker is sized to its share of the cores.
+Chunks travel as WKB in one shared-memory block, and workers write their rings straight
+into a preallocated shared-memory result; nothing but slice bounds is pickled.
+"""
+
+import os
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+import shapely
+
+SIMPLIFY_TOLERANCE = 0.006
+
+
+def available_cores():
+    """
+    Cores this process may run on (respecting CPU affinity, e.g. container limits)
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# uvicorn takes its --workers default from WEB_CONCURRENCY; GEOMETRY_WORKERS is per uvicorn worker
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+GEOMETRY_WORKERS = int(os.getenv("GEOMETRY_WORKERS", "0")) or max(1, available_cores() // WEB_CONCURRENCY)
+# zone sets with fewer points than this are reduced inline; the pool round trip costs more than it saves
+GEOMETRY_PARALLEL_POINTS = int(os.getenv("GEOMETRY_PARALLEL_POINTS", "100000"))
+
+POLYGON, MULTIPOLYGON = 3, 6
+
+
+def polygon_parts(geometries):
+    """
+    Outputs:
+        (parts, zone) : every polygon of the Polygon/MultiPolygon geometries (others have none),
+                        and the index of the geometry each came from
+    """
+    geometries = numpy.asarray(geometries, dtype=object)
+    parts, zone = shapely.get_parts(geometries, return_index=True)
+    keep = numpy.isin(shapely.get_type_id(geometries), (POLYGON, MULTIPOLYGON))[zone] & (shapely.get_type_id(parts) == POLYGON)
+    return parts[keep], zone[keep]
+
+
+def part_counts(geometries):
+    """
+    Outputs:
+        upper bound on the number of rings each geometry reduces to
+    """
+    types = shapely.get_type_id(geometries)
+    return numpy.where(types == POLYGON, 1, numpy.where(types == MULTIPOLYGON, shapely.get_num_geometries(geometries), 0))
+
+
+def reduce_geometries(geometries, tolerance=SIMPLIFY_TOLERANCE, max_points=40):
+    """
+    Simplify the exterior of every polygon part and cap it at `max_points` coordinates
+    Outputs:
+        (coords, ring_offsets, zone_offsets) in polygon_snapshot's layout, one zone per geometry
+    """
+    parts, zone = polygon_parts(geometries)
+    # empty parts are skipped, as douglas_peucker always has
+    exteriors = shapely.get_exterior_ring(parts)
+    keep = ~shapely.is_empty(exteriors)
+    exteriors, zone = exteriors[keep], zone[keep]
+
+    simplified = shapely.get_exterior_ring(shapely.simplify(shapely.polygons(exteriors), tolerance))
+    coords, ring = shapely.get_coordinates(simplified, return_index=True)
+    lengths = numpy.bincount(ring, minlength=len(simplified))
+
+    # keep every step-th point of rings over max_points, at most max_points of them
+    step = numpy.where(lengths > max_points, lengths // max_points, 1)
+    starts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+    position = numpy.arange(len(coords)) - starts[ring]
+    kept = (position % step[ring] == 0) & (position // step[ring] < max_points)
+    coords = coords[kept]
+    lengths = numpy.bincount(ring[kept], minlength=len(simplified))
+
+    ring_offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=ring_offsets[1:])
+    zone_offsets = numpy.zeros(len(geometries) + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(zone, minlength=len(geometries)), out=zone_offsets[1:])
+    return coords, ring_offsets, zone_offsets
+
+
+def reduce_chunk(source, result, n, parts, max_points, start, stop, first_slot, tolerance):
+    """
+    Worker side: reduce geometries start:stop of the WKB block `source`, writing each ring
+    into its own max_points slot of the `result` block
+    Args:
+        source : shared memory name of [n + 1 int64 WKB offsets][WKB bytes]
+        result : shared memory name of [parts int64 ring lengths][parts * max_points * 2 float64 coords]
+        first_slot : slot of geometry `start`'s first ring; each geometry has part_counts() slots
+    """
+    source_shm, result_shm = shared_memory.SharedMemory(source), shared_memory.SharedMemory(result)
+    try:
+        offsets = numpy.ndarray(n + 1, dtype=numpy.int64, buffer=source_shm.buf)
+        base = offsets.nbytes
+        geometries = shapely.from_wkb([
+            bytes(source_shm.buf[base + a:base + b])
+            for a, b in zip(offsets[start:stop].tolist(), offsets[start + 1:stop + 1].tolist())
+        ])
+        coords, ring_offsets, zone_offsets = reduce_geometries(geometries, tolerance, max_points)
+
+        # slot of each ring: its geometry's first slot plus its position within the geometry
+        geometry_slot = first_slot + numpy.concatenate(([0], numpy.cumsum(part_counts(geometries))[:-1]))
+        ring_zone = numpy.repeat(numpy.arange(len(geometries)), numpy.diff(zone_offsets))
+        slots = geometry_slot[ring_zone] + numpy.arange(len(ring_zone)) - zone_offsets[ring_zone]
+        ring_lengths = numpy.diff(ring_offsets)
+
+        lengths_out = numpy.ndarray(parts, dtype=numpy.int64, buffer=result_shm.buf)
+        coords_out = numpy.ndarray((parts * max_points, 2), dtype=numpy.float64, buffer=result_shm.buf, offset=parts * 8)
+        lengths_out[slots] = ring_lengths
+        coords_out[numpy.repeat(slots * max_points - ring_offsets[:-1], ring_lengths) + numpy.arange(len(coords))] = coords
+        # views must go before the blocks can close
+        del offsets, lengths_out, coords_out
+    finally:
+        source_shm.close()
+        result_shm.close()
+
+
+class geometry_pool():
+    def __init__(self, workers=GEOMETRY_WORKERS, parallel_points=GEOMETRY_PARALLEL_POINTS):
+        """
+        Args:
+            workers : processes in the pool (defaults to this uvicorn worker's share of the cores)
+            parallel_points : zone sets with fewer points than this are reduced inline
+        """
+        self.workers = workers
+        self.parallel_points = parallel_points
+        self.__pool = None
+
+    def __get_pool(self):
+        if self.__pool is None:
+            # forkserver: forking the threaded server process directly is unsafe
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            self.__pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        return self.__pool
+
+    def reduce(self, geometries, tolerance=SIMPLIFY_TOLERANCE, max_points=40):
+        """
+        reduce_geometries, split into chunks across the pool for zone sets with many points
+        Outputs:
+            (coords, ring_offsets, zone_offsets) in polygon_snapshot's layout, one zone per geometry
+        """
+        geometries = numpy.asarray(geometries, dtype=object)
+        n = len(geometries)
+        points = shapely.get_num_coordinates(geometries)
+        if self.workers <= 1 or n < 2 or points.sum() < self.parallel_points:
+            return reduce_geometries(geometries, tolerance, max_points)
+        # missing geometries have no WKB; they reduce to no rings either way
+        geometries = numpy.where(shapely.is_missing(geometries), shapely.GeometryCollection(), geometries)
+
+        counts = part_counts(geometries)
+        first_slots = numpy.concatenate(([0], numpy.cumsum(counts)))
+        parts = int(first_slots[-1])
+        wkb = shapely.to_wkb(geometries)
+        wkb_offsets = numpy.zeros(n + 1, dtype=numpy.int64)
+        numpy.cumsum([len(w) for w in wkb], out=wkb_offsets[1:])
+
+        source = shared_memory.SharedMemory(create=True, size=max(1, wkb_offsets.nbytes + int(wkb_offsets[-1])))
+        result = shared_memory.SharedMemory(create=True, size=max(1, parts * 8 + parts * max_points * 16))
+        try:
+            numpy.ndarray(n + 1, dtype=numpy.int64, buffer=source.buf)[:] = wkb_offsets
+            source.buf[wkb_offsets.nbytes:wkb_offsets.nbytes + int(wkb_offsets[-1])] = b"".join(wkb)
+            lengths = numpy.ndarray(parts, dtype=numpy.int64, buffer=result.buf)
+            lengths[:] = -1
+
+            # a few chunks of about equal point counts per worker, so an uneven chunk doesn't hold up the rest
+            cumulative = numpy.cumsum(points)
+            targets = numpy.linspace(0, cumulative[-1], self.workers * 4 + 1)[1:-1]
+            bounds = numpy.unique(numpy.concatenate(([0], numpy.searchsorted(cumulative, targets, side="right"), [n]))).tolist()
+            pool = self.__get_pool()
+            futures = [
+                pool.submit(reduce_chunk, source.name, result.name, n, parts, max_points, start, end, int(first_slots[start]), tolerance)
+                for start, end in zip(bounds[:-1], bounds[1:])
+            ]
+            for future in futures:
+                future.result()
+
+            # compact the filled slots
+            filled = numpy.flatnonzero(lengths >= 0)
+            ring_lengths = lengths[filled]
+            ring_offsets = numpy.zeros(len(filled) + 1, dtype=numpy.int64)
+            numpy.cumsum(ring_lengths, out=ring_offsets[1:])
+            coords_all = numpy.ndarray((parts * max_points, 2), dtype=numpy.float64, buffer=result.buf, offset=parts * 8)
+            coords = coords_all[numpy.repeat(filled * max_points - ring_offsets[:-1], ring_lengths) + numpy.arange(ring_offsets[-1])]
+            zone = numpy.searchsorted(first_slots, filled, side="right") - 1
+            zone_offsets = numpy.zeros(n + 1, dtype=numpy.int64)
+            numpy.cumsum(numpy.bincount(zone, minlength=n), out=zone_offsets[1:])
+            del lengths, coords_all
+        finally:
+            source.close()
+            source.unlink()
+            result.close()
+            result.unlink()
+        return coords, ring_offsets, zone_offsets
+
+    def shutdown(self):
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=False, cancel_futures=True)
+            self.__pool = None
+
+
+if __name__ == "__main__":
+    # scaling benchmark: python geometry_pool.py [zones] [points per boundary]
+    import sys
+    import time
+
+    zones = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    points = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rng = numpy.random.default_rng(0)
+    angles = numpy.sort(rng.random((zones, points)), axis=1) * 2 * numpy.pi
+    radius = 0.05 + 0.02 * rng.random((zones, points))
+    centres = rng.random((zones, 2)) * 5
+    boundaries = shapely.polygons(numpy.stack((centres[:, :1] + radius * numpy.cos(angles), centres[:, 1:] + radius * numpy.sin(angles)), axis=2))
+
+    print(f"{zones} boundaries of {points} points, {available_cores()} cores available")
+    baseline = None
+    for workers in sorted({2 ** i for i in range(available_cores().bit_length())} | {available_cores()}):
+        pool = geometry_pool(workers=workers, parallel_points=1)
+        pool.reduce(boundaries[:workers * 4])
+        started = time.perf_counter()
+        pool.reduce(boundaries)
+        elapsed = time.perf_counter() - started
+        pool.shutdown()
+        baseline = baseline or elapsed
+        print(f"{workers:>3} workers: {elapsed:.2f}s ({baseline / elapsed:.1f}x)")
@@ -0,0 +1,482 @@
+"""
+Shared executor for every LLM call made by the serverside cycle.
+
+Agents submit their chains here instead of calling `chain.invoke` directly. Calls wait
+in one priority heap; a single dispatcher thread hands the highest-priority call to a
+small thread pool whenever a pool thread is free and both token buckets (requests/min
+and tokens/min) have room. Calls that fail with rate limits or transient errors go back
+to the heap after a jittered exponential backoff (no pool thread sleeps through it), and
+are abandoned once their deadline passes.
+
+Calls can optionally be hedged: if an agent's call is still outstanding after its
+usual (percentile) latency, a duplicate goes to the same or a fallback model and the
+first successful result wins. Hedges are capped to a fraction of the submitted tokens.
+The losing copy is dropped if it has not started and never retried. A request already in
+flight cannot be interrupted, so it runs out on a spare pool thread (at most `concurrency`
+of them) without holding a dispatch slot, and its tokens are reported as abandoned.
+
+    python llm_scheduler.py [calls]   # hedging on a heavy-tailed stub model, per-call latency percentiles
+"""
+
+import os
+import time
+import heapq
+import random
+import itertools
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, CancelledError
+
+# PRIORITIES (lower runs first)
+PRIORITY_REC = 0
+PRIORITY_PREDICTION = 0
+PRIORITY_TWITTER = 1
+PRIORITY_ARTICLE = 2
+
+RETRYABLE_ERRORS = ("RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError", "TimeoutError")
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+# completion allowance charged to the tokens/min bucket on top of the prompt
+COMPLETION_TOKENS = int(os.getenv("LLM_COMPLETION_TOKENS", "1024"))
+
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.5, 1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def estimate_tokens(prompt_text):
+    """
+    Rough token count (~4 characters per token) of a prompt plus its completion allowance
+    """
+    return len(prompt_text) // 4 + COMPLETION_TOKENS
+
+
+class token_bucket():
+    """
+    Refills `per_minute` units per minute up to one minute's worth
+    """
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """
+        Outputs:
+            seconds until `amount` units are available (0 if available now)
+        """
+        self.__refill()
+        # a single call larger than the bucket is let through once the bucket is full
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount):
+        self.__refill()
+        self.level -= min(amount, self.capacity)
+
+
+class latency_histogram():
+    """
+    Call latencies of one agent: bucket counts for reporting, recent samples for percentiles
+    """
+    def __init__(self, window=200):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.samples = deque(maxlen=window)
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def record(self, seconds):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            i = len(LATENCY_BUCKETS)
+        self.counts[i] += 1
+        self.samples.append(seconds)
+
+    def percentile(self, pct):
+        """
+        Outputs:
+            the `pct` percentile of recent latencies, or None without samples
+        """
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def summary(self):
+        labels = [f"<={bound}s" for bound in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}s"]
+        return {
+            "calls": sum(self.counts),
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "histogram": dict(zip(labels, self.counts))
+        }
+
+
+class llm_job():
+    def __init__(self, fn, priority, tokens, deadline, seq, ctx=None):
+        self.fn = fn
+        self.priority = priority
+        self.tokens = tokens
+        self.deadline = deadline
+        self.seq = seq
+        self.attempts = 0
+        # monotonic time a retry may be dispatched again
+        self.ready_at = 0.0
+        # admitted to the pool and not back yet; lost a hedge race; gave its dispatch slot back
+        self.running = False
+        self.abandoned = False
+        self.released = False
+        self.future = Future()
+        # run inside the submitter's context so callbacks such as get_openai_callback still see the call
+        self.ctx = ctx or contextvars.copy_context()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+def is_retryable(err):
+    """
+    Rate limits, timeouts and 5xx responses are worth retrying; bad requests and parse errors are not
+    """
+    if type(err).__name__ in RETRYABLE_ERRORS or isinstance(err, TimeoutError):
+        return True
+    return getattr(err, "status_code", None) in RETRYABLE_STATUS
+
+
+def retry_after(err):
+    """
+    Outputs:
+        seconds requested by a `retry-after` header on the error's response, or None
+    """
+    response = getattr(err, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class llm_scheduler():
+    def __init__(
+        self,
+        rpm=int(os.getenv("LLM_RPM", "500")),
+        tpm=int(os.getenv("LLM_TPM", "200000")),
+        concurrency=int(os.getenv("LLM_CONCURRENCY", "4")),
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", "4")),
+        base_delay=float(os.getenv("LLM_BASE_DELAY", "1")),
+        max_delay=float(os.getenv("LLM_MAX_DELAY", "30")),
+        deadline=float(os.getenv("LLM_DEADLINE", "120")),
+        hedge=os.getenv("LLM_HEDGE", "false").lower() == "true",
+        hedge_percentile=float(os.getenv("LLM_HEDGE_PERCENTILE", "90")),
+        hedge_min_samples=int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "10")),
+        hedge_budget=float(os.getenv("LLM_HEDGE_BUDGET", "0.1"))
+    ):
+        self.requests = token_bucket(rpm)
+        self.tokens = token_bucket(tpm)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_budget = hedge_budget
+        self.latency = {}
+        self.concurrency = concurrency
+        self.__submitted_tokens = 0
+        self.__hedged_tokens = 0
+        self.__abandoned_tokens = 0
+        self.__stats_lock = threading.Lock()
+        # calls ready to run, by priority; retries backing off, by ready_at
+        self.__waiting = []
+        self.__delayed = []
+        self.__running = 0
+        # abandoned calls still running on a spare pool thread
+        self.__abandoned = 0
+        self.__closed = False
+        self.__cond = threading.Condition()
+        self.__seq = itertools.count()
+        self.__pool = ThreadPoolExecutor(max_workers=2 * concurrency, thread_name_prefix="llm")
+        threading.Thread(target=self.__dispatch, name="llm-dispatch", daemon=True).start()
+
+    def submit(self, fn, priority=PRIORITY_ARTICLE, tokens=1000, deadline=None, agent="default", hedge_fn=None):
+        """
+        Queue an LLM call
+        Args:
+            fn : zero-argument callable making the call (e.g. lambda: chain.invoke({}))
+            priority : lower values are admitted first
+            tokens : estimated prompt + completion tokens, charged to the tokens/min bucket
+            deadline : seconds the call may take including queueing and retries
+            agent : name the call's latency is recorded under
+            hedge_fn : callable for the hedged duplicate (e.g. the fallback model's chain), defaults to fn
+        Outputs:
+            concurrent.futures.Future with the call's result
+        """
+        deadline = time.monotonic() + (self.deadline if deadline is None else deadline)
+        with self.__stats_lock:
+            histogram = self.latency.setdefault(agent, latency_histogram())
+            self.__submitted_tokens += tokens
+            threshold = histogram.percentile(self.hedge_percentile) if len(histogram.samples) >= self.hedge_min_samples else None
+
+        result = Future()
+        started = time.monotonic()
+        first = llm_job(fn, priority, tokens, deadline, next(self.__seq))
+        jobs = [first]
+        self.__start(first)
+        # re-entered when abandoning a queued copy cancels its future
+        lock = threading.RLock()
+        timer = None
+
+        def finish(call):
+            with lock:
+                if result.done() or call.cancelled():
+                    return
+                if call.exception() is not None and any(not job.future.done() for job in jobs):
+                    # the other copy may still succeed
+                    return
+                if timer is not None:
+                    timer.cancel()
+                for job in jobs:
+                    if job.future is not call:
+                        self.__abandon(job)
+                with self.__stats_lock:
+                    histogram.record(time.monotonic() - started)
+                    if call is not first.future:
+                        histogram.hedge_wins += 1
+                if call.exception() is not None:
+                    result.set_exception(call.exception())
+                else:
+                    result.set_result(call.result())
+
+        def launch_hedge():
+            with lock:
+                if result.done() or first.future.done() or not self.__take_hedge_budget(tokens):
+                    return
+                with self.__stats_lock:
+                    histogram.hedged += 1
+                print(f"Hedging slow {agent} call after {threshold:.1f}s")
+                hedge = llm_job(hedge_fn or fn, priority, tokens, deadline, next(self.__seq), first.ctx.copy())
+                jobs.append(hedge)
+                self.__start(hedge)
+            hedge.future.add_done_callback(finish)
+
+        if self.hedge and threshold is not None:
+            timer = threading.Timer(threshold, launch_hedge)
+            timer.daemon = True
+            timer.start()
+        first.future.add_done_callback(finish)
+        return result
+
+    def invoke(self, fn, priority=PRIORITY_ARTICLE, tokens=1000, deadline=None, agent="default", hedge_fn=None):
+        """
+        Submit a call and wait for its result
+        """
+        return self.submit(fn, priority, tokens, deadline, agent, hedge_fn).result()
+
+    def stats(self):
+        """
+        Outputs:
+            per-agent latency summaries and hedge spend
+        """
+        with self.__stats_lock:
+            return {
+                "agents": {agent: histogram.summary() for agent, histogram in self.latency.items()},
+                "submitted_tokens": self.__submitted_tokens,
+                "hedged_tokens": self.__hedged_tokens,
+                "abandoned_tokens": self.__abandoned_tokens
+            }
+
+    def __take_hedge_budget(self, tokens):
+        """
+        Charge a hedge to the budget if it keeps hedged tokens under `hedge_budget` of all submitted tokens
+        """
+        with self.__stats_lock:
+            if self.__hedged_tokens + tokens > self.hedge_budget * self.__submitted_tokens:
+                return False
+            self.__hedged_tokens += tokens
+            self.__submitted_tokens += tokens
+            return True
+
+    def __start(self, job):
+        with self.__cond:
+            heapq.heappush(self.__waiting, job)
+            self.__cond.notify_all()
+
+    def __abandon(self, job):
+        """
+        Stop a hedge race's losing copy: drop it if it has not started or is backing off,
+        otherwise let the request run out without holding a dispatch slot (while spare
+        pool threads last) and without retrying
+        """
+        with self.__cond:
+            if job.future.done() or job.abandoned:
+                return
+            job.abandoned = True
+            # queued (or backing off): the dispatcher drops it
+            self.__cond.notify_all()
+            if not job.running:
+                return
+            if self.__abandoned < self.concurrency:
+                self.__running -= 1
+                self.__abandoned += 1
+                job.released = True
+        with self.__stats_lock:
+            self.__abandoned_tokens += job.tokens
+
+    def __dispatch(self):
+        """
+        Hand waiting calls to the pool in priority order as threads and bucket room free up
+        """
+        with self.__cond:
+            while not self.__closed:
+                now = time.monotonic()
+                while self.__delayed and self.__delayed[0][0] <= now:
+                    heapq.heappush(self.__waiting, heapq.heappop(self.__delayed)[2])
+                self.__expire(now)
+
+                wait = min([job.deadline for job in self.__waiting] + [d_[0] for d_ in self.__delayed[:1]] + [now + 60]) - now
+                if self.__waiting and self.__running < self.concurrency:
+                    job = self.__waiting[0]
+                    room = max(self.requests.wait_time(1), self.tokens.wait_time(job.tokens))
+                    if room <= 0:
+                        heapq.heappop(self.__waiting)
+                        if job.attempts == 0 and not job.future.set_running_or_notify_cancel():
+                            continue
+                        self.requests.take(1)
+                        self.tokens.take(job.tokens)
+                        self.__running += 1
+                        job.running = True
+                        self.__pool.submit(job.ctx.run, self.__run, job)
+                        continue
+                    # the head waits for the buckets; nothing behind it jumps the queue
+                    wait = min(wait, room)
+                self.__cond.wait(max(wait, 0.001))
+
+    def __expire(self, now):
+        """
+        Fail waiting calls whose deadline passed, and drop ones cancelled or abandoned before they ran again
+        """
+        expired = [job for job in self.__waiting if job.deadline <= now or job.future.cancelled() or job.abandoned]
+        if not expired:
+            return
+        self.__waiting = [job for job in self.__waiting if job not in expired]
+        heapq.heapify(self.__waiting)
+        for job in expired:
+            if not job.future.cancelled():
+                if job.attempts == 0:
+                    job.future.set_running_or_notify_cancel()
+                if job.abandoned:
+                    job.future.set_exception(CancelledError("lost a hedge race"))
+                else:
+                    job.future.set_exception(TimeoutError("LLM call deadline passed while queued"))
+
+    def __run(self, job):
+        job.attempts += 1
+        try:
+            result = job.fn()
+        except Exception as err:
+            retry = is_retryable(err) and job.attempts <= self.max_retries and not job.abandoned
+            if retry:
+                # full jitter, unless the API told us how long to wait
+                delay = retry_after(err)
+                if delay is None:
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (job.attempts - 1)))
+                retry = time.monotonic() + delay < job.deadline
+            if not retry:
+                self.__finished(job)
+                job.future.set_exception(err)
+                return
+            print(f"LLM call failed ({type(err).__name__}), retry {job.attempts} in {delay:.1f}s")
+            with self.__cond:
+                job.ready_at = time.monotonic() + delay
+                heapq.heappush(self.__delayed, (job.ready_at, job.seq, job))
+            self.__finished(job)
+            return
+        self.__finished(job)
+        job.future.set_result(result)
+
+    def __finished(self, job):
+        with self.__cond:
+            # an abandoned call may have given its dispatch slot back already
+            if job.released:
+                self.__abandoned -= 1
+            else:
+                self.__running -= 1
+            job.running = job.released = False
+            self.__cond.notify_all()
+
+    def shutdown(self):
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify_all()
+        self.__pool.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    # hedging benchmark on a stub model whose latency is lognormal with a heavy tail
+    import sys
+
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    clients = 8
+
+    def run(percentile=None):
+        rng = random.Random(0)
+        scheduler = llm_scheduler(
+            rpm=10**6, tpm=10**9, concurrency=clients, deadline=60,
+            hedge=percentile is not None, hedge_percentile=percentile or 90, hedge_min_samples=20
+        )
+        lock = threading.Lock()
+        latencies, peak = [], [0]
+        in_flight = [0]
+
+        def stub():
+            with lock:
+                # 5% of calls take ~20x as long
+                delay = rng.lognormvariate(-1.6, 0.4) * (20 if rng.random() < 0.05 else 1)
+                in_flight[0] += 1
+                peak[0] = max(peak[0], in_flight[0])
+            time.sleep(delay)
+            with lock:
+                in_flight[0] -= 1
+            return delay
+
+        def client(n):
+            for _ in range(n):
+                started = time.monotonic()
+                scheduler.invoke(stub, tokens=1000, agent="stub")
+                latencies.append(time.monotonic() - started)
+
+        started = time.monotonic()
+        threads = [threading.Thread(target=client, args=(calls // clients,)) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+        stats = scheduler.stats()
+        scheduler.shutdown()
+        latencies.sort()
+        pick = lambda pct: latencies[min(len(latencies) - 1, int(len(latencies) * pct / 100))]
+        agent = stats["agents"]["stub"]
+        print(
+            f"{f'hedge at p{percentile:g}' if percentile else 'no hedging':<13} p50 {pick(50):.2f}s  p90 {pick(90):.2f}s  p99 {pick(99):.2f}s  max {latencies[-1]:.2f}s  "
+            f"{len(latencies) / elapsed:.1f} calls/s  hedged {agent['hedged']} (won {agent['hedge_wins']})  "
+            f"extra tokens {stats['hedged_tokens'] / (stats['submitted_tokens'] - stats['hedged_tokens']):.1%}  "
+            f"abandoned {stats['abandoned_tokens']} tokens  peak {peak[0]} requests in flight"
+        )
+
+    print(f"{calls} calls from {clients} clients, concurrency {clients}")
+    for percentile in (None, 90, 95):
+        run(percentile)
@@ -0,0 +1,339 @@
+"""
+Load test for the serverside endpoints.
+
+Starts the backend under uvicorn against a scratch snapshot store, with the stub agents,
+geocoder and sources of cycle_bench (`cycle_bench:stub_app`), and starts the serverside
+cycle through POST /start_serverside. The real cycle then runs inside the server while
+it is measured, on synthetic articles or replayed NewsAPI responses. Thousands of
+concurrent async clients hit /dangerzones, /predictions, /ai_advice, /status, /tiles and
+/route. Reports p50/p95/p99 latency per endpoint, throughput, the server's peak RSS and
+the cycles published, and exits non-zero when any of them regress past the stored baseline.
+
+    python loadtest.py                       # compare against loadtest_baseline.json
+    python loadtest.py --save-baseline       # record this machine's numbers as the baseline
+    python loadtest.py --replay newsapi.jsonl --clients 5000 --workers 4
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import numpy
+import aiohttp
+import requests
+import tabulate
+from snapshot_store import snapshot_store
+from road_router import haversine
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, "loadtest_baseline.json")
+
+# around Melbourne, where the stub geocoder places zones and the road grid is laid out
+CENTRE = (144.96, -37.81)
+
+# (name, method, path or path function, weight)
+ENDPOINTS = (
+    ("dangerzones", "POST", "/dangerzones", 30),
+    ("predictions", "POST", "/predictions", 20),
+    ("ai_advice", "POST", "/ai_advice", 20),
+    ("status", "POST", "/status", 10),
+    ("dangerzones_bin", "POST", "/dangerzones?format=bin", 10),
+    ("tiles", "GET", lambda: "/tiles/dangerzones/10/%d/%d" % (924 + random.randint(0, 2), 628 + random.randint(0, 2)), 8),
+    ("route", "GET", lambda: "/route?from=%f,%f&to=%f,%f" % random_trip(), 2),
+)
+
+
+def random_trip():
+    """
+    Two random points on the synthetic road grid
+    """
+    return tuple(c + random.uniform(-0.1, 0.1) for c in CENTRE * 2)
+
+
+def write_road_grid(path, size=150, spacing=0.0015):
+    """
+    Save a size x size street grid around CENTRE in road_router's CSR layout, so /route is
+    served without downloading a real road graph
+    """
+    ys, xs = numpy.divmod(numpy.arange(size * size), size)
+    node_x = CENTRE[0] + (xs - size / 2) * spacing
+    node_y = CENTRE[1] + (ys - size / 2) * spacing
+    src, dst = [], []
+    for node in range(size * size):
+        row, col = divmod(node, size)
+        for r, c in ((row - 1, col), (row, col - 1), (row, col + 1), (row + 1, col)):
+            if 0 <= r < size and 0 <= c < size:
+                src.append(node)
+                dst.append(r * size + c)
+    weights = [haversine(node_x[a], node_y[a], node_x[b], node_y[b]) for a, b in zip(src, dst)]
+    indptr = numpy.zeros(size * size + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(src, minlength=size * size), out=indptr[1:])
+    os.makedirs(path, exist_ok=True)
+    arrays = {"node_x": node_x, "node_y": node_y, "indptr": indptr, "indices": numpy.array(dst), "weights": numpy.array(weights)}
+    for name, array in arrays.items():
+        numpy.save(os.path.join(path, f"{name}.npy"), array)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def process_rss(pid):
+    """
+    Outputs:
+        resident memory (bytes) of `pid` and its children, or None where /proc is unavailable
+    """
+    pids, total = [pid], 0
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(child) for child in f.read().split()]
+        for p in pids:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return total
+
+
+def percentile(ordered, pct):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def client(http, deadline, warmup_end, latencies, errors):
+    names, weights = [e[0] for e in ENDPOINTS], [e[3] for e in ENDPOINTS]
+    endpoints = {e[0]: e for e in ENDPOINTS}
+    while time.monotonic() < deadline:
+        name = random.choices(names, weights)[0]
+        _, method, path, _ = endpoints[name]
+        started = time.monotonic()
+        try:
+            async with http.request(method, path() if callable(path) else path) as response:
+                await response.read()
+                ok = response.status < 500
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            ok = False
+        if started < warmup_end:
+            continue
+        latencies[name].append(time.monotonic() - started)
+        if not ok:
+            errors[name] += 1
+
+
+async def drive(base_url, clients, duration, warmup, server_pid):
+    """
+    Outputs:
+        per-endpoint latencies and error counts, measured seconds and peak RSS
+    """
+    latencies = {e[0]: [] for e in ENDPOINTS}
+    errors = {e[0]: 0 for e in ENDPOINTS}
+    peak_rss = None
+    # aiohttp rather than httpx: httpx's pool slows down sharply with thousands of connections
+    connector = aiohttp.TCPConnector(limit=clients)
+    async with aiohttp.ClientSession(base_url, connector=connector, timeout=aiohttp.ClientTimeout(total=30)) as http:
+        start = time.monotonic()
+        warmup_end, deadline = start + warmup, start + warmup + duration
+        tasks = [asyncio.create_task(client(http, deadline, warmup_end, latencies, errors)) for _ in range(clients)]
+        while not all(t.done() for t in tasks):
+            rss = process_rss(server_pid)
+            if rss is not None:
+                peak_rss = max(peak_rss or 0, rss)
+            await asyncio.sleep(0.5)
+        await asyncio.gather(*tasks)
+    return latencies, errors, time.monotonic() - warmup_end, peak_rss
+
+
+def summarize(latencies, errors, elapsed, peak_rss, args):
+    def stats(samples, failed):
+        ordered = sorted(samples)
+        return {
+            "requests": len(ordered),
+            "errors": failed,
+            "throughput": len(ordered) / elapsed,
+            "p50": percentile(ordered, 50),
+            "p95": percentile(ordered, 95),
+            "p99": percentile(ordered, 99)
+        }
+
+    everything = [s_ for samples in latencies.values() for s_ in samples]
+    return {
+        "clients": args.clients,
+        "workers": args.workers,
+        "duration": round(elapsed, 1),
+        "rss_mb": None if peak_rss is None else round(peak_rss / 2**20, 1),
+        "overall": stats(everything, sum(errors.values())),
+        "endpoints": {name: stats(latencies[name], errors[name]) for name in latencies}
+    }
+
+
+def regressions(result, baseline, tolerance, floor=0.005):
+    """
+    Outputs:
+        descriptions of every metric worse than the baseline by more than `tolerance`
+        (latencies also need to be `floor` seconds worse, so tiny values don't flap)
+    """
+    found = []
+    groups = [("overall", result["overall"], baseline.get("overall", {}))]
+    groups += [(name, stats, baseline.get("endpoints", {}).get(name, {})) for name, stats in result["endpoints"].items()]
+    for name, now, before in groups:
+        for metric in ("p50", "p95", "p99"):
+            if now.get(metric) is not None and before.get(metric) is not None:
+                if now[metric] > before[metric] * (1 + tolerance) and now[metric] - before[metric] > floor:
+                    found.append(f"{name} {metric} {now[metric] * 1000:.1f}ms > baseline {before[metric] * 1000:.1f}ms")
+        if now["requests"] and before.get("requests"):
+            rate, baseline_rate = now["errors"] / now["requests"], before["errors"] / before["requests"]
+            if rate > baseline_rate + 0.01:
+                found.append(f"{name} error rate {rate:.1%} > baseline {baseline_rate:.1%}")
+    if result["overall"]["throughput"] < baseline.get("overall", {}).get("throughput", 0) * (1 - tolerance):
+        found.append(f"throughput {result['overall']['throughput']:.0f}/s < baseline {baseline['overall']['throughput']:.0f}/s")
+    if result["rss_mb"] is not None and baseline.get("rss_mb") is not None and result["rss_mb"] > baseline["rss_mb"] * (1 + tolerance):
+        found.append(f"RSS {result['rss_mb']}MB > baseline {baseline['rss_mb']}MB")
+    # per minute measured, so runs of different --duration compare
+    if baseline.get("cycles_published") is not None and baseline.get("duration"):
+        rate, baseline_rate = result["cycles_published"] * 60 / result["duration"], baseline["cycles_published"] * 60 / baseline["duration"]
+        if rate < baseline_rate * (1 - tolerance):
+            found.append(f"cycles published {rate:.1f}/min < baseline {baseline_rate:.1f}/min")
+    return found
+
+
+def report(result):
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.1f}"
+
+    rows = [
+        [name, stats["requests"], stats["errors"], f"{stats['throughput']:.0f}", ms(stats["p50"]), ms(stats["p95"]), ms(stats["p99"])]
+        for name, stats in list(result["endpoints"].items()) + [("overall", result["overall"])]
+    ]
+    print(tabulate.tabulate(rows, headers=["endpoint", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"]))
+    print(f"\n{result['clients']} clients, {result['workers']} workers, {result['duration']}s, peak RSS {result['rss_mb']} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=2000, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds before measuring")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--zones", type=int, default=30, help="synthetic articles per poll, each placing a zone (gen_polygons drops a source of MAX_SOURCE_ZONES, default 40, or more)")
+    parser.add_argument("--cycle-interval", type=float, default=5, help="seconds between the stub cycle's polls (CYCLE_MIN_INTERVAL)")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="median stub LLM latency (seconds)")
+    parser.add_argument("--replay", help="file of recorded NewsAPI responses (a JSON list, or one per line) the stub cycle plays one per poll")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline results file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed fraction worse than the baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="write this run's results as the baseline")
+    parser.add_argument("--output", help="also write this run's results here")
+    args = parser.parse_args()
+    # without a baseline there is nothing to gate on; that is a failure, not a pass
+    if not args.save_baseline and not os.path.exists(args.baseline):
+        sys.exit(f"No baseline at {args.baseline}; run with --save-baseline to record one.")
+
+    try:
+        import resource
+        # every client holds a socket
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else max(soft, 65536), hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+    with tempfile.TemporaryDirectory() as scratch:
+        db, graph = os.path.join(scratch, "snapshots.db"), os.path.join(scratch, "road_graph")
+        write_road_grid(graph)
+
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        env = dict(
+            os.environ, SNAPSHOT_DB=db, ROAD_GRAPH_DIR=graph, OPENAI_API_KEY=os.getenv("OPENAI_API_KEY") or "loadtest",
+            CYCLE_MIN_INTERVAL=str(args.cycle_interval), STUB_LATENCY=str(args.llm_latency),
+            STUB_ARTICLES=str(args.zones), STUB_PLACES=str(args.zones),
+            STUB_REPLAY=os.path.abspath(args.replay) if args.replay else ""
+        )
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "cycle_bench:stub_app", "--factory",
+             "--port", str(port), "--workers", str(args.workers), "--log-level", "warning", "--no-access-log"],
+            cwd=HERE, env=env, stdout=subprocess.DEVNULL
+        )
+        try:
+            for _ in range(120):
+                try:
+                    if requests.post(f"{base_url}/status", timeout=1).status_code == 200:
+                        break
+                except requests.RequestException:
+                    pass
+                if server.poll() is not None:
+                    sys.exit("Server exited during startup")
+                time.sleep(0.5)
+            else:
+                sys.exit("Server did not start")
+
+            # the cycle runs in whichever worker takes the lease; measure once it has published zones
+            requests.post(f"{base_url}/start_serverside", timeout=10)
+            for _ in range(240):
+                if requests.post(f"{base_url}/dangerzones", timeout=10).content.startswith(b"["):
+                    break
+                if server.poll() is not None:
+                    sys.exit("Server exited before the first cycle")
+                time.sleep(0.5)
+            else:
+                sys.exit("The stub cycle published no danger zones")
+
+            measured = time.time()
+            print(f"Driving {args.clients} clients for {args.duration:.0f}s (+{args.warmup:.0f}s warmup) at {base_url}. . .")
+            latencies, errors, elapsed, peak_rss = asyncio.run(drive(base_url, args.clients, args.duration, args.warmup, server.pid))
+            measured = (measured, time.time())
+        finally:
+            # uvicorn waits for background tasks before shutting down, and the cycle is one
+            try:
+                requests.post(f"{base_url}/stop_serverside", timeout=10)
+            except requests.RequestException:
+                pass
+            server.terminate()
+            try:
+                server.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+
+        # cycles that published danger zones while clients were being served
+        store = snapshot_store(db)
+        try:
+            cycles = sum(1 for s_ in store.between(*measured) if s_["polygons_at"] == s_["published_at"])
+        finally:
+            store.close()
+
+    result = summarize(latencies, errors, elapsed, peak_rss, args)
+    result["cycles_published"] = cycles
+    report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=4)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(result, f, indent=4)
+        print(f"\nSaved baseline to {args.baseline}")
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("clients") != args.clients or baseline.get("workers") != args.workers:
+        print(f"\nWarning: baseline ran {baseline.get('clients')} clients on {baseline.get('workers')} workers.")
+    found = regressions(result, baseline, args.tolerance)
+    if found:
+        print("\nREGRESSIONS:\n\t" + "\n\t".join(found))
+        sys.exit(1)
+    print("\nNo regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
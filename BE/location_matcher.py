@@ -0,0 +1,270 @@
+"""
+In-process replacement for the twitter agent's location/keyword matching.
+
+An Aho-Corasick automaton is built once over the government-monitored location names,
+their aliases and the disaster keywords. Tweets are scanned in a single pass each,
+mentions of a location together with a disaster keyword are counted over a sliding
+window of tweet time, and the result is emitted as the same `location`/`status`
+records the `tds_twit_agent` schema describes.
+
+Matches respect word boundaries: location names and keywords must stand as whole words
+("parkland" does not mention a park, "firearm" is not a fire; a keyword's plural still counts),
+while a keyword written as a stem ending in "*" only has to start a word ("evacuat*" matches
+"evacuation").
+
+    python location_matcher.py [tweets]   # scan throughput benchmark
+"""
+
+import os
+from collections import deque
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
+
+DISASTER_KEYWORDS = (
+    "fire", "bushfire", "wildfire", "blaze", "smoke", "burning", "evacuat*", "emergency",
+    "flood", "earthquake", "storm", "hurricane", "cyclone", "tornado", "landslide", "tsunami"
+)
+
+# trailing words dropped to derive short aliases ("You Yangs Regional Park" -> "You Yangs")
+GENERIC_SUFFIXES = (
+    "national park", "regional park", "state park", "state forest", "conservation park",
+    "bushland reserve", "nature reserve", "reserve", "park", "forest"
+)
+
+MENTION_WINDOW = float(os.getenv("MENTION_WINDOW_HOURS", "6"))
+
+
+class aho_corasick():
+    """
+    Multi-pattern matcher; `transitions` is the full automaton (failure links folded in)
+    so scanning costs one dict lookup per character, plus a boundary check per candidate match
+    """
+    def __init__(self, patterns):
+        """
+        Args:
+            patterns : dict of lowercase pattern -> (label reported when it matches, whole_word);
+                every match must start a word, and whole_word ones must end one too
+        """
+        goto = [{}]
+        outputs = [set()]
+        for pattern, (label, whole_word) in patterns.items():
+            state = 0
+            for ch in pattern:
+                if ch not in goto[state]:
+                    goto.append({})
+                    outputs.append(set())
+                    goto[state][ch] = len(goto) - 1
+                state = goto[state][ch]
+            outputs[state].add((len(pattern), label, whole_word))
+
+        # breadth-first, so a state's failure target is complete before the state itself
+        fail = [0] * len(goto)
+        transitions = [dict(goto[0])] + [None] * (len(goto) - 1)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            # fold the failure state's transitions in so scanning never follows failure links
+            transitions[state] = {**transitions[fail[state]], **goto[state]}
+            outputs[state] |= outputs[fail[state]]
+            for ch, nxt in goto[state].items():
+                fail[nxt] = transitions[fail[state]].get(ch, 0)
+                queue.append(nxt)
+
+        self.transitions = transitions
+        self.outputs = [frozenset(out) for out in outputs]
+
+    def search(self, text):
+        """
+        Outputs:
+            set of labels whose patterns occur in lowercase `text` on word boundaries
+        """
+        transitions, outputs = self.transitions, self.outputs
+        state = 0
+        found = set()
+        end = len(text) - 1
+        for i, ch in enumerate(text):
+            state = transitions[state].get(ch, 0)
+            for length, label, whole_word in outputs[state]:
+                start = i - length
+                if start >= 0 and text[start].isalnum():
+                    continue
+                if whole_word and i < end and text[i + 1].isalnum():
+                    continue
+                found.add(label)
+        return found
+
+
+def location_aliases(address):
+    """
+    Outputs:
+        lowercase names a tweet may use for a government address
+        e.g. "You Yangs Regional Park, Little River, VIC, Australia" ->
+             {"you yangs regional park", "you yangs", "youyangs"}
+    """
+    name = address.split(",")[0].strip().lower()
+    aliases = {name}
+    for suffix in GENERIC_SUFFIXES:
+        if name.endswith(" " + suffix):
+            aliases.add(name[:-len(suffix)].strip())
+            break
+    # hashtag forms
+    aliases |= {alias.replace(" ", "") for alias in aliases}
+    return {alias for alias in aliases if len(alias) > 3}
+
+
+class location_matcher():
+    def __init__(self, gov_addresses, keywords=DISASTER_KEYWORDS, aliases=None, window_hours=MENTION_WINDOW):
+        """
+        Args:
+            gov_addresses : government-monitored locations (reported back verbatim)
+            keywords : disaster keywords (matched as whole lowercase words or their plurals;
+                a trailing "*" marks a stem matched as a word prefix)
+            aliases : optional dict of address -> extra names
+            window_hours : sliding window of tweet time over which mentions are counted
+        """
+        self.gov_addresses = list(gov_addresses)
+        self.window = timedelta(hours=window_hours)
+        patterns = {}
+        for keyword in keywords:
+            keyword = keyword.lower()
+            if keyword.endswith("*"):
+                patterns[keyword[:-1]] = ("", False)
+            else:
+                patterns[keyword] = patterns[keyword + "s"] = ("", True)
+        for i, address in enumerate(self.gov_addresses):
+            names = location_aliases(address) | {a.lower() for a in (aliases or {}).get(address, ())}
+            for name in names:
+                patterns[name] = (i, True)
+        self.automaton = aho_corasick(patterns)
+        # both oldest first: (posted, location index, has keyword) and (posted, tweet key)
+        self.__mentions = deque()
+        self.__tweets = deque()
+        self.__seen = set()
+        self.__latest = None
+
+    def scan(self, tweets):
+        """
+        Add a batch of tweets ({"username", "content", "date-time posted"}) to the sliding window;
+        tweets already scanned are skipped
+        """
+        for tweet in tweets:
+            key = (tweet.get("username"), tweet.get("date-time posted"), tweet.get("content"))
+            if key in self.__seen:
+                continue
+            posted = parse_time(tweet.get("date-time posted"))
+            self.__seen.add(key)
+            self.__tweets.append((posted, key))
+            found = self.automaton.search(tweet.get("content", "").lower())
+            has_keyword = "" in found
+            for label in found:
+                if label != "":
+                    self.__mentions.append((posted, label, has_keyword))
+            if self.__latest is None or posted > self.__latest:
+                self.__latest = posted
+        self.__evict()
+
+    def __evict(self):
+        if self.__latest is None:
+            return
+        cutoff = self.__latest - self.window
+        # tweets arrive roughly in time order; drop from the front until inside the window
+        while self.__mentions and self.__mentions[0][0] < cutoff:
+            self.__mentions.popleft()
+        while self.__tweets and self.__tweets[0][0] < cutoff:
+            self.__seen.discard(self.__tweets.popleft()[1])
+
+    def counts(self):
+        """
+        Outputs:
+            {address: (mentions with a disaster keyword, mentions without)} within the window
+        """
+        out = {address: [0, 0] for address in self.gov_addresses}
+        for _, label, has_keyword in self.__mentions:
+            out[self.gov_addresses[label]][0 if has_keyword else 1] += 1
+        return {address: tuple(c) for address, c in out.items()}
+
+    def records(self):
+        """
+        Outputs:
+            list of {"location", "status"} records, one per government address, in the
+            shape the twitter agent answers in (they go on to the rec and prediction prompts)
+        """
+        return [
+            {"location": address, "status": "dangerous" if hits else "not dangerous"}
+            for address, (hits, _) in self.counts().items()
+        ]
+
+    def ambiguous(self):
+        """
+        Outputs:
+            addresses mentioned in the window but never alongside a disaster keyword
+        """
+        return [address for address, (hits, other) in self.counts().items() if other and not hits]
+
+
+def parse_time(value):
+    """
+    Parse an ISO 8601 tweet time; naive times are taken as UTC and unparseable ones as now
+    """
+    posted = parse_iso(value)
+    # outside the cache, so an unparseable time is the time it is seen at
+    return datetime.now(timezone.utc) if posted is None else posted
+
+
+@lru_cache(maxsize=4096)
+def parse_iso(value):
+    """
+    Outputs:
+        the aware datetime of an ISO 8601 time (naive ones taken as UTC), or None if unparseable
+    """
+    try:
+        posted = datetime.fromisoformat(value[:-1] + "+00:00" if value.endswith("Z") else value)
+    except (AttributeError, TypeError, ValueError):
+        return None
+    return posted if posted.tzinfo else posted.replace(tzinfo=timezone.utc)
+
+
+if __name__ == "__main__":
+    # scan throughput: python location_matcher.py [tweets]
+    import sys
+    import time
+    import random
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    random.seed(0)
+    addresses = [
+        "You Yangs Regional Park, Little River, VIC, Australia",
+        "Churchill National Park, Rowville, VIC, Australia",
+        "Dandenong Ranges National Park, Upper Ferntree Gully, VIC, Australia",
+        "Brisbane Ranges National Park, Anakie, VIC, Australia",
+        "Lerderderg State Park, Greendale, VIC, Australia",
+        "Kinglake National Park, Kinglake, VIC, Australia",
+        "Mount Macedon, VIC, Australia",
+        "Plenty Gorge Park, South Morang, VIC, Australia"
+    ]
+    names = [address.split(",")[0] for address in addresses]
+    filler = "the crews and locals near road were out this afternoon watching what happens next with the weather".split()
+    tweets = []
+    for i in range(count):
+        words = random.sample(filler, 14)
+        # a quarter mention a location, half of those with a disaster keyword
+        if i % 4 == 0:
+            words.insert(random.randrange(len(words)), random.choice(names))
+            if i % 8 == 0:
+                words.insert(random.randrange(len(words)), random.choice(DISASTER_KEYWORDS).rstrip("*") + "s")
+        tweets.append({
+            "username": f"user{i % 5000}",
+            "content": " ".join(words),
+            "date-time posted": f"2025-01-22T{(i * 6 // count):02d}:{i % 60:02d}:00Z"
+        })
+    chars = sum(len(tweet["content"]) for tweet in tweets) / count
+
+    started = time.perf_counter()
+    matcher = location_matcher(addresses)
+    print(f"automaton over {len(addresses)} locations built in {(time.perf_counter() - started) * 1000:.1f}ms")
+    started = time.perf_counter()
+    for batch in range(0, count, 1000):
+        matcher.scan(tweets[batch:batch + 1000])
+    elapsed = time.perf_counter() - started
+    print(f"{count} tweets ({chars:.0f} chars each) in {elapsed:.2f}s: {count / elapsed:,.0f} tweets/s")
+    print(sum(1 for record in matcher.records() if record["status"] == "dangerous"), "of", len(addresses), "locations dangerous")
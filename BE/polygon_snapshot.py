@@ -0,0 +1,391 @@
+"""
+Columnar representation of reduced danger/prediction zones.
+
+All ring coordinates live in one contiguous float64 (n, 2) array of [longitude, latitude]
+points. `ring_offsets` slices that array into rings and `zone_offsets` slices the rings
+into zones, so zone i is rings zone_offsets[i]:zone_offsets[i+1] and ring j is points
+ring_offsets[j]:ring_offsets[j+1]. Per-zone attributes are kept as columns.
+
+Encodings are produced straight from those buffers:
+    to_json    : the nested [[[[lon, lat], ...], ...], ...] list the endpoints have always served
+    to_geojson : a GeoJSON FeatureCollection, one MultiPolygon feature per zone with its attributes
+    to_binary  : header + offset arrays + float64 (or quantized int32) coordinates + attribute JSON
+    to_tile    : the zones intersecting a web-mercator tile, in int32 tile pixel coordinates
+The JSON encodings write coordinates with numpy as text to 1e-7 degrees (~1cm, the precision
+Nominatim gives boundaries in) rather than formatting a Python float per number.
+
+    python polygon_snapshot.py [zones]   # memory and serialization benchmark against nested lists
+"""
+
+import json
+import math
+import struct
+import numpy
+import shapely
+
+MAGIC = b"PLRS"
+VERSION = 1
+# header: magic, version, flags, zones, rings, points, attribute bytes
+HEADER = struct.Struct("<4sHHIIII")
+FLAG_QUANTIZED = 1
+FLAG_TILE = 2
+# 1e-7 degrees (~1cm) per unit keeps longitudes within int32
+QUANTIZE_SCALE = 1e7
+# coordinates in the JSON encodings are written to 1e-7 degrees, up to +-999.9999999
+DECIMALS = 7
+SPACE, MINUS, DOT = b" -."
+
+
+def digit_table(width, trim=None):
+    """
+    Outputs:
+        (10 ** width, width) uint8 array of each number's zero-padded digits, with its
+        "leading" zeros (but the last digit) or "trailing" zeros (all of them for 0) as spaces
+    """
+    table = numpy.frombuffer("".join(f"{i:0{width}d}" for i in range(10 ** width)).encode(), dtype=numpy.uint8)
+    table = table.reshape(-1, width).copy()
+    zeros = table == ord("0")
+    if trim == "leading":
+        table[:, :-1][numpy.cumprod(zeros[:, :-1], axis=1).astype(bool)] = SPACE
+    elif trim == "trailing":
+        table[numpy.cumprod(zeros[:, ::-1], axis=1)[:, ::-1].astype(bool)] = SPACE
+    return table
+
+
+def word_table(prefixes, digits):
+    """
+    Outputs:
+        uint32 array of 4-character words: every prefix character before every row of digits
+    """
+    words = numpy.empty((len(prefixes), len(digits), 4), dtype=numpy.uint8)
+    words[:, :, 0] = numpy.frombuffer(prefixes, dtype=numpy.uint8)[:, None]
+    words[:, :, 1:] = digits
+    return words.reshape(-1, 4).copy().view(numpy.uint32).ravel()
+
+
+# a number is three words looked up by value: the sign and integer part ("-144", "  -1"),
+# the point and the first 3 decimals (".9", ".001"), and the last 4 decimals ("05", "    ")
+WHOLE = word_table(b" ", digit_table(3, "leading"))
+NEGATIVE = WHOLE.view(numpy.uint8).reshape(-1, 4).copy()
+NEGATIVE[numpy.arange(1000), (NEGATIVE == SPACE).sum(axis=1) - 1] = MINUS
+WHOLE = numpy.concatenate((WHOLE, NEGATIVE.view(numpy.uint32).ravel()))
+# the first 3 decimals keep their trailing zeros unless the last 4 are all zero (and always the first)
+POINT = numpy.concatenate((word_table(b".", digit_table(3)), word_table(b".", digit_table(3, "trailing"))))
+POINT[1000] = numpy.frombuffer(b".0  ", dtype=numpy.uint32)[0]
+FRACTION = digit_table(4, "trailing").copy().view(numpy.uint32).ravel()
+# characters in each word once its spaces are dropped
+WHOLE_LENGTH, POINT_LENGTH, FRACTION_LENGTH = (
+    (table.view(numpy.uint8).reshape(-1, 4) != SPACE).sum(axis=1) for table in (WHOLE, POINT, FRACTION)
+)
+
+
+def format_numbers(values):
+    """
+    Write numbers as JSON text to DECIMALS places, without trailing zeros (at least one decimal)
+    Outputs:
+        (len(values), 12) uint8 array of each number's characters, padded with spaces,
+        and the number of characters that are not padding
+    """
+    scaled = numpy.round(numpy.asarray(values, dtype=numpy.float64) * 10 ** DECIMALS)
+    if not numpy.isfinite(scaled).all():
+        raise ValueError("Coordinates must be finite to encode as JSON")
+    magnitude = numpy.abs(scaled).astype(numpy.int64)
+    whole, frac = numpy.divmod(magnitude, 10 ** DECIMALS)
+    if (whole >= 1000).any():
+        raise ValueError("Coordinates must be below 1000 to encode as JSON")
+    high, low = numpy.divmod(frac, 10000)
+
+    whole += 1000 * (scaled < 0)
+    high += 1000 * (low == 0)
+    words = numpy.empty((len(magnitude), 3), dtype=numpy.uint32)
+    words[:, 0], words[:, 1], words[:, 2] = WHOLE[whole], POINT[high], FRACTION[low]
+    return words.view(numpy.uint8), WHOLE_LENGTH[whole] + POINT_LENGTH[high] + FRACTION_LENGTH[low]
+
+
+class polygon_snapshot():
+    def __init__(self, coords, ring_offsets, zone_offsets, attributes=None):
+        """
+        Args:
+            coords : (n, 2) float64 array of [longitude, latitude]
+            ring_offsets : int64 array of length rings + 1 into coords
+            zone_offsets : int64 array of length zones + 1 into rings
+            attributes : dict of column name -> list/array with one value per zone
+        """
+        self.coords = numpy.ascontiguousarray(coords, dtype=numpy.float64).reshape(-1, 2)
+        self.ring_offsets = numpy.ascontiguousarray(ring_offsets, dtype=numpy.int64)
+        self.zone_offsets = numpy.ascontiguousarray(zone_offsets, dtype=numpy.int64)
+        self.attributes = attributes or {}
+        self.__encoded = {}
+
+    def __len__(self):
+        return len(self.zone_offsets) - 1
+
+    @property
+    def empty(self):
+        return len(self) == 0
+
+    @classmethod
+    def from_rings(cls, zones, attributes=None):
+        """
+        Build from per-zone lists of rings, each ring an (m, 2) array-like of [longitude, latitude]
+        """
+        rings = [numpy.asarray(ring, dtype=numpy.float64).reshape(-1, 2) for zone in zones for ring in zone]
+        ring_offsets = numpy.zeros(len(rings) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(ring) for ring in rings], out=ring_offsets[1:])
+        zone_offsets = numpy.zeros(len(zones) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(zone) for zone in zones], out=zone_offsets[1:])
+        coords = numpy.concatenate(rings) if rings else numpy.empty((0, 2), dtype=numpy.float64)
+        return cls(coords, ring_offsets, zone_offsets, attributes)
+
+    @classmethod
+    def from_binary(cls, buf):
+        """
+        Read a `to_binary` buffer; offsets and float64 coordinates are views on `buf`, not copies
+        """
+        magic, version, flags, zones, rings, points, attr_len = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a polygon snapshot buffer")
+        pos = HEADER.size
+        zone_offsets = numpy.frombuffer(buf, dtype="<i4", count=zones + 1, offset=pos)
+        pos += zone_offsets.nbytes
+        ring_offsets = numpy.frombuffer(buf, dtype="<i4", count=rings + 1, offset=pos)
+        pos += ring_offsets.nbytes
+        if flags & (FLAG_QUANTIZED | FLAG_TILE):
+            raw = numpy.frombuffer(buf, dtype="<i4", count=points * 2, offset=pos)
+            coords = raw / QUANTIZE_SCALE if flags & FLAG_QUANTIZED else raw.astype(numpy.float64)
+        else:
+            coords = numpy.frombuffer(buf, dtype="<f8", count=points * 2, offset=pos)
+        pos += points * 2 * (4 if flags & (FLAG_QUANTIZED | FLAG_TILE) else 8)
+        attributes = json.loads(bytes(buf[pos:pos + attr_len])) if attr_len else {}
+        return cls(coords, ring_offsets, zone_offsets, attributes)
+
+    def to_nested(self):
+        """
+        Outputs:
+            the nested list format (list of zones, each a list of rings of [lon, lat] points)
+        """
+        points = self.coords.tolist()
+        rings = [points[a:b] for a, b in zip(self.ring_offsets[:-1].tolist(), self.ring_offsets[1:].tolist())]
+        return [rings[a:b] for a, b in zip(self.zone_offsets[:-1].tolist(), self.zone_offsets[1:].tolist())]
+
+    def __rings(self):
+        """
+        Outputs:
+            list of every ring as JSON bytes ("[[lon,lat],...]"), written from the coordinate buffer
+        """
+        n = len(self.coords)
+        numbers, lengths = format_numbers(self.coords.ravel())
+        width = numbers.shape[1]
+        # "[lon,lat]," per point, then the padding dropped
+        points = numpy.empty((n, 2 * width + 4), dtype=numpy.uint8)
+        points[:, 0], points[:, 1 + width], points[:, -2], points[:, -1] = b"[,],"
+        points[:, 1:1 + width], points[:, 2 + width:-2] = numbers[0::2], numbers[1::2]
+        text = points.tobytes().translate(None, b" ")
+        ends = numpy.zeros(n + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths.reshape(n, 2).sum(axis=1) + 4, out=ends[1:])
+        starts, stops = ends[self.ring_offsets[:-1]].tolist(), ends[self.ring_offsets[1:]].tolist()
+        # each ring's points run up to the separator after its last point
+        return [b"[" + text[a:max(a, b - 1)] + b"]" for a, b in zip(starts, stops)]
+
+    def __zones(self):
+        return zip(self.zone_offsets[:-1].tolist(), self.zone_offsets[1:].tolist())
+
+    def to_json(self):
+        """
+        Outputs:
+            the nested list format as JSON bytes (encoded once per snapshot)
+        """
+        if "json" not in self.__encoded:
+            rings = self.__rings()
+            self.__encoded["json"] = b"[" + b",".join(b"[" + b",".join(rings[a:b]) + b"]" for a, b in self.__zones()) + b"]"
+        return self.__encoded["json"]
+
+    def to_geojson(self):
+        """
+        Outputs:
+            GeoJSON FeatureCollection bytes with one feature per zone: a MultiPolygon of its rings
+            (each a polygon of its own, as in to_shapely; rings under 3 points are left out) and
+            the zone's attributes as properties
+        """
+        if "geojson" not in self.__encoded:
+            rings = self.__rings()
+            long_enough = (numpy.diff(self.ring_offsets) >= 3).tolist()
+            names = list(self.attributes)
+            columns = [list(self.attributes[name]) for name in names]
+            features = []
+            for i, (a, b) in enumerate(self.__zones()):
+                properties = json.dumps(
+                    {name: column[i] for name, column in zip(names, columns)},
+                    ensure_ascii=False, separators=(",", ":"), default=str,
+                ).encode("utf-8")
+                features.append(
+                    b'{"type":"Feature","properties":' + properties
+                    + b',"geometry":{"type":"MultiPolygon","coordinates":['
+                    + b",".join(b"[" + rings[j] + b"]" for j in range(a, b) if long_enough[j]) + b"]}}"
+                )
+            self.__encoded["geojson"] = b'{"type":"FeatureCollection","features":[' + b",".join(features) + b"]}"
+        return self.__encoded["geojson"]
+
+    def to_shapely(self):
+        """
+        Outputs:
+            (polygons, zone) : numpy array of one shapely Polygon per ring with at least 3 distinct points,
+                               and the index of the zone each polygon belongs to
+        """
+        starts, ends = self.ring_offsets[:-1], self.ring_offsets[1:]
+        ring_lengths = ends - starts
+        keep = numpy.flatnonzero(ring_lengths >= 3)
+        # a closed 3-point ring only has 2 distinct points; open ones are closed by shapely
+        keep = keep[(ring_lengths[keep] > 3) | (self.coords[starts[keep]] != self.coords[ends[keep] - 1]).any(axis=1)]
+        ring_zone = numpy.repeat(numpy.arange(len(self)), numpy.diff(self.zone_offsets))
+        if not len(keep):
+            return numpy.empty(0, dtype=object), numpy.empty(0, dtype=numpy.int64)
+        point_idx = numpy.concatenate([numpy.arange(self.ring_offsets[i], self.ring_offsets[i + 1]) for i in keep])
+        rings = shapely.linearrings(self.coords[point_idx], indices=numpy.repeat(numpy.arange(len(keep)), ring_lengths[keep]))
+        return shapely.polygons(rings), ring_zone[keep]
+
+    def to_binary(self, quantize=False):
+        """
+        Args:
+            quantize : store coordinates as int32 multiples of 1e-7 degrees instead of float64
+        Outputs:
+            bytes: header, int32 zone offsets, int32 ring offsets, little-endian coordinates, attribute JSON
+        """
+        if quantize:
+            coords = numpy.round(self.coords * QUANTIZE_SCALE).astype("<i4")
+        else:
+            coords = self.coords.astype("<f8", copy=False)
+        return self.__pack(coords, self.ring_offsets, self.zone_offsets, self.attributes, FLAG_QUANTIZED if quantize else 0)
+
+    def bounds(self):
+        """
+        Outputs:
+            (zones, 4) array of [west, south, east, north] per zone
+        """
+        if self.empty:
+            return numpy.empty((0, 4))
+        zone_points = self.ring_offsets[self.zone_offsets]
+        starts = zone_points[:-1]
+        # zones without points keep NaN bounds; the others' points run up to the next such start
+        valid = starts < zone_points[1:]
+        out = numpy.full((len(self), 4), numpy.nan)
+        if valid.any():
+            idx = starts[valid]
+            out[valid, 0:2] = numpy.minimum.reduceat(self.coords, idx)
+            out[valid, 2:4] = numpy.maximum.reduceat(self.coords, idx)
+        return out
+
+    def to_tile(self, z, x, y, extent=4096):
+        """
+        Encode the zones whose bounds intersect web-mercator tile z/x/y
+        Outputs:
+            `to_binary` layout with FLAG_TILE set, coordinates as int32 pixels in [0, extent) of the tile
+            (zones are not clipped to the tile)
+        """
+        n = 2.0 ** z
+        west, east = x / n * 360.0 - 180.0, (x + 1) / n * 360.0 - 180.0
+        north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+        south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+
+        box = self.bounds()
+        hit = numpy.flatnonzero(
+            (box[:, 0] <= east) & (box[:, 2] >= west) & (box[:, 1] <= north) & (box[:, 3] >= south)
+        )
+
+        # gather the rings and points of the selected zones
+        ring_starts, ring_ends = self.zone_offsets[hit], self.zone_offsets[hit + 1]
+        ring_idx = numpy.concatenate([numpy.arange(a, b) for a, b in zip(ring_starts, ring_ends)]) if len(hit) else numpy.empty(0, dtype=numpy.int64)
+        point_starts, point_ends = self.ring_offsets[ring_idx], self.ring_offsets[ring_idx + 1]
+        lengths = point_ends - point_starts
+        point_idx = numpy.repeat(point_starts - numpy.concatenate(([0], numpy.cumsum(lengths)[:-1])), lengths) + numpy.arange(lengths.sum())
+        coords = self.coords[point_idx]
+
+        # project to tile pixels
+        px = (coords[:, 0] + 180.0) / 360.0 * n
+        lat = numpy.radians(numpy.clip(coords[:, 1], -85.05112878, 85.05112878))
+        py = (1.0 - numpy.log(numpy.tan(lat) + 1.0 / numpy.cos(lat)) / math.pi) / 2.0 * n
+        pixels = numpy.empty((len(coords), 2), dtype="<i4")
+        pixels[:, 0] = numpy.round((px - x) * extent)
+        pixels[:, 1] = numpy.round((py - y) * extent)
+
+        ring_offsets = numpy.concatenate(([0], numpy.cumsum(lengths)))
+        zone_offsets = numpy.concatenate(([0], numpy.cumsum(ring_ends - ring_starts)))
+        attributes = {name: [column[i] for i in hit.tolist()] for name, column in self.attributes.items()}
+        return self.__pack(pixels, ring_offsets, zone_offsets, attributes, FLAG_TILE)
+
+    @staticmethod
+    def __pack(coords, ring_offsets, zone_offsets, attributes, flags):
+        attr = json.dumps(attributes, separators=(",", ":"), default=str).encode("utf-8") if attributes else b""
+        header = HEADER.pack(MAGIC, VERSION, flags, len(zone_offsets) - 1, len(ring_offsets) - 1, len(coords), len(attr))
+        return b"".join((
+            header,
+            numpy.asarray(zone_offsets, dtype="<i4").tobytes(),
+            numpy.asarray(ring_offsets, dtype="<i4").tobytes(),
+            numpy.ascontiguousarray(coords).tobytes(),
+            attr
+        ))
+
+
+if __name__ == "__main__":
+    # memory and serialization benchmark against the nested lists of tuples reduce() used to return
+    import sys
+    import time
+    import tracemalloc
+
+    zones = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rng = numpy.random.default_rng(0)
+    shapes = []
+    for _ in range(zones):
+        rings = []
+        for _ in range(rng.integers(1, 4)):
+            n = int(rng.integers(20, 200))
+            angles = numpy.sort(rng.random(n)) * 2 * numpy.pi
+            ring = rng.random(2) * [10, 5] + [140, -39] + 0.01 * numpy.stack((numpy.cos(angles), numpy.sin(angles)), axis=1)
+            # boundaries arrive from Nominatim to 7 decimals
+            rings.append(numpy.round(numpy.vstack((ring, ring[:1])), 7))
+        shapes.append(rings)
+    names = [f"zone {i}, Victoria, Australia" for i in range(zones)]
+
+    def measure(build):
+        tracemalloc.start()
+        value = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return value, size
+
+    nested, nested_size = measure(lambda: [[[tuple(point) for point in ring.tolist()] for ring in zone] for zone in shapes])
+    columnar, columnar_size = measure(lambda: polygon_snapshot.from_rings(shapes, {"display_name": names}))
+    points = len(columnar.coords)
+    print(f"{zones} zones, {len(columnar.ring_offsets) - 1} rings, {points} points")
+    print(f"memory: nested lists {nested_size / 1e6:.1f} MB, polygon_snapshot {columnar_size / 1e6:.1f} MB")
+
+    def fresh():
+        # encodings are kept per instance, so time a new view on the same buffers each run
+        return polygon_snapshot(columnar.coords, columnar.ring_offsets, columnar.zone_offsets, columnar.attributes)
+
+    def nested_geojson():
+        return json.dumps({"type": "FeatureCollection", "features": [
+            {"type": "Feature", "properties": {"display_name": name},
+             "geometry": {"type": "MultiPolygon", "coordinates": [[ring] for ring in zone]}}
+            for zone, name in zip(nested, names)
+        ]}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    encoders = [
+        ("nested lists -> JSON (JSONResponse)", lambda: json.dumps(nested, separators=(",", ":")).encode("utf-8")),
+        ("nested lists -> GeoJSON", nested_geojson),
+        ("polygon_snapshot.to_json", lambda: fresh().to_json()),
+        ("polygon_snapshot.to_geojson", lambda: fresh().to_geojson()),
+        ("polygon_snapshot.to_binary", lambda: fresh().to_binary()),
+    ]
+    for label, encode in encoders:
+        encode()
+        runs = []
+        for _ in range(5):
+            started = time.perf_counter()
+            out = encode()
+            runs.append(time.perf_counter() - started)
+        best = min(runs)
+        print(f"{label:<38} {best * 1000:8.1f} ms  {points / best / 1e6:6.2f} M points/s  {len(out) / 1e6:6.1f} MB")
+
+    assert json.loads(columnar.to_json()) == json.loads(encoders[0][1]())
+    assert json.loads(columnar.to_geojson()) == json.loads(nested_geojson())
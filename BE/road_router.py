@@ -0,0 +1,455 @@
+"""
+Evacuation routing on the region's drivable road graph.
+
+The graph is downloaded with osmnx once, by one worker under a lock file, and cached
+as compressed-sparse-row arrays (`node_x`, `node_y`, `indptr`, `indices`, `weights` in
+metres) plus a longitude-sorted node index in ROAD_GRAPH_DIR. Every worker memory-maps
+those files and searches them as stored, so the graph is held in memory once however
+many workers serve routes. Each time a danger or prediction snapshot is published the
+edges crossing its zones are marked (a per-worker bool per edge), and routes are found
+with A* over the marked graph, computing the heuristic only for the nodes the search
+reaches. Marked edges are not removed but cost ROUTE_HAZARD_PENALTY times their length,
+so a route only enters a zone when it starts or ends inside one or no other road exists.
+A search gives up after ROUTE_MAX_EXPANSIONS nodes, so no single query holds a thread (and the
+GIL) for long: trips that need more, typically long ones forced through a zone, whose penalty
+leaves the straight-line heuristic far below their cost, are refused rather than searched.
+"""
+
+import os
+import math
+import heapq
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy
+import shapely
+try:
+    import fcntl
+except ImportError:
+    # no flock (Windows): concurrent first starts may each build the graph
+    fcntl = None
+
+ROAD_GRAPH_DIR = os.getenv("ROAD_GRAPH_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "road_graph"))
+ROAD_PLACE = os.getenv("ROAD_PLACE", "Victoria, Australia")
+ROUTE_HAZARD_PENALTY = float(os.getenv("ROUTE_HAZARD_PENALTY", "1000"))
+# furthest (metres) a route end may be from the nearest road node
+ROUTE_SNAP_DISTANCE = float(os.getenv("ROUTE_SNAP_DISTANCE", "2000"))
+ROUTE_CACHE_SIZE = int(os.getenv("ROUTE_CACHE_SIZE", "1024"))
+# nodes one search may expand (about half a second of search on a dense street grid)
+ROUTE_MAX_EXPANSIONS = int(os.getenv("ROUTE_MAX_EXPANSIONS", "100000"))
+
+ARRAYS = ("node_x", "node_y", "indptr", "indices", "weights")
+# nodes in longitude order, and the largest lon/lat extent of any edge (see build_index)
+INDEX = ("x_order", "x_sorted", "edge_span")
+EARTH_RADIUS = 6371008.8
+# metres per degree of latitude
+METRES_PER_DEGREE = 111195.0
+
+
+class route_too_long(RuntimeError):
+    """
+    The search expanded ROUTE_MAX_EXPANSIONS nodes without reaching the goal
+    """
+
+
+# cached in place of a route the search gave up on
+TOO_LONG = object()
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """
+    Great-circle distance in metres (osmnx edge lengths are never shorter, so A* stays exact)
+    """
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def haversine_many(lon, lat, lons, lats):
+    """
+    haversine between a point (or array of points) and an array of points
+    """
+    lon, lat = numpy.radians(lon), numpy.radians(lat)
+    lons, lats = numpy.radians(lons), numpy.radians(lats)
+    a = numpy.sin((lats - lat) / 2) ** 2 + numpy.cos(lat) * numpy.cos(lats) * numpy.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.minimum(1.0, numpy.sqrt(a)))
+
+
+def build_index(node_x, node_y, indptr, indices):
+    """
+    Outputs:
+        (x_order, x_sorted, edge_span) : nodes sorted by longitude and their longitudes, for box and
+                                         nearest-node lookups; [max lon extent, max lat extent] of any edge
+    """
+    x_order = numpy.argsort(node_x, kind="stable")
+    src = numpy.repeat(numpy.arange(len(node_x)), numpy.diff(indptr))
+    edge_span = numpy.array([
+        numpy.abs(node_x[indices] - node_x[src]).max(initial=0.0),
+        numpy.abs(node_y[indices] - node_y[src]).max(initial=0.0)
+    ])
+    return x_order, numpy.asarray(node_x)[x_order], edge_span
+
+
+def build_graph(place=ROAD_PLACE, path=ROAD_GRAPH_DIR):
+    """
+    Download the drivable road graph of `place` and save it as CSR arrays in `path`
+    (parallel edges keep the shortest)
+    """
+    import osmnx as ox
+
+    graph = ox.graph_from_place(place, network_type="drive")
+    ids = list(graph.nodes)
+    position = {node: i for i, node in enumerate(ids)}
+    node_x = numpy.array([graph.nodes[node]["x"] for node in ids], dtype=numpy.float64)
+    node_y = numpy.array([graph.nodes[node]["y"] for node in ids], dtype=numpy.float64)
+
+    lengths = {}
+    for u, v, data in graph.edges(data=True):
+        key = (position[u], position[v])
+        lengths[key] = min(lengths.get(key, math.inf), float(data.get("length", 0.0)))
+    src = numpy.array([u for u, _ in lengths], dtype=numpy.int64)
+    dst = numpy.array([v for _, v in lengths], dtype=numpy.int64)
+    weights = numpy.array(list(lengths.values()), dtype=numpy.float64)
+
+    order = numpy.argsort(src, kind="stable")
+    indptr = numpy.zeros(len(ids) + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(src, minlength=len(ids)), out=indptr[1:])
+
+    os.makedirs(path, exist_ok=True)
+    arrays = {"node_x": node_x, "node_y": node_y, "indptr": indptr, "indices": dst[order], "weights": weights[order]}
+    for name, array in arrays.items():
+        numpy.save(os.path.join(path, f"{name}.npy"), array)
+
+
+def write_index(path):
+    """
+    Save build_index of the graph in `path` beside it, each file replaced whole
+    """
+    arrays = [numpy.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ("node_x", "node_y", "indptr", "indices")]
+    for name, array in zip(INDEX, build_index(*arrays)):
+        scratch = os.path.join(path, f".{name}.npy")
+        numpy.save(scratch, array)
+        os.replace(scratch, os.path.join(path, f"{name}.npy"))
+
+
+def cached(path, names):
+    return all(os.path.exists(os.path.join(path, f"{name}.npy")) for name in names)
+
+
+def ensure_graph(path=ROAD_GRAPH_DIR, place=ROAD_PLACE):
+    """
+    Make sure `path` holds the complete graph and index, building whatever is missing.
+    Workers take a lock file beside `path` first, so one builds while the others wait;
+    a new graph is built in a scratch directory and renamed into place whole.
+    """
+    if cached(path, ARRAYS + INDEX):
+        return
+    path = os.path.abspath(path)
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        # another worker may have finished while this one waited
+        if cached(path, ARRAYS + INDEX):
+            return
+        if cached(path, ARRAYS):
+            # caches written before the index existed
+            write_index(path)
+            return
+
+        print(f"\n>>>\tbuilding road graph for {place}. . .")
+        scratch = tempfile.mkdtemp(prefix=".road_graph-", dir=parent)
+        try:
+            build_graph(place, scratch)
+            write_index(scratch)
+            try:
+                # replaces `path` if it is missing or empty
+                os.rename(scratch, path)
+            except OSError:
+                # e.g. a mount point or a half-written older cache: move the files in one by one,
+                # each replaced whole, the index last
+                os.makedirs(path, exist_ok=True)
+                for name in ARRAYS + INDEX:
+                    os.replace(os.path.join(scratch, f"{name}.npy"), os.path.join(path, f"{name}.npy"))
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+class road_router():
+    def __init__(self, node_x, node_y, indptr, indices, weights, x_order=None, x_sorted=None, edge_span=None, penalty=ROUTE_HAZARD_PENALTY, cache_size=ROUTE_CACHE_SIZE, max_expansions=ROUTE_MAX_EXPANSIONS):
+        """
+        Args:
+            node_x, node_y : longitude and latitude of every node
+            indptr, indices, weights : CSR adjacency; node i's edges are indptr[i]:indptr[i+1]
+            x_order, x_sorted, edge_span : spatial index (see build_index), computed here if not given
+            penalty : factor applied to the length of edges crossing a zone
+            cache_size : routes remembered until the zones next change
+            max_expansions : nodes one search may expand before it gives up
+        """
+        # plain ndarray views of the (memory-mapped) arrays; memmap's own indexing is slow in the search loop
+        node_x, node_y, indptr, indices, weights = (numpy.asarray(a_) for a_ in (node_x, node_y, indptr, indices, weights))
+        self.node_x, self.node_y = node_x, node_y
+        self.indptr, self.indices, self.weights = indptr, indices, weights
+        if x_order is None:
+            x_order, x_sorted, edge_span = build_index(node_x, node_y, indptr, indices)
+        self.x_order, self.x_sorted, self.edge_span = numpy.asarray(x_order), numpy.asarray(x_sorted), tuple(numpy.asarray(edge_span).tolist())
+        self.penalty = penalty
+        self.cache_size = cache_size
+        self.max_expansions = max_expansions
+        # the arrays above may be memory-mapped and shared between workers; only the marks are per worker
+        self.blocked = numpy.zeros(len(indices), dtype=bool)
+        self.__any_blocked = False
+
+        self.__cache = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.node_x)
+
+    @classmethod
+    def load(cls, path=ROAD_GRAPH_DIR, place=ROAD_PLACE):
+        """
+        Memory-map the cached graph in `path`, downloading `place` first if there is none
+        """
+        ensure_graph(path, place)
+        return cls(*(numpy.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ARRAYS + INDEX))
+
+    def nodes_within(self, west, south, east, north):
+        """
+        Outputs:
+            indices of the nodes inside the bounding box
+        """
+        lo, hi = numpy.searchsorted(self.x_sorted, west, side="left"), numpy.searchsorted(self.x_sorted, east, side="right")
+        candidates = numpy.asarray(self.x_order[lo:hi])
+        y = self.node_y[candidates]
+        return candidates[(y >= south) & (y <= north)]
+
+    def edges_from(self, nodes):
+        """
+        Outputs:
+            (edges, src) : indices of every edge leaving `nodes`, and the node each leaves from
+        """
+        starts, ends = self.indptr[nodes], self.indptr[numpy.asarray(nodes) + 1]
+        lengths = ends - starts
+        firsts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+        edges = numpy.repeat(starts - firsts, lengths) + numpy.arange(lengths.sum())
+        return edges, numpy.repeat(nodes, lengths)
+
+    def update_hazards(self, *snapshots):
+        """
+        Mark the edges crossing any zone of the given polygon_snapshots, replacing the previous marks
+        Outputs:
+            number of marked edges
+        """
+        polygons = [snapshot.to_shapely()[0] for snapshot in snapshots]
+        polygons = numpy.concatenate(polygons) if polygons else numpy.empty(0, dtype=object)
+        blocked = numpy.zeros(len(self.indices), dtype=bool)
+        span_x, span_y = self.edge_span
+        for polygon, (west, south, east, north) in zip(polygons, shapely.bounds(polygons)):
+            # an edge reaching into the zone starts within one edge span of its bounding box
+            edges, src = self.edges_from(self.nodes_within(west - span_x, south - span_y, east + span_x, north + span_y))
+            dst = self.indices[edges]
+            x0, y0, x1, y1 = self.node_x[src], self.node_y[src], self.node_x[dst], self.node_y[dst]
+            near = (numpy.minimum(x0, x1) <= east) & (numpy.maximum(x0, x1) >= west) & (numpy.minimum(y0, y1) <= north) & (numpy.maximum(y0, y1) >= south)
+            # edges are masked as straight segments between their end nodes
+            segments = shapely.linestrings(numpy.stack((x0[near], y0[near], x1[near], y1[near]), axis=1).reshape(-1, 2, 2))
+            blocked[edges[near][shapely.intersects(segments, polygon)]] = True
+
+        # searches already running keep the marks they started with
+        with self.__lock:
+            self.blocked, self.__any_blocked = blocked, bool(blocked.any())
+            self.__cache.clear()
+        return int(blocked.sum())
+
+    def nearest(self, lon, lat):
+        """
+        Outputs:
+            index of the road node nearest to lon/lat, or None if it is beyond ROUTE_SNAP_DISTANCE
+        """
+        dlat = ROUTE_SNAP_DISTANCE / METRES_PER_DEGREE
+        dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+        nodes = self.nodes_within(lon - dlon, lat - dlat, lon + dlon, lat + dlat)
+        if not len(nodes):
+            return None
+        distance = haversine_many(lon, lat, self.node_x[nodes], self.node_y[nodes])
+        best = int(numpy.argmin(distance))
+        if distance[best] > ROUTE_SNAP_DISTANCE:
+            return None
+        return int(nodes[best])
+
+    def route(self, from_lon, from_lat, to_lon, to_lat):
+        """
+        Outputs:
+            {"coordinates": [[lon, lat], ...], "distance": metres, "crosses_danger": bool},
+            or None if either end is off the road network or no road connects them;
+            raises route_too_long if the search gives up first
+        """
+        start, goal = self.nearest(from_lon, from_lat), self.nearest(to_lon, to_lat)
+        if start is None or goal is None:
+            return None
+
+        with self.__lock:
+            blocked, any_blocked, cache = self.blocked, self.__any_blocked, self.__cache
+            hit = (start, goal) in cache
+            if hit:
+                cache.move_to_end((start, goal))
+                result = cache[(start, goal)]
+
+        if not hit:
+            try:
+                path = self.astar(start, goal, blocked if any_blocked else None)
+            except route_too_long:
+                # remembered like a route, so repeating the query doesn't repeat the search
+                path = result = TOO_LONG
+            if path is None:
+                result = None
+            elif path is not TOO_LONG:
+                nodes, edges = path
+                result = {
+                    "coordinates": numpy.column_stack((self.node_x[nodes], self.node_y[nodes])).tolist(),
+                    "distance": float(self.weights[edges].sum()) if edges else 0.0,
+                    "crosses_danger": bool(blocked[edges].any()) if edges else False
+                }
+
+            with self.__lock:
+                # only cache against the marks the route was searched with
+                if cache is self.__cache and blocked is self.blocked:
+                    cache[(start, goal)] = result
+                    if len(cache) > self.cache_size:
+                        cache.popitem(last=False)
+
+        if result is TOO_LONG:
+            raise route_too_long(f"no route within {self.max_expansions} nodes")
+        return result
+
+    def astar(self, start, goal, blocked=None):
+        """
+        A* from node `start` to node `goal`, over the CSR arrays as stored
+        Args:
+            blocked : bool mask of edges costing `penalty` times their length, or None
+        Outputs:
+            (nodes, edges) along the cheapest path, or None if `goal` is unreachable;
+            raises route_too_long after expanding `max_expansions` nodes
+        """
+        indptr, indices, weights = self.indptr, self.indices, self.weights
+        x_at, y_at = self.node_x.item, self.node_y.item
+        penalty, expansions = self.penalty, self.max_expansions
+        sin, cos, asin, sqrt, radians = math.sin, math.cos, math.asin, math.sqrt, math.radians
+        goal_lon, goal_lat = radians(x_at(goal)), radians(y_at(goal))
+        cos_goal = cos(goal_lat)
+
+        def heuristic(node):
+            # haversine to the goal, inlined
+            lat = radians(y_at(node))
+            a = sin((lat - goal_lat) / 2) ** 2 + cos_goal * cos(lat) * sin((radians(x_at(node)) - goal_lon) / 2) ** 2
+            return 2 * EARTH_RADIUS * asin(min(1.0, sqrt(a)))
+
+        best = {start: 0.0}
+        came_from = {start: (None, None)}
+        # the heuristic is only computed for the nodes the search reaches
+        queue = [(heuristic(start), 0.0, start)]
+        remaining = {}
+        while queue:
+            _, cost, node = heapq.heappop(queue)
+            if node == goal:
+                break
+            if cost > best[node]:
+                continue
+            expansions -= 1
+            if expansions < 0:
+                raise route_too_long(f"no route within {self.max_expansions} nodes")
+            first, last = indptr[node:node + 2].tolist()
+            costs = weights[first:last].tolist()
+            if blocked is not None:
+                costs = [c_ * penalty if b_ else c_ for c_, b_ in zip(costs, blocked[first:last].tolist())]
+            for edge, nxt, edge_cost in zip(range(first, last), indices[first:last].tolist(), costs):
+                nxt_cost = cost + edge_cost
+                if nxt_cost < best.get(nxt, math.inf):
+                    best[nxt] = nxt_cost
+                    came_from[nxt] = (node, edge)
+                    h = remaining.get(nxt)
+                    if h is None:
+                        h = remaining[nxt] = heuristic(nxt)
+                    heapq.heappush(queue, (nxt_cost + h, nxt_cost, nxt))
+        else:
+            return None
+
+        nodes, edges = [goal], []
+        while came_from[nodes[-1]][0] is not None:
+            node, edge = came_from[nodes[-1]]
+            nodes.append(node)
+            edges.append(edge)
+        return nodes[::-1], edges[::-1]
+
+
+if __name__ == "__main__":
+    # throughput benchmark: python road_router.py [grid size] [routes] [zones]
+    import sys
+    import time
+    import random
+    from polygon_snapshot import polygon_snapshot
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 700
+    routes = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    zones = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    random.seed(0)
+
+    def rss_mb():
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) // 1024 for line in f if line.startswith("VmRSS:"))
+
+    # size x size street grid, 150m apart, around Melbourne
+    spacing, centre = 0.0015, (144.96, -37.81)
+    ys, xs = numpy.divmod(numpy.arange(size * size), size)
+    node_x, node_y = centre[0] + (xs - size / 2) * spacing, centre[1] + (ys - size / 2) * spacing
+    src, dst = [], []
+    for d_row, d_col in ((-1, 0), (0, -1), (0, 1), (1, 0)):
+        ok = (ys + d_row >= 0) & (ys + d_row < size) & (xs + d_col >= 0) & (xs + d_col < size)
+        src.append(numpy.flatnonzero(ok))
+        dst.append(numpy.flatnonzero(ok) + d_row * size + d_col)
+    src, dst = numpy.concatenate(src), numpy.concatenate(dst)
+    order = numpy.argsort(src, kind="stable")
+    src, dst = src[order], dst[order]
+    weights = haversine_many(node_x[src], node_y[src], node_x[dst], node_y[dst])
+    indptr = numpy.zeros(size * size + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(src, minlength=size * size), out=indptr[1:])
+
+    with tempfile.TemporaryDirectory() as path:
+        arrays = {"node_x": node_x, "node_y": node_y, "indptr": indptr, "indices": dst, "weights": weights}
+        arrays.update(zip(INDEX, build_index(node_x, node_y, indptr, dst)))
+        for name, array in arrays.items():
+            numpy.save(os.path.join(path, f"{name}.npy"), array)
+        del arrays, node_x, node_y, indptr, src, dst, weights, order
+
+        before = rss_mb()
+        started = time.perf_counter()
+        router = road_router.load(path)
+        print(f"{len(router)} nodes, {len(router.indices)} edges: loaded in {time.perf_counter() - started:.2f}s, +{rss_mb() - before} MB")
+
+        angles = numpy.linspace(0, 2 * numpy.pi, 40)
+        rings = [[numpy.column_stack((
+            centre[0] + random.uniform(-0.3, 0.3) + 0.02 * numpy.cos(angles),
+            centre[1] + random.uniform(-0.3, 0.3) + 0.02 * numpy.sin(angles)
+        ))] for _ in range(zones)]
+        started = time.perf_counter()
+        marked = router.update_hazards(polygon_snapshot.from_rings(rings))
+        print(f"marked {marked} edges crossing {zones} zones in {time.perf_counter() - started:.2f}s")
+
+        def timed(trips):
+            refused = 0
+            started = time.perf_counter()
+            for trip in trips:
+                try:
+                    router.route(*trip)
+                except route_too_long:
+                    refused += 1
+            return time.perf_counter() - started, refused
+
+        for span in (0.02, 0.1, 0.4):
+            trips = [tuple(c_ + random.uniform(-span, span) for c_ in centre * 2) for _ in range(routes)]
+            uncached, refused = timed(trips)
+            cached_s, _ = timed(trips)
+            print(f"trips within {span:.2f} deg: {routes / uncached:8.1f} routes/s uncached, {routes / cached_s:8.0f} cached, {refused} refused")
+        print(f"peak +{rss_mb() - before} MB over the memory-mapped graph")
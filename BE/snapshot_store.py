@@ -0,0 +1,451 @@
+"""
+Shared snapshot store for the serverside cycle.
+
+Every uvicorn worker opens the same SQLite file in WAL mode. One worker holds the
+`cycle` lease and runs the LLM/geocode cycle, appending a snapshot to a log indexed by
+publish time each time one of its stages finishes. Section contents are stored once, as
+pre-serialized JSON keyed by their digest (polygon sections also in the binary layout of
+`polygon_snapshot.to_binary`), and a snapshot only references them: sections a stage did
+not produce carry over by reference, and re-publishing identical content reuses its row.
+Every section keeps its own freshness timestamp. The other workers only read: they keep
+the bytes of the latest snapshot and re-read the database only when `PRAGMA data_version`
+reports a commit from another connection. Older snapshots stay on disk for `/history`
+for SNAPSHOT_RETENTION_HOURS, and sections no snapshot references go with them.
+
+Geofence subscriptions are registered here by any worker; the leader evaluates them on
+each publish and appends the alerts that changed to a log clients poll by sequence number.
+"""
+
+import os
+import json
+import time
+import hashlib
+import socket
+import sqlite3
+import threading
+from polygon_snapshot import polygon_snapshot
+
+SNAPSHOT_DB = os.getenv("SNAPSHOT_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshots.db"))
+LEASE_TTL = float(os.getenv("LEASE_TTL", "120"))
+
+# most alerts one /alerts poll returns
+ALERT_PAGE_LIMIT = int(os.getenv("ALERT_PAGE_LIMIT", "500"))
+# 0 keeps every snapshot
+SNAPSHOT_RETENTION = float(os.getenv("SNAPSHOT_RETENTION_HOURS", "168"))
+ALERT_RETENTION = float(os.getenv("ALERT_RETENTION_HOURS", "24"))
+ALERT_COLUMNS = ("seq", "subscription", "published_at", "section", "status", "zone", "distance")
+
+SECTIONS = ("polygons", "predictions", "ai_rec")
+FRESHNESS = tuple(f"{name}_at" for name in SECTIONS)
+BINARY = tuple(f"{name}_bin" for name in SECTIONS)
+COLUMNS = ("id", "published_at") + SECTIONS + FRESHNESS + BINARY
+# the snapshot row with each section's JSON and binary joined in; missing sections read as null
+SELECT_SNAPSHOT = (
+    "SELECT snapshot.id, snapshot.published_at, "
+    + ", ".join(f"coalesce({name}.json, CAST('null' AS BLOB))" for name in SECTIONS) + ", "
+    + ", ".join(f"snapshot.{name}" for name in FRESHNESS) + ", "
+    + ", ".join(f"{name}.bin" for name in SECTIONS)
+    + " FROM snapshot "
+    + " ".join(f"LEFT JOIN section AS {name} ON {name}.id = snapshot.{name}" for name in SECTIONS)
+)
+
+
+class lease_lost(RuntimeError):
+    """
+    A leader-only write was attempted after the cycle lease passed to another worker
+    """
+
+
+def encode(content):
+    """
+    Serialize content exactly as fastapi's JSONResponse would render it
+    """
+    if isinstance(content, polygon_snapshot):
+        return content.to_json()
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def snapshot_json(snapshot):
+    """
+    Join a stored snapshot into one JSON object without decoding its sections
+    """
+    head = encode({name: snapshot[name] for name in ("id", "published_at") + FRESHNESS})[:-1]
+    return head + b"".join(b',"%s":%s' % (name.encode(), snapshot[name]) for name in SECTIONS) + b"}"
+
+
+class snapshot_store():
+    def __init__(self, path=SNAPSHOT_DB, lease_ttl=LEASE_TTL):
+        self.path = path
+        self.lease_ttl = lease_ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.execute("PRAGMA synchronous=NORMAL")
+        self.__conn.execute("PRAGMA mmap_size=268435456")
+        self.__conn.execute("""
+            CREATE TABLE IF NOT EXISTS section (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                digest BLOB NOT NULL,
+                json BLOB NOT NULL,
+                bin BLOB,
+                UNIQUE (name, digest)
+            )
+        """)
+        # a null section reference means the section was never published
+        self.__conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS snapshot (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                published_at REAL NOT NULL,
+                {", ".join(f"{name} INTEGER REFERENCES section (id)" for name in SECTIONS)},
+                {", ".join(f"{name} REAL" for name in FRESHNESS)}
+            )
+        """)
+        self.__conn.execute("CREATE INDEX IF NOT EXISTS snapshot_published_at ON snapshot (published_at)")
+        # pruning looks up whether anything still references a section
+        for name in SECTIONS:
+            self.__conn.execute(f"CREATE INDEX IF NOT EXISTS snapshot_{name} ON snapshot ({name})")
+        self.__conn.execute("""
+            CREATE TABLE IF NOT EXISTS lease (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                started_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                stop INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        # points keep lon/lat columns so they load without parsing; areas are GeoJSON;
+        # state is the JSON {section: [status, zone]} the subscriber was told when subscribing
+        self.__conn.execute("""
+            CREATE TABLE IF NOT EXISTS subscription (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT NOT NULL UNIQUE,
+                lon REAL,
+                lat REAL,
+                area TEXT,
+                radius REAL NOT NULL,
+                state TEXT NOT NULL
+            )
+        """)
+        self.__conn.execute("""
+            CREATE TABLE IF NOT EXISTS alert_log (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                subscription TEXT NOT NULL,
+                published_at REAL NOT NULL,
+                section TEXT NOT NULL,
+                status TEXT NOT NULL,
+                zone TEXT,
+                distance REAL
+            )
+        """)
+        self.__conn.execute("CREATE INDEX IF NOT EXISTS alert_log_subscription ON alert_log (subscription, seq)")
+        self.__version = None
+        self.__latest = None
+
+    # LEADER LEASE
+    def acquire(self, name="cycle"):
+        """
+        Take the lease if it is free, expired or already ours.
+        A leader asked to stop keeps the lease until it releases it (or it expires), since
+        it may still be finishing its cycle; until then nobody, itself included, may take it.
+        Outputs:
+            True if this worker now holds the lease
+        """
+        now = time.time()
+        with self.__lock:
+            self.__conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.__conn.execute(
+                    "SELECT owner, expires_at, stop FROM lease WHERE name = ?", (name,)
+                ).fetchone()
+                if row is not None and row[1] > now and (row[0] != self.owner or row[2]):
+                    self.__conn.execute("ROLLBACK")
+                    return False
+                self.__conn.execute(
+                    "INSERT OR REPLACE INTO lease (name, owner, started_at, expires_at, stop) VALUES (?, ?, ?, ?, 0)",
+                    (name, self.owner, now, now + self.lease_ttl),
+                )
+                self.__conn.execute("COMMIT")
+                return True
+            except Exception:
+                self.__conn.execute("ROLLBACK")
+                raise
+
+    def holds(self, name="cycle"):
+        """
+        True if this worker still holds the lease (even if asked to stop)
+        """
+        with self.__lock:
+            return self.__holds(name)
+
+    def __holds(self, name):
+        row = self.__conn.execute("SELECT owner FROM lease WHERE name = ?", (name,)).fetchone()
+        return row is not None and row[0] == self.owner
+
+    def renew(self, name="cycle"):
+        """
+        Extend the lease while the cycle is still running
+        Outputs:
+            False if the lease was lost to another worker
+        """
+        with self.__lock:
+            cur = self.__conn.execute(
+                "UPDATE lease SET expires_at = ? WHERE name = ? AND owner = ?",
+                (time.time() + self.lease_ttl, name, self.owner),
+            )
+            return cur.rowcount == 1
+
+    def release(self, name="cycle"):
+        with self.__lock:
+            self.__conn.execute("DELETE FROM lease WHERE name = ? AND owner = ?", (name, self.owner))
+
+    def request_stop(self, name="cycle"):
+        """
+        Ask the leader (which may live in another worker) to stop after its current cycle
+        """
+        with self.__lock:
+            cur = self.__conn.execute(
+                "UPDATE lease SET stop = 1 WHERE name = ? AND expires_at > ? AND stop = 0",
+                (name, time.time()),
+            )
+            return cur.rowcount == 1
+
+    def stop_requested(self, name="cycle"):
+        with self.__lock:
+            row = self.__conn.execute(
+                "SELECT stop FROM lease WHERE name = ? AND owner = ?", (name, self.owner)
+            ).fetchone()
+        return row is None or bool(row[0])
+
+    def lease_info(self, name="cycle"):
+        """
+        Outputs:
+            (owner, started_at) of the live lease, or None if no worker is running the cycle
+        """
+        with self.__lock:
+            row = self.__conn.execute(
+                "SELECT owner, started_at FROM lease WHERE name = ? AND expires_at > ? AND stop = 0",
+                (name, time.time()),
+            ).fetchone()
+        return row
+
+    # SNAPSHOTS
+    def __section(self, name, content, binary):
+        """
+        Outputs:
+            id of the section row holding `content` (JSON bytes), added if no identical one exists;
+            `binary()` gives its binary layout and is only called for a new row
+        """
+        digest = hashlib.sha256(content).digest()
+        row = self.__conn.execute("SELECT id FROM section WHERE name = ? AND digest = ?", (name, digest)).fetchone()
+        if row is not None:
+            return row[0]
+        return self.__conn.execute(
+            "INSERT INTO section (name, digest, json, bin) VALUES (?, ?, ?, ?)", (name, digest, content, binary())
+        ).lastrowid
+
+    def __insert(self, values):
+        self.__conn.execute(
+            f"INSERT INTO snapshot ({', '.join(values)}) VALUES ({', '.join('?' * len(values))})",
+            tuple(values.values()),
+        )
+
+    def __prune(self, now):
+        """
+        Drop snapshots older than SNAPSHOT_RETENTION_HOURS (never the latest) and the
+        sections only they referenced
+        """
+        if not SNAPSHOT_RETENTION:
+            return
+        where = "published_at < ? AND id < (SELECT max(id) FROM snapshot)"
+        cutoff = (now - SNAPSHOT_RETENTION * 3600,)
+        dropped = {
+            id for row in self.__conn.execute(f"SELECT {', '.join(SECTIONS)} FROM snapshot WHERE {where}", cutoff)
+            for id in row if id is not None
+        }
+        if not dropped:
+            return
+        self.__conn.execute(f"DELETE FROM snapshot WHERE {where}", cutoff)
+        self.__conn.execute(
+            f"DELETE FROM section WHERE id IN ({', '.join('?' * len(dropped))}) AND "
+            + " AND ".join(f"NOT EXISTS (SELECT 1 FROM snapshot WHERE {name} = section.id)" for name in SECTIONS),
+            tuple(dropped),
+        )
+
+    def publish(self, **sections):
+        """
+        Append a snapshot in which the given sections (polygons, predictions, ai_rec) are new.
+        The other sections carry over from the previous snapshot, or are null if there is none.
+        Only the holder of the `cycle` lease may publish; anyone else gets lease_lost.
+        """
+        unknown = set(sections) - set(SECTIONS)
+        if unknown:
+            raise ValueError(f"Unknown snapshot sections: {unknown}")
+
+        now = time.time()
+        with self.__lock:
+            self.__conn.execute("BEGIN IMMEDIATE")
+            try:
+                if not self.__holds("cycle"):
+                    raise lease_lost("cycle lease is held by another worker")
+                references = SECTIONS + FRESHNESS
+                row = self.__conn.execute(
+                    f"SELECT {', '.join(references)} FROM snapshot ORDER BY id DESC LIMIT 1"
+                ).fetchone()
+                values = {"published_at": now, **dict(zip(references, row or (None,) * len(references)))}
+                for name, content in sections.items():
+                    binary = content.to_binary if isinstance(content, polygon_snapshot) else lambda: None
+                    values[name], values[f"{name}_at"] = self.__section(name, encode(content), binary), now
+                self.__insert(values)
+                self.__prune(now)
+                self.__conn.execute("COMMIT")
+            except Exception:
+                self.__conn.execute("ROLLBACK")
+                raise
+            # data_version only moves for commits made by other connections
+            self.__latest = None
+
+    def latest(self):
+        """
+        Outputs:
+            dict with `id`, `published_at`, the JSON bytes of every section, each section's
+            `<section>_at` timestamp (None if never published) and `<section>_bin` binary
+            encoding (None unless it holds polygons), or None if nothing was published
+        """
+        with self.__lock:
+            version = self.__conn.execute("PRAGMA data_version").fetchone()[0]
+            if version != self.__version or self.__latest is None:
+                row = self.__conn.execute(
+                    f"{SELECT_SNAPSHOT} ORDER BY snapshot.id DESC LIMIT 1"
+                ).fetchone()
+                self.__latest = None if row is None else dict(zip(COLUMNS, row))
+                self.__version = version
+            return self.__latest
+
+    def at(self, ts):
+        """
+        Outputs:
+            the snapshot that was current at unix time `ts`, or None
+        """
+        with self.__lock:
+            row = self.__conn.execute(
+                f"{SELECT_SNAPSHOT} WHERE snapshot.published_at <= ? "
+                "ORDER BY snapshot.published_at DESC LIMIT 1",
+                (ts,),
+            ).fetchone()
+        return None if row is None else dict(zip(COLUMNS, row))
+
+    def between(self, start, end, batch=16):
+        """
+        Read from their own connection, `batch` rows at a time, so a long range neither holds
+        the store's lock nor sits in memory; the range is read from one consistent state of the
+        log even if the leader publishes or prunes meanwhile.
+        Outputs:
+            iterator over the snapshots published in [start, end], oldest first
+        """
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=30, check_same_thread=False)
+        try:
+            cur = conn.execute(
+                f"{SELECT_SNAPSHOT} WHERE snapshot.published_at BETWEEN ? AND ? "
+                "ORDER BY snapshot.published_at",
+                (start, end),
+            )
+            while True:
+                rows = cur.fetchmany(batch)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(zip(COLUMNS, row))
+        finally:
+            conn.close()
+
+    # GEOFENCES
+    def subscribe(self, id, radius, state, lon=None, lat=None, area=None):
+        """
+        Register (or replace) a subscription to a point (lon/lat) or an area (GeoJSON polygon string),
+        with the alert state (JSON) already returned to the subscriber
+        """
+        with self.__lock:
+            self.__conn.execute(
+                "INSERT OR REPLACE INTO subscription (id, lon, lat, area, radius, state) VALUES (?, ?, ?, ?, ?, ?)",
+                (id, lon, lat, area, radius, state),
+            )
+
+    def unsubscribe(self, id):
+        with self.__lock:
+            cur = self.__conn.execute("DELETE FROM subscription WHERE id = ?", (id,))
+            return cur.rowcount == 1
+
+    def subscription_version(self):
+        """
+        Outputs:
+            value that changes whenever a subscription is added, replaced or removed
+        """
+        with self.__lock:
+            # seq is never reused, so any insert raises the max and any lone delete lowers the count
+            return self.__conn.execute("SELECT count(*), max(seq) FROM subscription").fetchone()
+
+    def subscriptions(self):
+        """
+        Outputs:
+            list of (id, lon, lat, area, radius, state)
+        """
+        with self.__lock:
+            return self.__conn.execute("SELECT id, lon, lat, area, radius, state FROM subscription ORDER BY seq").fetchall()
+
+    def add_alerts(self, alerts):
+        """
+        Append alerts ({"subscription", "section", "status", "zone", "distance"}) and drop
+        those older than ALERT_RETENTION_HOURS. Like publish, only the `cycle` lease holder may append.
+        """
+        now = time.time()
+        with self.__lock:
+            self.__conn.execute("BEGIN IMMEDIATE")
+            try:
+                if not self.__holds("cycle"):
+                    raise lease_lost("cycle lease is held by another worker")
+                self.__conn.executemany(
+                    "INSERT INTO alert_log (subscription, published_at, section, status, zone, distance) VALUES (?, ?, ?, ?, ?, ?)",
+                    ((a["subscription"], now, a["section"], a["status"], a["zone"], a["distance"]) for a in alerts),
+                )
+                self.__conn.execute("DELETE FROM alert_log WHERE published_at < ?", (now - ALERT_RETENTION * 3600,))
+                self.__conn.execute("COMMIT")
+            except Exception:
+                self.__conn.execute("ROLLBACK")
+                raise
+
+    def alerts(self, subscription=None, since=0, limit=ALERT_PAGE_LIMIT):
+        """
+        Outputs:
+            alerts after sequence number `since` (of one subscription, or all), oldest first
+        """
+        where, args = ("subscription = ? AND seq > ?", (subscription, since)) if subscription else ("seq > ?", (since,))
+        with self.__lock:
+            rows = self.__conn.execute(
+                f"SELECT {', '.join(ALERT_COLUMNS)} FROM alert_log WHERE {where} ORDER BY seq LIMIT ?",
+                args + (limit,),
+            ).fetchall()
+        return [dict(zip(ALERT_COLUMNS, row)) for row in rows]
+
+    def latest_alerts(self):
+        """
+        Outputs:
+            the most recent alert of every subscription and section still in the log
+        """
+        with self.__lock:
+            rows = self.__conn.execute(
+                f"SELECT {', '.join(ALERT_COLUMNS)} FROM alert_log "
+                "WHERE seq IN (SELECT max(seq) FROM alert_log GROUP BY subscription, section)"
+            ).fetchall()
+        return [dict(zip(ALERT_COLUMNS, row)) for row in rows]
+
+    def close(self):
+        with self.__lock:
+            self.__conn.close()